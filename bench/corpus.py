@@ -0,0 +1,56 @@
+"""
+Seeded synthetic corpus of secrets: multi-word tags drawn from a skewed vocabulary, owned by many users with a few
+heavy ones, a fraction of them forgotten afterwards.
+"""
+import random
+
+_COMMON = ("prod", "staging", "dev", "db", "database", "password", "passwords", "vpn", "oncall", "wifi", "office",
+           "printer", "api", "token", "tokens", "key", "keys", "billing", "account", "accounts", "server", "servers",
+           "running", "deploy", "deploying", "backup", "backups", "mobile", "number", "phone", "meeting", "room",
+           "kubernetes", "cluster", "dashboard", "monitoring", "grafana", "jenkins", "mid-day", "someone's", "ssh",
+           "aws", "gcp", "s3", "bucket", "replica", "primary", "secondary", "admin", "root", "readonly", "legacy")
+_SYLLABLES = ("ka", "lo", "mi", "ne", "ro", "ta", "vu", "zi", "sha", "pre", "dex", "tor", "ul", "ix", "bo", "gan")
+
+
+class Corpus:
+    def __init__(self, size, users=1000, deleted=0.1, seed=7):
+        """
+        :param size: number of secrets
+        :param users: number of users owning them
+        :param deleted: fraction of secrets forgotten after being kept
+        :param seed: random seed, the same seed always gives the same corpus
+        """
+        self.size = size
+        self.users = ["user%04d" % i for i in range(users)]
+        self.deleted = deleted
+        self.seed = seed
+        rnd = random.Random(seed)
+        # a long tail of rare words next to the common ones
+        rare = {"".join(rnd.choice(_SYLLABLES) for _ in range(rnd.randint(2, 4))) for _ in range(5000)}
+        self.vocabulary = list(_COMMON) + sorted(rare)
+        # zipf-like weights, over words and over users
+        self._word_weights = [1.0 / (rank + 1) for rank in range(len(self.vocabulary))]
+        self._user_weights = [1.0 / (rank + 1) ** 0.8 for rank in range(users)]
+
+    def tag(self, rnd):
+        return " ".join(rnd.choices(self.vocabulary, self._word_weights, k=rnd.choice((1, 1, 2, 2, 2, 3, 3, 4))))
+
+    def secrets(self):
+        """
+        :return: generator of tuples containing key, secret and user name, as taken by da.put_many
+        """
+        rnd = random.Random(self.seed)
+        for i in range(self.size):
+            username = rnd.choices(self.users, self._user_weights)[0]
+            secret = "%s #%d %s" % (username, i, "x" * rnd.randint(8, 200))
+            yield self.tag(rnd), secret, username
+
+    def is_deleted(self, i):
+        return random.Random(self.seed * 1000003 + i).random() < self.deleted
+
+    def queries(self, count):
+        """
+        :return: list of tuples containing a tag and a user name, drawn like kept secrets are
+        """
+        rnd = random.Random(self.seed + 1)
+        return [(self.tag(rnd), rnd.choices(self.users, self._user_weights)[0]) for _ in range(count)]
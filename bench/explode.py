@@ -0,0 +1,57 @@
+"""
+Per-key cost of deriving keywords from tags.
+
+    $ python -m bench.explode [--keys 20000]
+
+"before" builds a stemmer for every word, as da._stem used to; "_explode" and "explode_many" go through the cached
+stemming pipeline of src.da, from a cold and then a warm cache.
+"""
+import argparse
+import random
+import time
+
+from nltk.stem.snowball import SnowballStemmer
+
+from src import da
+
+_WORDS = ("prod", "staging", "database", "passwords", "running", "servers", "mobile", "numbers", "vpn", "oncall",
+          "kubernetes", "clusters", "credentials", "wifi", "office", "printer", "backups", "deploying", "keys", "api",
+          "tokens", "billing", "accounts", "monitoring", "dashboards", "meeting", "rooms", "atif's", "mid-day")
+
+
+def _tags(count, seed=7):
+    rnd = random.Random(seed)
+    return [" ".join(rnd.choice(_WORDS) for _ in range(rnd.randint(1, 4))) for _ in range(count)]
+
+
+def _before(key):
+    keys = set()
+    for word in set(key.lower().split()):
+        word = word.replace("'", "").replace("?", "")
+        for w in {word}.union(word.split("-")):
+            if w not in da._stop_words:
+                keys.add((w, SnowballStemmer("english").stem(w)))
+    return list(keys)
+
+
+def _timeit(label, func, tags):
+    start = time.perf_counter()
+    func(tags)
+    elapsed = time.perf_counter() - start
+    print("%-22s %10.2f us/key" % (label, elapsed / len(tags) * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python -m bench.explode")
+    parser.add_argument('--keys', type=int, default=20000, help="number of tags to explode")
+    args = parser.parse_args()
+
+    tags = _tags(args.keys)
+    _timeit("before", lambda ts: [_before(t) for t in ts], tags)
+    da._stem_word.cache_clear()
+    _timeit("_explode (cold cache)", lambda ts: [da._explode(t) for t in ts], tags)
+    _timeit("_explode (warm cache)", lambda ts: [da._explode(t) for t in ts], tags)
+    da._stem_word.cache_clear()
+    _timeit("explode_many (cold)", da.explode_many, tags)
+    _timeit("explode_many (warm)", da.explode_many, tags)
+    print(da.stem_cache_info())
@@ -0,0 +1,175 @@
+"""
+Load test of the slack server, threaded vs pre-forked, over a file store holding the seeded corpus of bench.corpus.
+
+    $ python -m bench.load [--size 10000] [--servers threaded,prefork] [--processes 4] [--clients 8]
+                           [--requests 2000] [--cache-size 1024] [--snapshot N] [--out load.json]
+
+The server runs in a subprocess on a free local port and answers /tell right away (nothing is deferred). Client
+processes send the commands over plain HTTP and time them. Every run ends with a consistency check: a tag is
+completed, kept, then completed again - whichever worker answers, and whatever keys it loaded, it must be suggested.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.corpus import Corpus
+
+_LOAD_BATCH = 10000
+
+
+def _load(tmp, size, users, seed):
+    from src import da
+    from src.stores import file as filestore
+    filestore._store = filestore._single_store = os.path.join(tmp, "load.db_" + filestore._ns)
+    filestore._store_del = filestore._store + ".deleted"
+    da._store, da._storage = filestore, "file"
+    batch = []
+    for item in Corpus(size, users=users, seed=seed).secrets():
+        batch.append(item)
+        if len(batch) == _LOAD_BATCH:
+            da.put_many(batch)
+            batch = []
+    if batch:
+        da.put_many(batch)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def _command(port, command, text, username):
+    body = urllib.parse.urlencode({"command": command, "text": text, "user_name": username, "channel_id": "C1",
+                                   "channel_name": "load", "user_id": "U1", "response_url": ""})
+    connection = http.client.HTTPConnection("localhost", port, timeout=30)
+    try:
+        connection.request("POST", "/dude/command", body, {"Content-Type": "application/x-www-form-urlencoded"})
+        return connection.getresponse().read().decode("utf-8")
+    finally:
+        connection.close()
+
+
+def _client(args):
+    port, queries = args
+    samples = []
+    for tag, username in queries:
+        start = time.perf_counter()
+        _command(port, "/tell", tag, username)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _start(name, processes, port, tmp, args):
+    env = dict(os.environ, DUDE_FILE_DB=os.path.join(tmp, "load.db"), DUDE_STORE="file", DUDE_SLACK_SERVER=name,
+               DUDE_SLACK_PROCESSES=str(processes), DUDE_SLACK_PORT=str(port), DUDE_SLACK_DEFER="",
+               DUDE_CACHE_SIZE=str(args.cache_size), PYTHONPATH=os.getcwd())
+    if args.snapshot is not None:
+        env["DUDE_FILE_INDEX_SNAPSHOT"] = str(args.snapshot)
+    server = subprocess.Popen([sys.executable, os.path.join("src", "clients", "slack_dude.py")], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("%s server did not start" % name)
+
+
+def _memory(pid):
+    """
+    :return: proportional set size in MiB of a process and its children, which counts the pages they share once; None
+    where /proc doesn't tell
+    """
+    try:
+        with open("/proc/%d/smaps_rollup" % pid) as f:
+            pss = sum(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+        with open("/proc/%d/task/%d/children" % (pid, pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return None
+    return pss / 1024 + sum(_memory(child) or 0 for child in children)
+
+
+def _consistent(port, username, checks, spread):
+    """
+    :param spread: number of concurrent commands, so that several workers answer them
+    :return: number of checks whose /tell commands all suggested a tag kept right before them
+    """
+    told = 0
+    with ThreadPoolExecutor(spread) as pool:
+        for _ in range(checks):
+            tag = "load%s" % uuid.uuid4().hex[:12]
+            # tags starting with it, none yet, from the user's keys which the workers answering load and keep
+            list(pool.map(lambda _i: _command(port, "/tell", tag + "*", username), range(spread)))
+            _command(port, "/keep", "%s fresh" % tag, username)
+            answers = pool.map(lambda _i: _command(port, "/tell", tag + "*", username), range(spread))
+            told += all(answer.endswith("\n" + tag) for answer in answers)
+    return told
+
+
+def _run(name, args, tmp):
+    port = _free_port()
+    processes = args.processes if name == "prefork" else 1
+    server = _start(name, processes, port, tmp, args)
+    try:
+        queries = Corpus(args.size, users=args.users, seed=args.seed).queries(args.requests)
+        shares = [(port, queries[i::args.clients]) for i in range(args.clients)]
+        _client((port, queries[:args.clients]))  # warm every worker up
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.clients) as pool:
+            samples = sorted(sample for share in pool.map(_client, shares) for sample in share)
+        elapsed = time.perf_counter() - start
+        told = _consistent(port, queries[0][1], args.checks, 2 * processes)
+        memory = _memory(server.pid)
+    finally:
+        server.terminate()
+        server.wait(30)
+    result = {"server": name, "processes": processes, "clients": args.clients, "requests": len(samples),
+              "per_second": len(samples) / elapsed, "p50_ms": samples[len(samples) // 2] * 1e3,
+              "p95_ms": samples[int(len(samples) * 0.95)] * 1e3, "consistent": "%d/%d" % (told, args.checks),
+              "memory_mib": memory}
+    print("%-9s processes=%-3d %8.0f/s  p50=%.1fms  p95=%.1fms  memory=%sMiB  kept then told: %s"
+          % (name, processes, result["per_second"], result["p50_ms"], result["p95_ms"],
+             "%.0f" % memory if memory is not None else "?", result["consistent"]))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python -m bench.load")
+    parser.add_argument('--size', type=int, default=10000, help="number of secrets in the store")
+    parser.add_argument('--users', type=int, default=100, help="number of users owning them")
+    parser.add_argument('--servers', default="threaded,prefork", help="comma separated servers to compare")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="workers of the prefork server")
+    parser.add_argument('--clients', type=int, default=8, help="number of concurrent client processes")
+    parser.add_argument('--requests', type=int, default=2000, help="number of /tell commands sent")
+    parser.add_argument('--checks', type=int, default=20, help="number of /keep then /tell consistency checks")
+    parser.add_argument('--cache-size', type=int, default=1024, help="DUDE_CACHE_SIZE of the server, 0 disables it")
+    parser.add_argument('--snapshot', type=int, help="DUDE_FILE_INDEX_SNAPSHOT of the server, its own default if unset")
+    parser.add_argument('--seed', type=int, default=7, help="corpus seed")
+    parser.add_argument('--out', help="where to write the results as JSON")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="dude-load-")
+    try:
+        _load(tmp, args.size, args.users, args.seed)
+        results = [_run(name, args, tmp) for name in args.servers.split(",")]
+    finally:
+        shutil.rmtree(tmp)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"python": sys.version.split()[0], "cpus": os.cpu_count(), "results": results}, f, indent=2)
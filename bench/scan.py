@@ -0,0 +1,63 @@
+"""
+Full scan throughput of the file store, text records vs binary records.
+
+    $ python -m bench.scan [--records 100000]
+
+Writes the same synthetic secrets in both formats to a temporary directory and walks them with the store's cursor,
+reading bodies or skipping them.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from src.stores import file as filestore
+
+_WORDS = ("prod", "staging", "db", "password", "vpn", "oncall", "wifi", "printer", "api", "token", "billing", "k8s")
+
+
+def _secrets(count, seed=7):
+    rnd = random.Random(seed)
+    for _ in range(count):
+        words = [rnd.choice(_WORDS) for _ in range(rnd.randint(1, 4))]
+        secret = filestore.Secret()
+        secret.serialize(str(uuid.uuid4()), " ".join(words), "secret %s" % ("x" * rnd.randint(8, 600)), words, words,
+                         "user%d" % rnd.randint(0, 50), datetime.utcnow())
+        yield secret
+
+
+def _scan(store, body):
+    start = time.perf_counter()
+    count = 0
+    for _offset, secret in filestore._cursor(store, body=body):
+        if body:
+            secret.secret
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python -m bench.scan")
+    parser.add_argument('--records', type=int, default=100000, help="number of records to scan")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="dude-bench-")
+    try:
+        text, binary = os.path.join(tmp, "text.db"), os.path.join(tmp, "binary.db")
+        with open(text, "w") as t, open(binary, "wb") as b:
+            b.write(filestore._MAGIC)
+            for secret in _secrets(args.records):
+                t.write("\n%s" % secret.text())
+                b.write(secret.pack())
+        print("%-8s %12s %12s" % ("", "text", "binary"))
+        print("%-8s %10.1fMB %10.1fMB" % ("size", os.path.getsize(text) / 1e6, os.path.getsize(binary) / 1e6))
+        for body in (True, False):
+            text_rate, binary_rate = _scan(text, body), _scan(binary, body)
+            print("%-8s %10.0f/s %10.0f/s  x%.1f" % ("body" if body else "no body", text_rate, binary_rate,
+                                                    binary_rate / text_rate))
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,47 @@
+"""
+Import cost of the CLI, as reported by python -X importtime.
+
+    $ python -m bench.startup [--module src.dude] [--runs 5] [--top 10]
+
+Prints the cumulative import time of the module (best of several runs), the slowest imports and flags heavy
+dependencies (nltk, pymongo, bson) that should only be loaded once an operation needs them.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+_HEAVY = ("nltk", "pymongo", "bson")
+
+
+def _importtime(module):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")])))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                          env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True,
+                          check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python -m bench.startup")
+    parser.add_argument('--module', default="src.dude", help="module to import")
+    parser.add_argument('--runs', type=int, default=5, help="number of runs, the best one is reported")
+    parser.add_argument('--top', type=int, default=10, help="number of slowest imports to list")
+    args = parser.parse_args()
+
+    runs = [_importtime(args.module) for _ in range(args.runs)]
+    best = min(runs, key=lambda times: times.get(args.module, 0))
+    print("%s: %.2f ms (best of %d)" % (args.module, best.get(args.module, 0) / 1000, args.runs))
+    for name, us in sorted(best.items(), key=lambda item: -item[1])[:args.top]:
+        print("  %8.2f ms  %s" % (us / 1000, name))
+    heavy = sorted({name.strip().split(".")[0] for name in best} & set(_HEAVY))
+    if heavy:
+        print("heavy imports at startup: %s" % ", ".join(heavy))
+        sys.exit(1)
@@ -0,0 +1,203 @@
+"""
+Timings of the public operations of src.da over every store, at several corpus sizes.
+
+    $ python -m bench.suite [--sizes 1000,100000,1000000] [--stores file,mongodb] [--ops 1000] [--out results.json]
+                            [--baseline previous.json] [--tolerance 0.2]
+
+Every store is loaded with the seeded corpus of bench.corpus (put_many, in batches) then put, get, rank,
+list_absolute_keys, complete and remove are timed one call at a time, with the query cache disabled so that every call
+reaches the store. The file and SQLite stores work in a temporary directory, MongoDB runs on mongomock. The import
+time of the CLI and the cost of _explode are measured once. Results are written as JSON; given a baseline, operations
+whose median got slower by more than the tolerance are listed and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from bench.corpus import Corpus
+from bench.startup import _importtime
+from src import da
+from src.cache import QueryCache
+
+_LOAD_BATCH = 10000
+
+
+def _file_store(tmp):
+    from src.stores import file as filestore
+    filestore._layout = "single"
+    filestore._store = filestore._single_store = os.path.join(tmp, "bench.db")
+    filestore._store_del = filestore._store + ".deleted"
+    return filestore
+
+
+def _mongodb_store(_tmp):
+    import mongomock
+    from src.stores import mongodb as mongostore
+    mongostore._collection = mongomock.MongoClient().bench.secrets
+    mongostore._ensure_indexes(mongostore._collection)
+    return mongostore
+
+
+def _sqlite_store(tmp):
+    from src.stores import sqlite as sqlitestore
+    sqlitestore._db = os.path.join(tmp, "bench.sqlite")
+    return sqlitestore
+
+
+_STORES = {"file": _file_store, "mongodb": _mongodb_store, "sqlite": _sqlite_store}
+
+
+def _stats(samples):
+    samples = sorted(samples)
+    return {"calls": len(samples), "mean_us": sum(samples) / len(samples) * 1e6,
+            "p50_us": samples[len(samples) // 2] * 1e6, "p95_us": samples[int(len(samples) * 0.95)] * 1e6,
+            "max_us": samples[-1] * 1e6}
+
+
+def _timeit(func, args):
+    samples = []
+    for arg in args:
+        start = time.perf_counter()
+        func(*arg)
+        samples.append(time.perf_counter() - start)
+    return _stats(samples)
+
+
+def _load(corpus):
+    """
+    Keeps the whole corpus, then forgets its deleted fraction.
+
+    :return: a tuple containing the load throughput in secrets per second, the IDs of the secrets still kept and those
+    of the secrets to forget, both as lists of tuples containing the ID and the user name
+    """
+    kept, forgotten, batch, i = [], [], [], 0
+    start = time.perf_counter()
+    for item in corpus.secrets():
+        batch.append(item)
+        if len(batch) == _LOAD_BATCH:
+            i = _load_batch(corpus, batch, i, kept, forgotten)
+            batch = []
+    if batch:
+        _load_batch(corpus, batch, i, kept, forgotten)
+    return corpus.size / (time.perf_counter() - start), kept, forgotten
+
+
+def _load_batch(corpus, batch, i, kept, forgotten):
+    for (_keys, sid), (_key, _secret, username) in zip(da.put_many(batch), batch):
+        (forgotten if corpus.is_deleted(i) else kept).append((sid, username))
+        i += 1
+    return i
+
+
+def _run(name, size, args, tmp):
+    da._store = _STORES[name](tmp)
+    da._storage = name
+    corpus = Corpus(size, users=min(args.users, size), deleted=args.deleted, seed=args.seed)
+    results = {}
+
+    def record(op, func, calls):
+        try:
+            results[op] = func(calls)
+        except Exception as e:
+            # an operation missing from a store is reported, not fatal to the whole run
+            results[op] = {"error": "%s: %s" % (type(e).__name__, e)}
+
+    rate, kept, forgotten = _load(corpus)
+    results["put_many"] = {"calls": size, "per_second": rate}
+    rnd = random.Random(args.seed)
+    queries = corpus.queries(args.ops)
+    usernames = [username for _tag, username in queries]
+    record("remove", lambda calls: _timeit(da.remove, calls), forgotten[:args.ops])
+    if "error" not in results["remove"]:
+        by_user = {}
+        for sid, username in forgotten[args.ops:]:
+            by_user.setdefault(username, []).append(sid)
+        for username, sids in by_user.items():
+            da.remove_many(sids, username)
+    record("get", lambda calls: _timeit(da.get, calls), queries)
+    record("get_any", lambda calls: _timeit(lambda tag, username: da.get(tag, username, match_all=False), calls),
+           queries)
+    record("rank", lambda calls: _timeit(lambda tag, username: da.rank(tag, username, limit=10), calls), queries)
+    record("list_absolute_keys", lambda calls: _timeit(da.list_absolute_keys, calls),
+           [(username,) for username in usernames])
+    # the first call of every user loads their vocabulary, later calls only search it
+    record("complete", lambda calls: _timeit(lambda prefix, username: da.complete(prefix, username, 10), calls),
+           [(tag[:3], username) for tag, username in queries])
+    puts = [(corpus.tag(rnd), "bench secret %d" % i, username) for i, username in enumerate(usernames)]
+    record("put", lambda calls: _timeit(da.put, calls), puts)
+    print("%-8s %9d  %s" % (name, size, "  ".join("%s=%s" % (op, _summary(r)) for op, r in results.items())))
+    return [dict(store=name, size=size, op=op, **result) for op, result in results.items()]
+
+
+def _summary(result):
+    if "error" in result:
+        return "error"
+    if "per_second" in result:
+        return "%.0f/s" % result["per_second"]
+    return "%.0fus" % result["p50_us"]
+
+
+def _explode(args):
+    tags = [tag for tag, _username in Corpus(0, seed=args.seed).queries(args.ops)]
+    da._stem_word.cache_clear()
+    cold = _timeit(da._explode, [(tag,) for tag in tags])
+    warm = _timeit(da._explode, [(tag,) for tag in tags])
+    return [dict(store=None, size=None, op="_explode_cold", **cold),
+            dict(store=None, size=None, op="_explode_warm", **warm)]
+
+
+def _startup(args):
+    best = min(_importtime("src.dude").get("src.dude", 0) for _ in range(args.startup_runs))
+    return [dict(store=None, size=None, op="startup", calls=args.startup_runs, p50_us=best, mean_us=best)]
+
+
+def _regressions(results, baseline, tolerance):
+    before = {(r["store"], r["size"], r["op"]): r for r in baseline["results"] if "p50_us" in r}
+    for result in results:
+        previous = before.get((result["store"], result["size"], result["op"]))
+        if previous and "p50_us" in result and result["p50_us"] > previous["p50_us"] * (1 + tolerance):
+            yield result, previous
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python -m bench.suite")
+    parser.add_argument('--sizes', default="1000,100000,1000000", help="comma separated corpus sizes")
+    parser.add_argument('--stores', default=",".join(sorted(_STORES)), help="comma separated stores")
+    parser.add_argument('--users', type=int, default=1000, help="number of users owning the corpus")
+    parser.add_argument('--deleted', type=float, default=0.1, help="fraction of the corpus forgotten")
+    parser.add_argument('--ops', type=int, default=1000, help="number of timed calls per operation")
+    parser.add_argument('--seed', type=int, default=7, help="corpus seed")
+    parser.add_argument('--startup-runs', type=int, default=5, help="number of CLI imports, the best one is kept")
+    parser.add_argument('--out', default="bench-results.json", help="where to write the results")
+    parser.add_argument('--baseline', help="results of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown of medians over the baseline")
+    args = parser.parse_args()
+
+    da._cache = QueryCache(0, 0)
+    results = _startup(args) + _explode(args)
+    for size in [int(size) for size in args.sizes.split(",")]:
+        for name in args.stores.split(","):
+            tmp = tempfile.mkdtemp(prefix="dude-bench-")
+            try:
+                results.extend(_run(name, size, args, tmp))
+            finally:
+                shutil.rmtree(tmp)
+    with open(args.out, "w") as f:
+        json.dump({"python": platform.python_version(), "date": datetime.utcnow().isoformat(), "seed": args.seed,
+                   "results": results}, f, indent=2)
+    print("results written to %s" % args.out)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = list(_regressions(results, json.load(f), args.tolerance))
+        for result, previous in slower:
+            print("slower: %s %s %s %.0fus -> %.0fus" % (result["store"], result["size"], result["op"],
+                                                         previous["p50_us"], result["p50_us"]))
+        if slower:
+            sys.exit(1)
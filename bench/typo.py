@@ -0,0 +1,64 @@
+"""
+Typo-tolerant key lookup, trigram candidates vs comparing a misspelled word to every key.
+
+    $ python -m bench.typo [--keys 100000] [--lookups 1000] [--distance 2]
+
+Keys come from the vocabulary of bench.corpus, lookups are keys with random edits. Both approaches must find the same
+keys, the trigram index only computes the edit distance of the candidates it generates.
+"""
+import argparse
+import random
+import time
+
+from bench.corpus import Corpus
+from src.vocabulary import Vocabulary, distance
+
+_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def _misspell(word, edits, rnd):
+    for _ in range(edits):
+        i = rnd.randrange(len(word))
+        edit = rnd.choice(("insert", "delete", "replace"))
+        if edit == "insert":
+            word = word[:i] + rnd.choice(_LETTERS) + word[i:]
+        elif edit == "delete" and len(word) > 1:
+            word = word[:i] + word[i + 1:]
+        else:
+            word = word[:i] + rnd.choice(_LETTERS) + word[i + 1:]
+    return word
+
+
+def _brute_force(keys, word, bound):
+    return sorted((d, key) for d, key in ((distance(word, key, bound), key) for key in keys) if d <= bound)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python -m bench.typo")
+    parser.add_argument('--keys', type=int, default=100000, help="number of distinct keys")
+    parser.add_argument('--lookups', type=int, default=1000, help="number of misspelled lookups")
+    parser.add_argument('--distance', type=int, default=2, help="largest edit distance")
+    args = parser.parse_args()
+
+    rnd = random.Random(7)
+    corpus = Corpus(0, users=1)
+    keys = set(corpus.vocabulary)
+    while len(keys) < args.keys:
+        keys.add(corpus.tag(rnd).replace(" ", ""))
+    keys = sorted(keys)[:args.keys]
+    vocabulary = Vocabulary(lambda username: [(str(i), {key}) for i, key in enumerate(keys)], ttl=3600)
+    typos = [_misspell(rnd.choice(keys), rnd.randint(1, args.distance), rnd) for _ in range(args.lookups)]
+
+    start = time.perf_counter()
+    vocabulary.similar("user", "warmup", args.distance)
+    print("%-12s %10.2f ms" % ("index build", (time.perf_counter() - start) * 1e3))
+    start = time.perf_counter()
+    trigram = [vocabulary.similar("user", typo, args.distance) for typo in typos]
+    trigram_us = (time.perf_counter() - start) / len(typos) * 1e6
+    start = time.perf_counter()
+    brute = [[key for _d, key in _brute_force(keys, typo, args.distance)] for typo in typos]
+    brute_us = (time.perf_counter() - start) / len(typos) * 1e6
+    print("%-12s %10.2f us/lookup" % ("trigrams", trigram_us))
+    print("%-12s %10.2f us/lookup  x%.1f" % ("brute force", brute_us, brute_us / trigram_us))
+    missed = sum(1 for t, b in zip(trigram, brute) if t != b)
+    print("lookups answered differently: %d/%d" % (missed, len(typos)))
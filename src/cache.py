@@ -0,0 +1,168 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+_MISSING = object()
+_MARK = struct.Struct("<Q")
+
+
+class QueryCache:
+    """
+    Least recently used cache of query results, with a time to live. Entries are tracked per user, so that a user's
+    writes drop all of their cached results. Results read from the store while those of their user were dropped are not
+    cached: callers take the user's generation before reading, and put the result along with it.
+    """
+
+    def __init__(self, size, ttl):
+        """
+        :param size: maximum number of cached results, 0 disables the cache
+        :param ttl: seconds a result stays valid for
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (username, expiry, value)
+        self._users = {}  # username -> keys
+        self._generations = {}  # username -> number of times their results were dropped
+        self._cleared = 0  # number of times every result was dropped
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[1] <= time.monotonic():
+                self._drop(key)
+                entry = _MISSING
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def generation(self, username):
+        """
+        :param username: user name
+        :return: token which changes whenever the user's results are dropped
+        """
+        with self._lock:
+            return self._cleared, self._generations.get(username, 0)
+
+    def put(self, key, username, value, generation=None):
+        """
+        :param key: query key
+        :param username: user name
+        :param value: result
+        :param generation: the user's generation taken before reading the result, None to cache it regardless
+        """
+        if self.size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != (self._cleared, self._generations.get(username, 0)):
+                return  # dropped while it was read, it may predate a write
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (username, time.monotonic() + self.ttl, value)
+            self._users.setdefault(username, set()).add(key)
+            while len(self._entries) > self.size:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, username):
+        with self._lock:
+            self._generations[username] = self._generations.get(username, 0) + 1
+            for key in self._users.pop(username, ()):
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._cleared += 1
+            self._entries.clear()
+            self._users.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "size": len(self._entries), "max_size": self.size}
+
+    def _drop(self, key):
+        username = self._entries.pop(key)[0]
+        keys = self._users.get(username)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._users[username]
+
+
+class WriteMarks:
+    """
+    Per-user write marks shared between processes through a memory-mapped file: a process writing a user's secrets
+    leaves a new mark, and the others tell from it that what they cached about the user is stale. Users are hashed to a
+    fixed number of slots, users sharing one just drop each other's cached results more often than needed.
+    """
+
+    def __init__(self, path, slots=4096):
+        """
+        :param path: file shared by the processes, created if missing
+        :param slots: number of marks in the file
+        """
+        self.path = path
+        self.slots = slots
+        self._map = None  # mapped on first use
+        self._seen = {}  # slot -> mark this process last saw
+        self._lock = threading.Lock()
+
+    def mark(self, username):
+        """
+        Record that a user's secrets changed.
+
+        :param username: user name
+        """
+        slot = self._slot(username)
+        mark = os.urandom(_MARK.size)  # unique whatever process writes it, unlike a counter or a forked random state
+        with self._lock:
+            self._mapped()[slot * _MARK.size:(slot + 1) * _MARK.size] = mark
+            self._seen[slot] = _MARK.unpack(mark)[0]
+
+    def mark_all(self):
+        """
+        Record that any user's secrets may have changed, e.g. after an import.
+        """
+        with self._lock:
+            mapped = self._mapped()
+            mapped[:] = os.urandom(len(mapped))
+            self._seen.clear()
+
+    def changed(self, username):
+        """
+        Tell whether another process changed a user's secrets since this one last asked.
+
+        :param username: user name
+        :return: True if the user's cached results are stale
+        """
+        slot = self._slot(username)
+        with self._lock:
+            mark = _MARK.unpack_from(self._mapped(), slot * _MARK.size)[0]
+            seen = self._seen.get(slot, mark)
+            self._seen[slot] = mark
+            return seen != mark
+
+    def _slot(self, username):
+        return zlib.crc32((username or '').encode("utf-8")) % self.slots
+
+    def _mapped(self):
+        if self._map is None:
+            size = self.slots * _MARK.size
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        return self._map
@@ -1,13 +1,115 @@
 import json
 import os
+import re
+import shutil
+import signal
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
 
-from bottle import route, run, request
-
-from src import dude
-
-_SERVER_HOST = os.environ['DUDE_SLACK_HOST']
-_SERVER_PORT = os.environ['DUDE_SLACK_PORT']
+import requests
+from bottle import ServerAdapter, route, run, request, response
+
+from src import da, dude, metrics
+from src.cache import WriteMarks
+
+_SERVER_HOST = os.environ.get('DUDE_SLACK_HOST', 'localhost')
+_SERVER_PORT = os.environ.get('DUDE_SLACK_PORT', 4390)
+# "threaded", "prefork", or any server bottle supports (wsgiref, paste, gevent...)
+_SERVER = os.environ.get('DUDE_SLACK_SERVER', 'threaded')
+# worker processes of the "prefork" server
+_PROCESSES = int(os.environ.get('DUDE_SLACK_PROCESSES', 0)) or os.cpu_count() or 1
+# records indexed past the file store's index snapshot before the "prefork" server has it rewritten, when
+# DUDE_FILE_INDEX_SNAPSHOT doesn't say
+_PREFORK_SNAPSHOT = 10000
+_TELL_LIMIT = int(os.environ.get('DUDE_SLACK_TELL_LIMIT', 10))
+_LIST_LIMIT = int(os.environ.get('DUDE_SLACK_LIST_LIMIT', 50))
+# commands acknowledged right away and answered later through their response_url
+_DEFERRED = set(filter(None, os.environ.get('DUDE_SLACK_DEFER', '/tell,/list').split(",")))
+_WORKERS = int(os.environ.get('DUDE_SLACK_WORKERS', 4))
+_QUEUE_DEPTH = int(os.environ.get('DUDE_SLACK_QUEUE', 32))
+
+_executor = ThreadPoolExecutor(max_workers=_WORKERS)
+# bounds the commands waiting for or running on a worker
+_queue_slots = threading.BoundedSemaphore(_QUEUE_DEPTH)
+
+
+class ThreadedServer(ServerAdapter):
+    """
+    wsgiref server handling every request in its own thread.
+    """
+
+    def run(self, handler):
+        from socketserver import ThreadingMixIn
+        from wsgiref.simple_server import WSGIServer, make_server
+
+        class _Server(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        make_server(self.host, self.port, handler, server_class=_Server, **self.options).serve_forever()
+
+
+class PreforkServer(ServerAdapter):
+    """
+    Threaded wsgiref servers in DUDE_SLACK_PROCESSES worker processes, forked once the listening socket is open so that
+    they all accept connections on it. Commands are then answered on as many cores, and workers that die are replaced.
+    Workers share writes through da's write marks, so that a secret kept in one is told by all the others right away.
+    Over the file store, they share the memory-mapped snapshot of its index, which is loaded before they are forked.
+    """
+
+    def run(self, handler):
+        from socketserver import ThreadingMixIn
+        from wsgiref.simple_server import WSGIServer, make_server
+
+        class _Server(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        marks_dir = None
+        if da._marks is None:
+            marks_dir = tempfile.mkdtemp(prefix="dude-slack-")
+            da._marks = WriteMarks(os.path.join(marks_dir, "marks"))
+        if da._storage == "file":
+            from src.stores import file as filestore
+
+            if not os.environ.get('DUDE_FILE_INDEX_SNAPSHOT'):
+                filestore._snapshot_every = _PREFORK_SNAPSHOT
+            for store, _store_del in filestore._shards():
+                filestore._index(store)
+        server = make_server(self.host, self.port, handler, server_class=_Server, **self.options)
+        workers = set()
+        stopping = []
+
+        def stop(signum, _frame):
+            stopping.append(signum)
+            for pid in list(workers):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        try:
+            while not stopping:
+                while len(workers) < _PROCESSES and not stopping:
+                    pid = os.fork()
+                    if pid == 0:
+                        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                        signal.signal(signal.SIGINT, signal.SIG_DFL)
+                        try:
+                            server.serve_forever()
+                        finally:
+                            os._exit(0)
+                    workers.add(pid)
+                pid, _status = os.wait()
+                workers.discard(pid)
+            for pid in workers:
+                os.waitpid(pid, 0)
+        finally:
+            server.server_close()
+            if marks_dir is not None:
+                shutil.rmtree(marks_dir, ignore_errors=True)
 
 
 @route('/verification', method="POST")
@@ -16,6 +118,13 @@ def verification():
     return req['challenge']
 
 
+@route('/metrics')
+def metrics_text():
+    # Prometheus scrape target, empty unless DUDE_METRICS is set
+    response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+    return metrics.render()
+
+
 @route('/dude/command', method="POST")
 def keep():
     # token=XXX&team_id=XXX&team_domain=XXX&channel_id=XXX&channel_name=directmessage&user_id=XXX&user_name=XXX
@@ -29,9 +138,36 @@ def keep():
     text = request.forms.get("text")
     response_url = request.forms.get("response_url")
 
-    handler_func = eval("_%s" % command.replace("/", ""))
-    res = handler_func(channel_id, channel_name, user_id, user_name, command, text, response_url)
-    return res
+    return _handle(channel_id, channel_name, user_id, user_name, command, text, response_url)
+
+
+def _handle(channel_id, channel_name, user_id, user_name, command, text, response_url):
+    handler_func = _handlers.get(command)
+    if handler_func is None:
+        return "\n".join([_sarcasm[randint(0, len(_sarcasm) - 1)], "Hint: %s" % ", ".join(sorted(_handlers))])
+    args = (channel_id, channel_name, user_id, user_name, command, text, response_url)
+    metrics.inc("dude_slack_commands_total", command=command)
+    if command not in _DEFERRED or not response_url:
+        return handler_func(*args)
+    if not _queue_slots.acquire(blocking=False):
+        metrics.inc("dude_slack_rejected_total", command=command)
+        return "Too many secrets being told right now, ask me again in a bit."
+    try:
+        _executor.submit(_reply_later, handler_func, args)
+    except Exception:
+        _queue_slots.release()
+        raise
+    return "On it.."
+
+
+def _reply_later(handler_func, args):
+    try:
+        res = handler_func(*args)
+        requests.post(args[-1], json={"text": res}, timeout=10)
+    except Exception as e:
+        print("Failed to answer %s: %s" % (args[4], e))
+    finally:
+        _queue_slots.release()
 
 
 _sarcasm = (":expressionless: let's be good to each other.", ":disappointed: quit playin!",
@@ -48,7 +184,7 @@ def _keep(channel_id, channel_name, user_id, user_name, command, text, response_
         res = "\n".join([_sarcasm[randint(0, len(_sarcasm) - 1)], "Hint: /keep <tag> <secret>"])
     else:
         try:
-            dude.keep(secret[0], tag)
+            dude.keep(secret[0], tag, user_name)
             res = "\n".join(["Kept! To recall just holla..", "Hint: /tell %s" % tag])
         except Exception as e:
             res = "\n".join([_error_msg, str(e)])
@@ -56,28 +192,49 @@ def _keep(channel_id, channel_name, user_id, user_name, command, text, response_
 
 
 def _tell(channel_id, channel_name, user_id, user_name, command, text, response_url):
-    tag, *secret = text.split(" ", 1)
-    if tag:
+    # /tell <tag> [-n <limit>] [-p <page token>], or /tell <prefix>* for tag suggestions
+    match = re.match(r"^(.*?)(?:\s+-n\s+(\d+))?(?:\s+-p\s+(\S+))?$", text.strip())
+    # pages hold at least one secret, or they would never move past one another
+    tag, limit, token = match.group(1), max(int(match.group(2) or _TELL_LIMIT), 1), match.group(3)
+    if tag.endswith("*") and tag.rstrip("*"):
         try:
-            secrets = dude.tell(tag)
-            if len(secrets) > 1:
-                res = "\n".join(["Found more than one. Sorting by match strength..", ] + [s[2] for s in secrets])
+            keys = dude.complete(tag.rstrip("*"), user_name, limit=limit)
+            res = "\n".join(["Try one of these..", ] + keys) if keys else "no tags starting with %s" % tag.rstrip("*")
+        except Exception as e:
+            res = "\n".join([_error_msg, str(e)])
+    elif tag:
+        try:
+            secrets, next_token = dude.tell_page(tag, user_name, limit, token)
+            if len(secrets) > 1 or token or next_token:
+                res = "\n".join(["Found more than one. Sorting by match strength..", ] +
+                                 ["%.2f  %s" % (s[0], s[3]) for s in secrets])
+                if next_token:
+                    res += "\nMore: /tell %s -n %d -p %s" % (tag, limit, next_token)
             elif len(secrets) == 0:
                 res = "nothing associated with %s" % tag
             else:
-                res = str(secrets[0][2])
+                res = str(secrets[0][3])
         except Exception as e:
             res = "\n".join([_error_msg, str(e)])
     else:
-        res = "\n".join(["I am gonna need a tag %s! I am no God!" % user_name, "Hint: /tell <tag>"])
+        res = "\n".join(["I am gonna need a tag %s! I am no God!" % user_name,
+                         "Hint: /tell <tag> [-n <limit>], or /tell <tag beginning>* for suggestions"])
     return res
 
 
 def _list(channel_id, channel_name, user_id, user_name, command, text, response_url):
+    # /list [-n <limit>] [-p <last tag of the previous page>]
+    match = re.match(r"^(?:-n\s+(\d+))?\s*(?:-p\s+(.+))?$", text.strip())
+    limit, after = (max(int(match.group(1) or _LIST_LIMIT), 1), match.group(2)) if match else (_LIST_LIMIT, None)
     try:
-        keys = dude.list_absolute_keys()
+        # one more than asked for tells whether there is a next page
+        keys = dude.list_absolute_keys(user_name, limit + 1, after)
         if keys:
-            res = "\n".join(["Found these..", ] + keys)
+            res = "\n".join(["Found these..", ] + keys[:limit])
+            if len(keys) > limit:
+                res += "\nMore: /list -n %d -p %s" % (limit, keys[limit - 1])
+        elif after is not None:
+            res = "no more tags after %s" % after
         else:
             res = "Tell me few secrets first."
     except Exception as e:
@@ -85,4 +242,8 @@ def _list(channel_id, channel_name, user_id, user_name, command, text, response_
     return res
 
 
-run(host=_SERVER_HOST, port=int(_SERVER_PORT))
+_handlers = {"/keep": _keep, "/tell": _tell, "/list": _list}
+
+if __name__ == '__main__':
+    servers = {"threaded": ThreadedServer, "prefork": PreforkServer}
+    run(host=_SERVER_HOST, port=int(_SERVER_PORT), server=servers.get(_SERVER, _SERVER))
@@ -1,21 +1,58 @@
+import base64
+import heapq
+import itertools
+import json
 import os
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
 
 import sys
 
+from src import metrics, stores
+from src.cache import QueryCache, WriteMarks
+from src.vocabulary import Vocabulary
+
+_ns = os.environ.get("DUDE_NAMESPACE", "default")
 _storage = os.environ.get("DUDE_STORE", "file")
-if _storage.lower() == "file":
-    print("[Using file as storage]")
-    from src.stores import file as store
-elif _storage.lower() == "mongodb":
-    print("[Using mongodb as storage]")
-    from src.stores import mongodb as store
-else:
-    print("Storage %s not supported" % _storage)
-    sys.exit(1)
+_store = None  # loaded on first use, see _backend
+_stemmer = None  # loaded on first use, see _stem_word
+_stem_cache_size = int(os.environ.get("DUDE_STEM_CACHE_SIZE", 10000))
+# results of recent queries; writes from other processes show up once cached results expire
+_cache = QueryCache(int(os.environ.get("DUDE_CACHE_SIZE", 1024)), float(os.environ.get("DUDE_CACHE_TTL", 60)))
+# queries paged through (see page) matching more secrets than this are streamed from the store without being cached
+_cache_max_results = int(os.environ.get("DUDE_CACHE_MAX_RESULTS", 1000))
+# marks of writes shared with the other processes serving the same store (e.g. the slack server's workers), so that
+# their writes drop this process's cached results and vocabulary right away rather than once they expire
+_marks = WriteMarks(os.environ["DUDE_WRITE_MARKS"]) if os.environ.get("DUDE_WRITE_MARKS") else None
+# whether what is cached about a user is checked against the store's version of their secrets (see _sync), set by
+# long-lived processes which other processes writing to the store may not mark their writes for, e.g. src.daemon
+_check_versions = False
+# username -> version of their secrets in store when last checked
+_versions = {}
+# whether secrets' content is indexed for search as they are kept
+_content_index = os.environ.get("DUDE_CONTENT_INDEX", "").lower() in ("1", "true", "yes", "on")
+# words of secrets' content: letters and digits, joined by dots, dashes and quotes (e.g. 10.0.3.17, mid-day)
+_WORD_RE = re.compile(r"\w+(?:['.\-]\w+)*")
+# keys of every user's secrets, for completion; reloaded from the store after DUDE_VOCABULARY_TTL seconds
+_vocabulary = Vocabulary(lambda username: _backend().get_terms(username),
+                         float(os.environ.get("DUDE_VOCABULARY_TTL", 300)))
 
-from nltk.stem.snowball import SnowballStemmer
+# match strength of a query word hitting a secret's key as a whole, one of its words, or one of their stems
+_EXACT_MATCH, _DERIVED_MATCH, _STEMMED_MATCH = 1.0, 0.75, 0.5
+# weights of match strength, fraction of the key's words matched and recency in a secret's score
+_STRENGTH_WEIGHT, _COVERAGE_WEIGHT, _RECENCY_WEIGHT = 0.6, 0.3, 0.1
+# misspelled query words are matched to keys within this many edits when nothing matches them as typed, 0 never does
+_typo_distance = int(os.environ.get("DUDE_TYPO_DISTANCE", 0))
+# shorter words are too close to too many others to be corrected
+_TYPO_MIN_LENGTH = 4
+# age in days at which a secret's recency is halved
+_recency_half_life = float(os.environ.get("DUDE_RECENCY_HALF_LIFE", 30))
+# page tokens carry the time pages are scored at, in seconds since then
+_EPOCH = datetime(1970, 1, 1)
 
 
+@metrics.timed("dude_da_seconds", op="put")
 def put(key, secret, username):
     """
     Store a secret and associate it with derived key words.
@@ -30,10 +67,40 @@ def put(key, secret, username):
     key = key.lower()
     keys = _explode(key)
     derived_keys, stemmed_keys = list(zip(*keys)) if keys else ([], [])
-    secret_id = store.put(secret, key, derived_keys, stemmed_keys, username)
-    return set([key] + list(derived_keys) + list(stemmed_keys)), secret_id
+    content_keys = tokenize(secret) if _content_index else None
+    with metrics.timer("dude_store_seconds", store=_storage, op="put"):
+        secret_id = _backend().put(secret, key, derived_keys, stemmed_keys, username, content_keys=content_keys)
+    _invalidate(username)
+    all_keys = set([key] + list(derived_keys) + list(stemmed_keys))
+    _vocabulary.add(username, secret_id, all_keys)
+    return all_keys, secret_id
+
 
+@metrics.timed("dude_da_seconds", op="put_many")
+def put_many(items):
+    """
+    Store a batch of secrets, like put does for one, in a single write to the store.
+
+    :param items: iterable of tuples containing key, secret and user name
+    :return: a list of tuples containing derived key words and the secret's ID assigned in database, in input order
+    """
+    items = [(key.lower(), secret, username) for key, secret, username in items]
+    records, all_keys = [], []
+    for (key, secret, username), keys in zip(items, explode_many([key for key, _secret, _username in items])):
+        derived_keys, stemmed_keys = list(zip(*keys)) if keys else ([], [])
+        records.append((secret, key, derived_keys, stemmed_keys, username))
+        all_keys.append(set([key] + list(derived_keys) + list(stemmed_keys)))
+    with metrics.timer("dude_store_seconds", store=_storage, op="put_many"):
+        content_keys = [tokenize(secret) for _key, secret, _username in items] if _content_index else None
+        secret_ids = _backend().put_many(records, content_keys=content_keys) if records else []
+    for username in {username for _key, _secret, username in items}:
+        _invalidate(username)
+    for keys, secret_id, (_key, _secret, username) in zip(all_keys, secret_ids, items):
+        _vocabulary.add(username, secret_id, keys)
+    return list(zip(all_keys, secret_ids))
 
+
+@metrics.timed("dude_da_seconds", op="remove")
 def remove(secret_id, username):
     """
     Forget a secret.
@@ -41,31 +108,425 @@ def remove(secret_id, username):
     :param secret_id: secret's ID
     :param username: user name
     """
-    store.remove(secret_id, username)
+    with metrics.timer("dude_store_seconds", store=_storage, op="remove"):
+        _backend().remove(secret_id, username)
+    _invalidate(username)
+    _vocabulary.remove(username, secret_id)
+
+
+@metrics.timed("dude_da_seconds", op="remove_many")
+def remove_many(secret_ids, username):
+    """
+    Forget a batch of secrets of a user, in a single write to the store.
+
+    :param secret_ids: secrets' IDs
+    :param username: user name
+    """
+    secret_ids = list(secret_ids)
+    with metrics.timer("dude_store_seconds", store=_storage, op="remove_many"):
+        _backend().remove_many(secret_ids, username)
+    _invalidate(username)
+    for secret_id in secret_ids:
+        _vocabulary.remove(username, secret_id)
+
+
+@metrics.timed("dude_da_seconds", op="remove_where")
+def remove_where(username, key=None, older_than=None):
+    """
+    Forget the secrets of a user matching conditions, e.g. for retention cleanups - all of them if none is given.
+
+    :param username: user name
+    :param key: only forget the secrets kept under this key, as provided by end-user
+    :param older_than: only forget the secrets kept before this datetime (UTC), or longer ago than this timedelta
+    :return: number of secrets forgotten
+    """
+    if isinstance(older_than, timedelta):
+        older_than = datetime.utcnow() - older_than
+    with metrics.timer("dude_store_seconds", store=_storage, op="remove_where"):
+        removed = _backend().remove_where(username, key.lower() if key is not None else None, older_than)
+    _invalidate(username)
+    _vocabulary.invalidate(username)
+    return removed
 
 
-def get(key, username):
+@metrics.timed("dude_da_seconds", op="get")
+def get(key, username, match_all=True):
     """
     Get a collection of secrets associated with the key.
+    The key is a tag, or a list of tags. Tags are exploded like put does, a secret matches when it has all the words
+    (or their stems) of all the tags - or any of them if match_all is False. When nothing matches, misspelled words
+    are looked up again as the keys closest to them, if DUDE_TYPO_DISTANCE allows.
 
     :param username: user name
     :param key: the key
+    :param match_all: whether secrets must match all the words, or any of them
     :return: a list of tuples containing the following: secret ID, original key, secret content, timestamp
     """
-    key = key.lower()
-    return store.get(key, username)
+    return _lookup(_query(key), username, match_all)[1]
+
+
+def iter_get(key, username, match_all=True):
+    """
+    Get the secrets associated with the key (see get) one at a time, as the store reads them, bypassing the cache.
+
+    :param key: the key
+    :param username: user name
+    :param match_all: whether secrets must match all the words, or any of them
+    :return: generator of tuples containing the following: secret ID, original key, secret content, timestamp
+    """
+    return _backend().iter_get(_query(key), username, match_all)
+
+
+@metrics.timed("dude_da_seconds", op="page")
+def page(key, username, limit, token=None, match_all=True):
+    """
+    Get a page of the secrets associated with the key, best matches first (see rank). Matches come from the result
+    cache, or are streamed from the store and only the best limit ones after those of previous pages are kept, so
+    memory doesn't grow with the number of matches. Streamed matches are cached unless there are too many of them,
+    see _iter_cached.
+
+    :param key: the key
+    :param username: user name
+    :param limit: number of secrets per page, at least 1
+    :param token: continuation token returned with the previous page, None for the first page
+    :param match_all: whether secrets must match all the words, or any of them
+    :return: a tuple containing the list of tuples containing score, secret ID, original key, secret content and
+    timestamp, and the token of the next page (None on the last page)
+    :raise ValueError: if limit is less than 1, or the token is invalid
+    """
+    if limit < 1:
+        raise ValueError("Invalid page size: %s" % limit)
+    if token is None:
+        now, after = datetime.utcnow(), None
+    else:
+        now, after = _decode_token(token)
+    clauses = _query(key)
+    secrets = _iter_cached(clauses, username, match_all)
+    if _typo_distance > 0:
+        first = next(secrets, None)
+        if first is None:
+            clauses = _correct(clauses, username)
+            secrets = _iter_cached(clauses, username, match_all)
+        else:
+            secrets = itertools.chain([first], secrets)
+    # a secret's position is its score, ties broken by ID; "after" is the position of the last one of the previous page
+    scored = ((_score(clauses, secret, now), secret[0]) + tuple(secret[1:]) for secret in secrets)
+    if after is not None:
+        scored = (s for s in scored if (s[0], s[1]) < after)
+    results = heapq.nlargest(limit + 1, scored, key=lambda s: (s[0], s[1]))
+    next_token = _encode_token(now, results[limit - 1][:2]) if len(results) > limit else None
+    return results[:limit], next_token
+
+
+def _encode_token(now, after):
+    state = json.dumps([(now - _EPOCH).total_seconds(), after[0], after[1]])
+    return base64.urlsafe_b64encode(state.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_token(token):
+    try:
+        now, score, secret_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8"))
+        return _EPOCH + timedelta(seconds=now), (score, secret_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid page token: %s" % token)
+
+
+@metrics.timed("dude_da_seconds", op="rank")
+def rank(key, username, limit=None, match_all=True):
+    """
+    Get the secrets associated with the key (see get), best matches first.
+    Secrets score higher for matching the key as a whole rather than its words or their stems, for having more of their
+    key's words matched and for being recent. Only the top scores are kept while going through the matches.
+
+    :param key: the key
+    :param username: user name
+    :param limit: maximum number of secrets to return, all of them if None
+    :param match_all: whether secrets must match all the words, or any of them
+    :return: a list of tuples containing the following: score, secret ID, original key, secret content, timestamp
+    """
+    clauses, secrets = _lookup(_query(key), username, match_all)
+    now = datetime.utcnow()
+    scored = ((_score(clauses, secret, now),) + tuple(secret) for secret in secrets)
+    if limit is None:
+        return sorted(scored, key=lambda s: s[0], reverse=True)
+    return heapq.nlargest(limit, scored, key=lambda s: s[0])
+
+
+def cache_stats():
+    """
+    Get the counters of the query result cache.
+
+    :return: a dict containing hits, misses, hit_rate, size and max_size
+    """
+    return _cache.stats()
+
+
+def _lookup(clauses, username, match_all):
+    """
+    Query the store (see _get), again with misspelled words corrected if nothing matched and typo tolerance is on.
+
+    :param clauses: query clauses, see _query
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: a tuple containing the clauses finally queried and the list of secrets they matched
+    """
+    secrets = _get(clauses, username, match_all)
+    if not secrets and _typo_distance > 0:
+        corrected = _correct(clauses, username)
+        if corrected != clauses:
+            metrics.inc("dude_typo_corrections_total")
+            clauses, secrets = corrected, _get(corrected, username, match_all)
+    return clauses, secrets
+
+
+def _correct(clauses, username):
+    """
+    Replaces the clauses none of whose keys the user has by the user's keys within _typo_distance edits of them.
+
+    :param clauses: query clauses, see _query
+    :param username: user name
+    :return: list of sets of alternative keys
+    """
+    _sync(username)
+    corrected = []
+    for clause in clauses:
+        similar = set()
+        if not any((username, key) in _vocabulary for key in clause):
+            for key in clause:
+                if len(key) >= _TYPO_MIN_LENGTH:
+                    similar.update(_vocabulary.similar(username, key, _typo_distance))
+        corrected.append(similar or clause)
+    return corrected
+
+
+def _get(clauses, username, match_all):
+    """
+    Query the store through the result cache.
+
+    :param clauses: query clauses, see _query
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: a list of tuples containing the following: secret ID, original key, secret content, timestamp
+    """
+    _sync(username)
+    cache_key = _cache_key(clauses, username, match_all)
+    generation = _cache.generation(username)
+    secrets = _cache.get(cache_key)
+    if secrets is None:
+        metrics.inc("dude_cache_misses_total")
+        with metrics.timer("dude_store_seconds", store=_storage, op="get"):
+            secrets = tuple(_backend().get(clauses, username, match_all))
+        _cache.put(cache_key, username, secrets, generation)
+    else:
+        metrics.inc("dude_cache_hits_total")
+    return list(secrets)
+
+
+def _iter_cached(clauses, username, match_all):
+    """
+    Query the store through the result cache, streaming the secrets when they aren't cached. Streamed secrets are
+    cached once read to the end, unless they are more than _cache_max_results.
+
+    :param clauses: query clauses, see _query
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: iterator of tuples containing the following: secret ID, original key, secret content, timestamp
+    """
+    _sync(username)
+    cache_key = _cache_key(clauses, username, match_all)
+    generation = _cache.generation(username)
+    secrets = _cache.get(cache_key)
+    if secrets is not None:
+        metrics.inc("dude_cache_hits_total")
+        return iter(secrets)
+    metrics.inc("dude_cache_misses_total")
+    return _caching(_backend().iter_get(clauses, username, match_all), cache_key, username, generation)
+
+
+def _caching(secrets, cache_key, username, generation):
+    kept = []
+    for secret in secrets:
+        if kept is not None:
+            kept.append(secret)
+            if len(kept) > _cache_max_results:
+                kept = None
+        yield secret
+    if kept is not None:
+        _cache.put(cache_key, username, tuple(kept), generation)
+
+
+def _cache_key(clauses, username, match_all):
+    return _ns, _storage, username, tuple(sorted(tuple(sorted(clause)) for clause in clauses)), match_all
+
+
+def _score(clauses, secret, now):
+    """
+    Scores a secret against query clauses, between 0 and 1.
+
+    :param clauses: query clauses, see _query
+    :param secret: tuple containing secret ID, original key, secret content, timestamp
+    :param now: current UTC time
+    :return: the score
+    """
+    _sid, key, _secret, in_ts = secret
+    keys = _explode(key)
+    words = {word for word, _stem in keys}
+    stems = {stem for _word, stem in keys}
+    strength = 0.0
+    for clause in clauses:
+        if key in clause:
+            strength += _EXACT_MATCH
+        elif clause & words:
+            strength += _DERIVED_MATCH
+        elif clause & stems:
+            strength += _STEMMED_MATCH
+    strength /= len(clauses) or 1
+    if keys:
+        query_keys = set().union(*clauses)
+        coverage = sum(1 for word, stem in keys if word in query_keys or stem in query_keys) / len(keys)
+    else:
+        coverage = 1.0 if strength else 0.0
+    age = max((now - in_ts).total_seconds(), 0) / 86400
+    recency = 0.5 ** (age / _recency_half_life)
+    return _STRENGTH_WEIGHT * strength + _COVERAGE_WEIGHT * coverage + _RECENCY_WEIGHT * recency
 
 
-def list_absolute_keys(username):
+@metrics.timed("dude_da_seconds", op="list_absolute_keys")
+def list_absolute_keys(username, limit=None, after=None):
     """
     Get a collection of keys (tags) that have a score of 1 - essentially keys input by end-user while storing secrets.
 
     :param username: user name
-    :return: a list of absolute keys
+    :param limit: maximum number of keys to return, all of them if None
+    :param after: only return the keys sorting after this one - the last key of the previous page
+    :return: a sorted list of distinct absolute keys
+    """
+    with metrics.timer("dude_store_seconds", store=_storage, op="get_keys"):
+        return _backend().get_keys(username, after=after, limit=limit)
+
+
+@metrics.timed("dude_da_seconds", op="search")
+def search(text, username, match_all=True):
+    """
+    Get the secrets whose content has the words of a text, or their stems - or any of them if match_all is False.
+    Only secrets kept while DUDE_CONTENT_INDEX was set, or indexed since by reindex_content, are searched.
+
+    :param text: words to look for
+    :param username: user name
+    :param match_all: whether secrets must have all the words, or any of them
+    :return: a list of tuples containing the following: secret ID, original key, secret content, timestamp
+    """
+    clauses = [{word, stem} for word, stem in _explode(" ".join(_words(text)))]
+    if not clauses:
+        return []
+    with metrics.timer("dude_store_seconds", store=_storage, op="search"):
+        return _backend().search(clauses, username, match_all)
+
+
+def reindex_content():
+    """
+    Index the content of every stored secret for search.
+
+    :return: number of secrets indexed
+    """
+    return _backend().reindex_content(tokenize)
+
+
+def tokenize(text):
+    """
+    Derives the content keys of a secret: the words of its content (see _explode) and their stems.
+
+    :param text: secret content
+    :return: set of keys
+    """
+    return {key for keys in _explode(" ".join(_words(text))) for key in keys}
+
+
+def _words(text):
+    return _WORD_RE.findall(text)
+
+
+@metrics.timed("dude_da_seconds", op="complete")
+def complete(prefix, username, limit=None):
+    """
+    Get the keys starting with a prefix, among the tags, derived words and stems of a user's secrets.
+
+    :param prefix: beginning of a tag
+    :param username: user name
+    :param limit: maximum number of keys to return, all of them if None
+    :return: sorted list of keys
+    """
+    _sync(username)
+    return _vocabulary.complete(username, prefix.lower().strip(), limit)
+
+
+def _invalidate(username):
+    """
+    Drop the cached results of a user after a write, in this process and, through the write marks, in the others.
+
+    :param username: user name
+    """
+    _cache.invalidate(username)
+    if _marks is not None:
+        _marks.mark(username)
+
+
+def _sync(username):
+    """
+    Drop what this process cached about a user if another one wrote their secrets since, see _marks and
+    _check_versions.
+
+    :param username: user name
+    """
+    if _marks is not None and _marks.changed(username):
+        _cache.invalidate(username)
+        _vocabulary.invalidate(username)
+    if _check_versions:
+        version = _backend().version(username)
+        # stores which can't tell have no version, nothing about the user stays cached then
+        if version is None or _versions.get(username) != version:
+            _cache.invalidate(username)
+            _vocabulary.invalidate(username)
+            _versions[username] = version
+
+
+def _backend():
+    """
+    Get the configured store, importing it on first use.
+
+    :return: the store module
     """
-    return store.get_keys(username)
+    global _store
+    if _store is None:
+        try:
+            _store = stores.load(_storage)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print("[Using %s as storage]" % _storage.lower())
+    return _store
 
 
+def _query(key):
+    """
+    Turns tags into store query clauses: one clause per derived word, satisfied by the tag itself, the word or its stem.
+    A tag made of stop words only is looked up as is.
+
+    :param key: a tag or a list of tags
+    :return: list of sets of alternative keys
+    """
+    tags = [key] if isinstance(key, str) else list(key)
+    clauses = []
+    for tag, keys in zip(tags, explode_many(tags)):
+        tag = tag.lower()
+        if keys:
+            clauses.extend({tag, word, stem} for word, stem in keys)
+        else:
+            clauses.append({tag})
+    return clauses
+
+
+@metrics.timed("dude_da_seconds", op="explode")
 def _explode(key):
     """
     Derives all possible keywords from input key. All the stop words are excluded.
@@ -73,15 +534,32 @@ def _explode(key):
     :param key: key as provided by end-user
     :return: list of tuples containing original and stemmed words
     """
-    key = key.lower()
-    words = set(key.split())
     derived_keys = set()
-    for word in words:
-        ret = _stem(word)
-        for ok, k in ret:
-            derived_keys.add((ok, k))
-    keys = list(derived_keys)
-    return keys
+    for word in set(key.lower().split()):
+        derived_keys.update(_stem(word))
+    return list(derived_keys)
+
+
+@metrics.timed("dude_da_seconds", op="explode_many")
+def explode_many(keys):
+    """
+    Derives keywords from a batch of keys, like _explode does for one. Every distinct word of the batch is stemmed once.
+
+    :param keys: list of keys as provided by end-user
+    :return: list containing, for every key in order, the list of tuples containing original and stemmed words
+    """
+    words = [set(key.lower().split()) for key in keys]
+    stems = {word: _stem(word) for word in set().union(*words)}
+    return [list(set().union(*[stems[word] for word in key_words])) for key_words in words]
+
+
+def stem_cache_info():
+    """
+    Get the hit and miss counters of the stem cache.
+
+    :return: a named tuple containing hits, misses, maxsize and currsize
+    """
+    return _stem_word.cache_info()
 
 
 # TODO externalize stop words
@@ -144,8 +622,16 @@ def _stem(word):
     word = word.replace("'", "").replace("?", "")
     in_word_set = {word}.union(word.split("-"))
     out_word_set = set()
-    stemmer = SnowballStemmer("english")
     for word in in_word_set:
         if word not in _stop_words:
-            out_word_set.add((word, stemmer.stem(word)))
+            out_word_set.add((word, _stem_word(word)))
     return out_word_set
+
+
+@lru_cache(maxsize=_stem_cache_size)
+def _stem_word(word):
+    global _stemmer
+    if _stemmer is None:
+        from nltk.stem.snowball import SnowballStemmer
+        _stemmer = SnowballStemmer("english")
+    return _stemmer.stem(word)
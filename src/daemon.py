@@ -0,0 +1,258 @@
+"""
+Background process keeping src.dude warm for shell_dude: the store, its indexes, the query cache and the stemmer stay
+loaded between calls, which are served over a Unix domain socket.
+
+    $ python -m src.daemon [serve|stop]
+
+The protocol is one JSON object per line each way. A request names an operation of src.dude along with its
+arguments, {"op": "tell", "args": ["ssh", "atif"], "kwargs": {"limit": 5}}, and is answered with {"result": ...} or
+{"error": "..."}. Timestamps travel as {"$datetime": "<ISO 8601>"}.
+
+This module only imports what a client needs until it serves, so that clients calling through it start fast.
+"""
+import datetime
+import errno
+import getpass
+import hashlib
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where the daemon can't be kept to a single instance
+    fcntl = None
+
+# seconds without requests after which the daemon exits
+_idle = float(os.environ.get("DUDE_DAEMON_IDLE", 900))
+# seconds a client waits for a daemon it started to listen
+_START_TIMEOUT = 5
+# operations of src.dude served
+_OPS = ("keep", "tell", "tell_page", "list_absolute_keys", "complete", "search")
+
+
+class Unavailable(Exception):
+    """
+    No daemon could be reached, callers fall back to calling src.dude in process.
+    """
+
+
+def socket_path():
+    """
+    Path of the socket of the current user's daemon. Every configuration (DUDE_* environment variables) gets its own
+    daemon, so that a daemon never serves a store other than the one the client is configured for.
+
+    :return: DUDE_DAEMON_SOCKET if set, else a path in a directory only the user can access
+    :raise Unavailable: if that directory isn't the user's own, private one
+    """
+    path = os.environ.get("DUDE_DAEMON_SOCKET")
+    if path:
+        return path
+    config = sorted((k, v) for k, v in os.environ.items() if k.startswith("DUDE_") and not k.startswith("DUDE_DAEMON"))
+    fingerprint = hashlib.sha1(json.dumps([os.getcwd(), config]).encode("utf-8")).hexdigest()[:12]
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime:
+        import tempfile
+        runtime = tempfile.gettempdir()
+    directory = os.path.join(runtime, "dude-%s" % getpass.getuser())
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        st = os.lstat(directory)
+    except OSError as e:
+        raise Unavailable(str(e))
+    # a directory created first by another local user would let them serve the socket, and be sent every secret kept;
+    # its owner can't be told without os.getuid, e.g. on Windows
+    if (not hasattr(os, "getuid") or not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+            or stat.S_IMODE(st.st_mode) != 0o700):
+        raise Unavailable("%s is not a directory only %s can access" % (directory, getpass.getuser()))
+    return os.path.join(directory, "%s.sock" % fingerprint)
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError("%s is not serializable" % type(value).__name__)
+
+
+def _hook(obj):
+    if len(obj) == 1 and "$datetime" in obj:
+        return datetime.datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+def _encode(message):
+    return (json.dumps(message, default=_default) + "\n").encode("utf-8")
+
+
+def _decode(line):
+    return json.loads(line.decode("utf-8"), object_hook=_hook)
+
+
+def request(op, *args, path=None, **kwargs):
+    """
+    Call an operation of src.dude in the daemon.
+
+    :param op: name of the operation, one of _OPS or "shutdown"
+    :param path: socket path, socket_path() if None
+    :return: the result of the operation, with tuples turned into lists
+    :raise Unavailable: if no daemon listens
+    :raise RuntimeError: if the operation failed in the daemon
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path or socket_path())
+            sock.sendall(_encode({"op": op, "args": args, "kwargs": kwargs}))
+            with sock.makefile("rb") as f:
+                line = f.readline()
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        raise Unavailable(str(e))
+    if not line:
+        raise Unavailable("daemon closed the connection")
+    response = _decode(line)
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response["result"]
+
+
+def call(op, *args, **kwargs):
+    """
+    Call an operation of src.dude in the daemon, starting it if it isn't running.
+
+    :param op: name of the operation, one of _OPS
+    :return: the result of the operation, with tuples turned into lists
+    :raise Unavailable: if the daemon could not be started
+    :raise RuntimeError: if the operation failed in the daemon
+    """
+    path = socket_path()
+    try:
+        return request(op, *args, path=path, **kwargs)
+    except Unavailable:
+        pass
+    start(path)
+    deadline = time.monotonic() + _START_TIMEOUT
+    while True:
+        try:
+            return request(op, *args, path=path, **kwargs)
+        except Unavailable:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.02)
+
+
+def start(path):
+    """
+    Start a daemon in the background, detached from the terminal. It exits on its own if another one already serves
+    the path.
+
+    :param path: socket path
+    """
+    import subprocess
+
+    with open(os.devnull, "r+b") as devnull:
+        subprocess.Popen([sys.executable, "-m", "src.daemon", "serve"], env=dict(os.environ, DUDE_DAEMON_SOCKET=path),
+                         cwd=os.getcwd(), stdin=devnull, stdout=devnull, stderr=devnull, start_new_session=True)
+
+
+def _handle(dude, message):
+    op = message.get("op")
+    if op not in _OPS:
+        return {"error": "Unknown operation %s" % op}
+    try:
+        return {"result": getattr(dude, op)(*message.get("args", ()), **message.get("kwargs", {}))}
+    except Exception as e:
+        return {"error": "%s: %s" % (type(e).__name__, e)}
+
+
+def serve(path=None):
+    """
+    Serve src.dude on a Unix domain socket until stopped, or idle for DUDE_DAEMON_IDLE seconds.
+    Other processes writing to the store (the slack server, shell_dude running in process, dude_migrate) drop what the
+    daemon cached through their write marks if DUDE_WRITE_MARKS is set; otherwise every call checks the store's version
+    of the user's secrets, see da._check_versions.
+
+    :param path: socket path, socket_path() if None
+    :return: False if another daemon already serves the path
+    """
+    import socketserver
+
+    path = path or socket_path()
+    lock = open(path + ".lock", "w")
+    try:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        lock.close()
+        return False
+    from src import da, dude
+
+    check_versions = da._check_versions
+    if da._marks is None:  # nothing would tell the daemon about writes from other processes
+        da._check_versions = True
+
+    last_request = [time.monotonic()]
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                last_request[0] = time.monotonic()
+                try:
+                    message = _decode(line)
+                except ValueError as e:
+                    response = {"error": "Bad request: %s" % e}
+                else:
+                    if message.get("op") == "shutdown":
+                        self.wfile.write(_encode({"result": True}))
+                        threading.Thread(target=self.server.shutdown).start()
+                        return
+                    response = _handle(dude, message)
+                self.wfile.write(_encode(response))
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    def watch():
+        while time.monotonic() - last_request[0] < _idle:
+            time.sleep(min(_idle, 1))
+        server.shutdown()
+
+    if os.path.exists(path):
+        os.remove(path)  # left over by a daemon that didn't exit cleanly, we hold the lock
+    old_umask = os.umask(0o177)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+    try:
+        if _idle > 0:
+            threading.Thread(target=watch, daemon=True).start()
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+        lock.close()
+        da._check_versions = check_versions
+    return True
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else "serve"
+    if command == "serve":
+        try:
+            sys.exit(0 if serve() else 1)
+        except Unavailable as e:
+            sys.exit("dude daemon can't serve: %s" % e)
+    elif command == "stop":
+        try:
+            request("shutdown")
+        except Unavailable:
+            print("dude daemon not running")
+    else:
+        sys.exit("usage: python -m src.daemon [serve|stop]")
@@ -5,10 +5,26 @@ def keep(secret, key, username):
     return da.put(key, secret, username)
 
 
-def tell(tag, username):
-    secrets = da.get(tag, username)
+def keep_many(items):
+    return da.put_many(items)
+
+
+def tell(tag, username, limit=None, match_all=True):
+    secrets = da.rank(tag, username, limit, match_all)
     return secrets
 
 
-def list_absolute_keys(username):
-    return da.list_absolute_keys(username)
+def tell_page(tag, username, limit, token=None, match_all=True):
+    return da.page(tag, username, limit, token, match_all)
+
+
+def list_absolute_keys(username, limit=None, after=None):
+    return da.list_absolute_keys(username, limit, after)
+
+
+def complete(prefix, username, limit=None):
+    return da.complete(prefix, username, limit)
+
+
+def search(text, username, match_all=True):
+    return da.search(text, username, match_all)
@@ -0,0 +1,174 @@
+import bisect
+import functools
+import os
+import threading
+import time
+
+# off unless asked for, every hook is then a flag check
+_enabled = os.environ.get("DUDE_METRICS", "").lower() in ("1", "true", "yes", "on")
+# upper bounds in seconds of the latency histogram buckets
+_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_lock = threading.Lock()
+
+
+class _Timer:
+    """
+    Context manager observing the time spent in its block into a latency histogram.
+    """
+
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _observe(self.name, self.labels, time.perf_counter() - self.start)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_timer = _NoTimer()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(on=True):
+    """
+    Turn metrics collection on or off, collected values are kept.
+
+    :param on: whether to collect
+    """
+    global _enabled
+    _enabled = on
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def inc(name, value=1, **labels):
+    """
+    Add to a counter.
+
+    :param name: counter name, e.g. dude_records_scanned_total
+    :param value: amount to add
+    :param labels: label names and values
+    """
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """
+    Record a duration in a latency histogram.
+
+    :param name: histogram name, e.g. dude_da_seconds
+    :param seconds: duration
+    :param labels: label names and values
+    """
+    if _enabled:
+        _observe(name, tuple(sorted(labels.items())), seconds)
+
+
+def _observe(name, labels, seconds):
+    key = (name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(_BUCKETS) + 3)
+        histogram[bisect.bisect_left(_BUCKETS, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+
+def timer(name, **labels):
+    """
+    Time a block of code into a latency histogram: with metrics.timer("dude_store_seconds", op="get"): ...
+
+    :param name: histogram name
+    :param labels: label names and values
+    :return: a context manager, doing nothing while metrics are off
+    """
+    if not _enabled:
+        return _no_timer
+    return _Timer(name, tuple(sorted(labels.items())))
+
+
+def timed(name, **labels):
+    """
+    Decorator timing every call of a function into a latency histogram.
+
+    :param name: histogram name
+    :param labels: label names and values
+    """
+    labels = tuple(sorted(labels.items()))
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(name, labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render():
+    """
+    Collected metrics in the Prometheus text exposition format.
+
+    :return: the metrics as text
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, list(histogram)) for key, histogram in _histograms.items())
+    lines, typed = [], set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            typed.add(name)
+            lines.append("# TYPE %s counter" % name)
+        lines.append("%s%s %s" % (name, _labels(labels), value))
+    for (name, labels), histogram in histograms:
+        if name not in typed:
+            typed.add(name)
+            lines.append("# TYPE %s histogram" % name)
+        cumulative = 0
+        for bound, count in zip(_BUCKETS + ("+Inf",), histogram):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (name, _labels(labels + (("le", str(bound)),)), cumulative))
+        lines.append("%s_sum%s %.6f" % (name, _labels(labels), histogram[-2]))
+        lines.append("%s_count%s %d" % (name, _labels(labels), histogram[-1]))
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
@@ -0,0 +1,111 @@
+import itertools
+import json
+import sys
+import time
+from datetime import datetime
+
+# records between progress reports
+_REPORT_EVERY = 100000
+
+
+class Progress:
+    """
+    Counts records going through an export or import and reports throughput to stderr.
+    """
+
+    def __init__(self, action, out=sys.stderr):
+        self.action = action
+        self.out = out
+        self.count = 0
+        self.reported = None
+        self.start = time.perf_counter()
+
+    def add(self, count):
+        reported = self.count // _REPORT_EVERY
+        self.count += count
+        if self.count // _REPORT_EVERY > reported:
+            self.report()
+
+    def done(self):
+        if self.reported != self.count:
+            self.report()
+
+    def report(self):
+        self.reported = self.count
+        elapsed = time.perf_counter() - self.start
+        self.out.write("%s %d secrets in %.1fs (%.0f/s)\n" % (self.action, self.count, elapsed,
+                                                             self.count / elapsed if elapsed else 0))
+
+
+def dump(record):
+    """
+    Serialize a secret as a line of the export format: a JSON object holding the fields of the record.
+
+    :param record: dict as yielded by a store's iter_records
+    :return: the line, without line feed
+    """
+    return json.dumps(dict(record, in_ts=record["in_ts"].isoformat()), ensure_ascii=False, sort_keys=True)
+
+
+def parse(line):
+    """
+    Deserialize a line of the export format, see dump.
+
+    :param line: the line
+    :return: dict as taken by a store's restore_many
+    """
+    record = json.loads(line)
+    record["in_ts"] = datetime.fromisoformat(record["in_ts"])
+    return record
+
+
+def export_records(store, out, progress=None):
+    """
+    Write every secret kept in a store to a file in the export format, one per line.
+
+    :param store: store module
+    :param out: text file to write to
+    :param progress: Progress to report to
+    :return: number of secrets written
+    """
+    count = 0
+    for record in store.iter_records():
+        out.write(dump(record) + "\n")
+        count += 1
+        if progress is not None:
+            progress.add(1)
+    return count
+
+
+def restore(store, records, batch_size=1000, tokenize=None, progress=None):
+    """
+    Put secrets in a store in batches, keeping their IDs and timestamps. Only one batch is held in memory at a time.
+
+    :param store: store module
+    :param records: iterable of dicts as yielded by a store's iter_records
+    :param batch_size: number of secrets per write
+    :param tokenize: function deriving the content keys of a secret's content to index it for search, None not to
+    :param progress: Progress to report to
+    :return: number of secrets put
+    """
+    records = iter(records)
+    count = 0
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return count
+        content_keys = [tokenize(record["secret"]) for record in batch] if tokenize else None
+        count += store.restore_many(batch, content_keys=content_keys)
+        if progress is not None:
+            progress.add(len(batch))
+
+
+def import_records(store, lines, batch_size=1000, tokenize=None, progress=None):
+    """
+    Put the secrets of a file in the export format in a store, see restore.
+
+    :param store: store module
+    :param lines: iterable of lines in the export format
+    :return: number of secrets put
+    """
+    return restore(store, (parse(line) for line in lines if line.strip()), batch_size, tokenize, progress)
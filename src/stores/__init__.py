@@ -0,0 +1,46 @@
+import importlib
+
+# storage name -> module implementing put, put_many, get, iter_get, search, get_keys, get_terms, remove, remove_many,
+# remove_where, remove_all, iter_records, restore_many and reindex_content
+_backends = {
+    "file": "src.stores.file",
+    "mongodb": "src.stores.mongodb",
+    "sqlite": "src.stores.sqlite",
+}
+
+
+def clauses(key):
+    """
+    Normalize a store query. A query is either a single key, or a list of clauses where every clause is a key or an
+    iterable of alternative keys; a clause is satisfied by a secret having any of its keys.
+
+    :param key: the query
+    :return: a list of sets of lower cased alternative keys
+    """
+    if isinstance(key, str):
+        return [{key.lower()}]
+    return [{clause.lower()} if isinstance(clause, str) else {k.lower() for k in clause} for clause in key]
+
+
+def register(name, module_name):
+    """
+    Make a storage backend available under a name.
+
+    :param name: storage name, as set in DUDE_STORE
+    :param module_name: dotted path of the module implementing the store
+    """
+    _backends[name.lower()] = module_name
+
+
+def load(name):
+    """
+    Import a storage backend. Backends are only imported when asked for, so unused ones cost nothing.
+
+    :param name: storage name, as set in DUDE_STORE
+    :return: the store module
+    """
+    try:
+        module_name = _backends[name.lower()]
+    except KeyError:
+        raise ValueError("Storage %s not supported" % name)
+    return importlib.import_module(module_name)
@@ -1,19 +1,112 @@
+import array
+import bisect
 import csv
+import hashlib
+import mmap
 import os
+import queue
 import re
+import struct
+import threading
 import uuid
-from datetime import datetime
+import zlib
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # no advisory locking, e.g. on Windows
+    fcntl = None
+
+from src import metrics
+from src.stores import clauses
 
 _ns = os.environ.get('DUDE_NAMESPACE', 'default')
-_store = os.environ.get('DUDE_FILE_DB', 'dudefile.db') + "_" + _ns
+# "single": one store file shared by all users, "sharded": a directory holding one store file per user
+_layout = os.environ.get('DUDE_FILE_LAYOUT', 'single')
+_single_store = os.environ.get('DUDE_FILE_DB', 'dudefile.db') + "_" + _ns
+_sharded_store = os.path.join(os.environ.get('DUDE_FILE_DB', 'dudefile.db'), _ns)
+_store = _sharded_store if _layout == "sharded" else _single_store
 _store_del = _store + ".deleted"
 
 _BEGIN_MARKER = "====<BR %s>===="
 _BEGIN_MARKER_RE = "====<BR (.*)>===="
 _END_MARKER = "====<ER>===="
 
+_BEGIN_BYTES = b"====<BR "
+# characters separating the fields and entries of the sidecars
+_SEPARATORS = re.compile("[\t\n\r]")
+
+# store files in the binary record format start with this magic, whose last byte is the format version; files without
+# it hold text records (see Secret.serialize) and are converted by compaction
+_MAGIC = b"DUDEBIN1"
+# binary record header: length of the rest of the record, flags, UTC timestamp in microseconds since the epoch, lengths
+# of the secret ID, user name and key, numbers of derived and stemmed keys, lengths of the keys and of the body
+_HEADER = struct.Struct("<IBqHHHHHII")
+_COMPRESSED = 0x01
+_EPOCH = datetime(1970, 1, 1)
+# secret bodies at least this long are stored zlib compressed, 0 disables compression
+_compress_min = int(os.environ.get('DUDE_FILE_COMPRESS_MIN', 256))
+
+# compact the store once tombstones make up this fraction of its records, 0 disables automatic compaction
+_vacuum_ratio = float(os.environ.get('DUDE_FILE_VACUUM_RATIO', 0))
+
+# when appends reach the disk: "none" leaves it to the OS, "batched" syncs once per group commit, "record" syncs every
+# record on its own
+_durability = os.environ.get('DUDE_FILE_DURABILITY', 'batched')
+# maximum number of queued appends written together
+_group_commit_size = int(os.environ.get('DUDE_FILE_GROUP_COMMIT', 256))
+
+# in-memory copies of the index sidecars, keyed by sidecar path
+_indexes = {}
+# rewrite the memory-mapped snapshot of an index sidecar once this many records were indexed past it, 0 never does;
+# processes serving the same store (e.g. pre-forked slack workers, which turn it on) share the snapshot's pages rather
+# than each loading the whole sidecar
+_snapshot_every = int(os.environ.get('DUDE_FILE_INDEX_SNAPSHOT', 0))
+# index snapshot: magic, inode and bytes of the sidecar covered, bytes of the store covered, number of records and of
+# words, followed by a sorted table of words (offset and length of the word, offset and number of its postings), the
+# words and the postings as 64-bit record offsets
+_SNAPSHOT_MAGIC = b"DUDEMIX1"
+_SNAPSHOT_HEADER = struct.Struct("<8sQQQQQ")
+_SNAPSHOT_ENTRY = struct.Struct("<QIQI")
+# tag catalog sidecar path -> _Catalog
+_catalogs = {}
+# rewrite the tag catalog snapshot once this many secrets were cataloged or forgotten past it, 0 never does; loading a
+# catalog then costs its number of tags plus the entries past the snapshot, rather than its number of secrets
+_catalog_snapshot_every = int(os.environ.get('DUDE_FILE_CATALOG_SNAPSHOT', 10000))
+# tag catalog snapshot: magic, inode and bytes of the sidecar covered, bytes of the store and of the tombstone log
+# covered, bytes of tags and number of secrets, followed by the tags ("username<TAB>key<TAB>count" lines), a table of
+# the secrets sorted by ID (offset and length of the ID, line number of its tag) and the IDs
+_CATALOG_MAGIC = b"DUDETAG1"
+_CATALOG_HEADER = struct.Struct("<8sQQQQQQ")
+_CATALOG_ENTRY = struct.Struct("<QII")
+# guards the in-memory indexes, and is always taken before a store's file lock
+_index_lock = threading.RLock()
+# advisory file locks, keyed by lock file path
+_file_locks = {}
+
 
 class Secret:
+    __slots__ = ("sid", "username", "key", "derived_keys", "fuzzy_keys", "in_ts", "content_keys", "_secret", "_body",
+                 "_flags")
+
+    def __init__(self):
+        self.sid = self.username = self.key = self.in_ts = None
+        self.content_keys = None  # words of the body to index, not part of the record
+        self.derived_keys, self.fuzzy_keys = [], []
+        self._secret, self._body, self._flags = None, None, 0
+
+    @property
+    def secret(self):
+        # binary records keep the body as stored until it is asked for
+        if self._secret is None and self._body is not None:
+            body = zlib.decompress(self._body) if self._flags & _COMPRESSED else self._body
+            self._secret = body.decode("utf-8")
+        return self._secret
+
+    @secret.setter
+    def secret(self, secret):
+        self._secret, self._body, self._flags = secret, None, 0
+
     def serialize(self, sid, key, secret, derived_keys, fuzzy_keys, username, in_ts):
         self.sid = sid
         self.username = username if username else ''
@@ -22,10 +115,12 @@ class Secret:
         self.derived_keys = derived_keys
         self.fuzzy_keys = fuzzy_keys
         self.in_ts = in_ts
+        return self.text()
 
+    def text(self):
         return "\n".join(
-            [_BEGIN_MARKER % sid, self.username, str(self.in_ts), self.key,
-             " ".join(self.derived_keys + self.fuzzy_keys),
+            [_BEGIN_MARKER % self.sid, self.username or '', str(self.in_ts), self.key,
+             " ".join(list(self.derived_keys) + list(self.fuzzy_keys)),
              self.secret, _END_MARKER])
 
     def deserialize(self, record):
@@ -40,11 +135,397 @@ class Secret:
         self.derived_keys, self.fuzzy_keys = _keys[:_mid], _keys[_mid:]
         return self
 
+    def pack(self):
+        """
+        Encode the secret as a binary record. A body read from a binary record is written back as it was stored.
+
+        :return: the record bytes
+        """
+        if self._body is not None:
+            body, flags = self._body, self._flags
+        else:
+            body, flags = self._secret.encode("utf-8"), 0
+            if _compress_min and len(body) >= _compress_min:
+                compressed = zlib.compress(body)
+                if len(compressed) < len(body):
+                    body, flags = compressed, _COMPRESSED
+        sid, username = str(self.sid).encode("utf-8"), (self.username or '').encode("utf-8")
+        key = self.key.encode("utf-8")
+        keys = "\0".join(list(self.derived_keys) + list(self.fuzzy_keys)).encode("utf-8")
+        ts = (self.in_ts - _EPOCH) // timedelta(microseconds=1)
+        payload_len = len(sid) + len(username) + len(key) + len(keys) + len(body)
+        header = _HEADER.pack(_HEADER.size - 4 + payload_len, flags, ts, len(sid), len(username), len(key),
+                              len(self.derived_keys), len(self.fuzzy_keys), len(keys), len(body))
+        return b"".join([header, sid, username, key, keys, body])
+
+    def unpack(self, f, body=True):
+        """
+        Decode the next binary record of a file. Only the header is decoded, the body is kept as stored or, if not
+        asked for, skipped.
+
+        :param f: file positioned at the start of a record
+        :param body: whether to read the body
+        :return: the Secret, None at the end of the file
+        """
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+        _len, flags, ts, sid_len, username_len, key_len, n_derived, n_fuzzy, keys_len, body_len = _HEADER.unpack(header)
+        meta_len = sid_len + username_len + key_len + keys_len
+        data = f.read(meta_len + body_len) if body else f.read(meta_len)
+        if len(data) < (meta_len + body_len if body else meta_len):
+            return None  # truncated by an interrupted write
+        if not body:
+            f.seek(body_len, os.SEEK_CUR)
+        pos = sid_len + username_len
+        self.sid = data[:sid_len].decode("utf-8")
+        self.username = data[sid_len:pos].decode("utf-8") or None
+        self.key = data[pos:pos + key_len].decode("utf-8")
+        pos += key_len
+        keys = data[pos:pos + keys_len].decode("utf-8").split("\0") if keys_len else []
+        self.derived_keys, self.fuzzy_keys = keys[:n_derived], keys[n_derived:n_derived + n_fuzzy]
+        self.in_ts = _EPOCH + timedelta(microseconds=ts)
+        self._secret, self._flags = None, flags
+        self._body = data[meta_len:] if body else None
+        return self
+
     def summary(self):
         return (self.sid, self.key, self.secret, self.in_ts)
 
+    def words(self):
+        return {self.key}.union(self.derived_keys, self.fuzzy_keys)
+
 
-def put(secret, orig_key, derived_keys, stemmed_keys, username):
+class _Index:
+    """
+    In-memory view of the index sidecar: postings keyed by "username<TAB>word" holding the byte offsets of matching
+    records in the store file.
+    """
+
+    def __init__(self, inode, snapshot=None):
+        self.inode = inode
+        self.postings = {}  # postings past the snapshot, all of them without one
+        self.pos = 0  # bytes of the sidecar consumed so far
+        self.watermark = 0  # bytes of the store file covered by the sidecar
+        self.records = 0
+        self.tombstones = 0  # lines of the tombstone log counted so far, see _count_tombstones
+        self.del_pos = 0  # bytes of the tombstone log counted so far
+        self.snapshot = snapshot
+        self.snapshot_inode = None  # inode of the snapshot file looked at when this index was loaded
+        if snapshot is not None:
+            self.pos, self.watermark, self.records = snapshot.idx_pos, snapshot.watermark, snapshot.records
+
+    def get(self, word):
+        """
+        :param word: "username<TAB>word"
+        :return: byte offsets of the records having the word, in store order
+        """
+        postings = self.postings.get(word, ())
+        if self.snapshot is None:
+            return postings
+        return self.snapshot.get(word) + list(postings)
+
+
+class _Snapshot:
+    """
+    Read-only, memory-mapped snapshot of the postings of an index sidecar up to some point, see _write_snapshot.
+    Words are looked up with a binary search over its sorted table.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.idx_inode, self.idx_pos, self.watermark, self.records, self.words = \
+            _SNAPSHOT_HEADER.unpack_from(self.map)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError("%s is not an index snapshot" % path)
+
+    def get(self, word):
+        key = word.encode("utf-8")
+        lo, hi = 0, self.words
+        while lo < hi:
+            mid = (lo + hi) // 2
+            word_offset, word_len, offset, count = self._entry(mid)
+            found = self.map[word_offset:word_offset + word_len]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return array.array("Q", self.map[offset:offset + 8 * count]).tolist()
+        return []
+
+    def items(self):
+        for i in range(self.words):
+            word_offset, word_len, offset, count = self._entry(i)
+            yield (self.map[word_offset:word_offset + word_len].decode("utf-8"),
+                   array.array("Q", self.map[offset:offset + 8 * count]).tolist())
+
+    def _entry(self, i):
+        return _SNAPSHOT_ENTRY.unpack_from(self.map, _SNAPSHOT_HEADER.size + i * _SNAPSHOT_ENTRY.size)
+
+
+class _CatalogSnapshot:
+    """
+    Read-only, memory-mapped snapshot of a tag catalog up to some point, see _write_catalog_snapshot. Its tags are read
+    on load, the original key of a secret is looked up with a binary search over its table of secrets.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.tags_inode, self.tags_pos, self.watermark, self.del_pos, tags_size, self.secrets = \
+            _CATALOG_HEADER.unpack_from(self.map)
+        if magic != _CATALOG_MAGIC:
+            raise ValueError("%s is not a tag catalog snapshot" % path)
+        self.tags = []  # (username, key, number of secrets), by line number
+        blob = self.map[_CATALOG_HEADER.size:_CATALOG_HEADER.size + tags_size].decode("utf-8")
+        for line in blob.split("\n")[:-1]:
+            username, tag = line.split("\t", 1)
+            key, count = tag.rsplit("\t", 1)
+            self.tags.append((username, key, int(count)))
+        self.table = _CATALOG_HEADER.size + tags_size
+
+    def get(self, secret_id):
+        """
+        :param secret_id: secret ID
+        :return: tuple containing the username and original key of the secret, None if it isn't in the snapshot
+        """
+        sid = secret_id.encode("utf-8")
+        lo, hi = 0, self.secrets
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sid_offset, sid_len, tag = self._entry(mid)
+            found = self.map[sid_offset:sid_offset + sid_len]
+            if found < sid:
+                lo = mid + 1
+            elif found > sid:
+                hi = mid
+            else:
+                return self.tags[tag][:2]
+        return None
+
+    def items(self):
+        for i in range(self.secrets):
+            sid_offset, sid_len, tag = self._entry(i)
+            yield (self.map[sid_offset:sid_offset + sid_len].decode("utf-8"),) + self.tags[tag][:2]
+
+    def _entry(self, i):
+        return _CATALOG_ENTRY.unpack_from(self.map, self.table + i * _CATALOG_ENTRY.size)
+
+
+class _Catalog:
+    """
+    In-memory view of the tag catalog sidecar: per user, the number of secrets kept under every key. It is loaded from
+    the catalog's snapshot, if it has one, and the sidecar entries past it; forgotten secrets are dropped as the
+    tombstone log grows.
+    """
+
+    def __init__(self, inode, snapshot=None):
+        self.inode = inode
+        self.snapshot = snapshot
+        self.snapshot_inode = None  # inode of the snapshot file looked at when this catalog was loaded
+        self.keys = {}  # secret ID -> (username, key) of the secrets cataloged past the snapshot and still kept
+        self.gone = set()  # IDs of the secrets of the snapshot forgotten since
+        self.counts = {}  # username -> {key: number of secrets}
+        self.sorted = {}  # username -> sorted keys, dropped whenever the user's keys change
+        self.pos = 0  # bytes of the sidecar consumed so far
+        self.watermark = 0  # bytes of the store file covered by the sidecar
+        self.del_pos = 0  # bytes of the tombstone log consumed so far
+        self.changes = 0  # secrets cataloged or forgotten past the snapshot
+        if snapshot is not None:
+            self.pos, self.watermark, self.del_pos = snapshot.tags_pos, snapshot.watermark, snapshot.del_pos
+            for username, key, count in snapshot.tags:
+                self.counts.setdefault(username, {})[key] = count
+
+    def has(self, secret_id):
+        return self._entry(secret_id) is not None
+
+    def add(self, secret_id, username, key):
+        if self.has(secret_id):
+            return
+        self.keys[secret_id] = (username, key)
+        self.changes += 1
+        counts = self.counts.setdefault(username, {})
+        if key not in counts:
+            self.sorted.pop(username, None)
+        counts[key] = counts.get(key, 0) + 1
+
+    def discard(self, secret_id, username):
+        entry = self._entry(secret_id)
+        if entry is None or entry[0] != username:
+            return  # unknown, or tombstoned by another user which doesn't forget it
+        if self.keys.pop(secret_id, None) is None:
+            self.gone.add(secret_id)
+        self.changes += 1
+        counts = self.counts[username]
+        count = counts[entry[1]] - 1
+        if count:
+            counts[entry[1]] = count
+        else:
+            del counts[entry[1]]
+            self.sorted.pop(username, None)
+
+    def tags(self, username):
+        tags = self.sorted.get(username)
+        if tags is None:
+            tags = self.sorted[username] = sorted(self.counts.get(username, ()))
+        return tags
+
+    def items(self):
+        """
+        :return: generator of tuples containing the ID, username and original key of every secret still kept
+        """
+        if self.snapshot is not None:
+            for secret_id, username, key in self.snapshot.items():
+                if secret_id not in self.gone:
+                    yield secret_id, username, key
+        for secret_id, (username, key) in self.keys.items():
+            yield secret_id, username, key
+
+    def _entry(self, secret_id):
+        entry = self.keys.get(secret_id)
+        if entry is None and self.snapshot is not None and secret_id not in self.gone:
+            entry = self.snapshot.get(secret_id)
+        return entry
+
+
+class _FileLock:
+    """
+    Exclusive lock of a store file, held across processes with an advisory lock on a sidecar lock file and re-entrant
+    within a process. Takes the index lock first so that threads always acquire both in the same order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        _index_lock.acquire()
+        try:
+            if self._depth == 0:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+            self._depth += 1
+        except Exception:
+            _index_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        _index_lock.release()
+
+
+class _Writer:
+    """
+    Group commit of appends: callers queue their records or tombstones and wait while a single thread writes whatever
+    has piled up, one write (and at most one sync) per file.
+    """
+
+    def __init__(self):
+        self._pid = None
+        self._queue = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, kind, store, path, payload):
+        """
+        Queue an append and wait for it to be written. Must not be called while holding the index lock, which the
+        writer thread needs.
+
+        :param kind: "records" or "tombstones"
+        :param store: store file path, whose lock guards the append
+        :param path: path of the file appended to
+        :param payload: list of records entries, or of tombstone rows
+        """
+        request = _WriteRequest(kind, store, path, payload)
+        self._ensure_started().put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._pid != os.getpid():  # not started yet, or started by the process we were forked from
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, args=(self._queue,), name="dude-file-writer", daemon=True).start()
+                self._pid = os.getpid()
+            return self._queue
+
+    def _run(self, requests):
+        while True:
+            batch = [requests.get()]
+            while len(batch) < _group_commit_size:
+                try:
+                    batch.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.kind, request.store, request.path), []).append(request)
+            for (kind, store, path), group in groups.items():
+                try:
+                    _commit(kind, store, path, [request.payload for request in group])
+                except Exception as e:
+                    for request in group:
+                        request.error = e
+                finally:
+                    for request in group:
+                        request.done.set()
+
+
+class _WriteRequest:
+    def __init__(self, kind, store, path, payload):
+        self.kind = kind
+        self.store = store
+        self.path = path
+        self.payload = payload
+        self.error = None
+        self.done = threading.Event()
+
+
+_writer = _Writer()
+
+
+def _shard(username):
+    """
+    Get the files holding a user's secrets. With the sharded layout every user has their own, named after a stable hash
+    of the user name.
+
+    :param username: user name
+    :return: a tuple containing the store file path and the tombstone file path
+    """
+    if _layout != "sharded":
+        return _store, _store_del
+    store = os.path.join(_store, hashlib.sha1((username or '').encode("utf-8")).hexdigest()[:16] + ".db")
+    return store, store + ".deleted"
+
+
+def _shards():
+    """
+    Get the files of every shard of the store.
+
+    :return: a list of tuples containing the store file path and the tombstone file path
+    """
+    if _layout != "sharded":
+        return [(_store, _store_del)]
+    if not os.path.isdir(_store):
+        return []
+    return [(os.path.join(_store, name), os.path.join(_store, name) + ".deleted")
+            for name in sorted(os.listdir(_store)) if name.endswith(".db")]
+
+
+def put(secret, orig_key, derived_keys, stemmed_keys, username, content_keys=None):
     """
     Put a secret in store along with its key and derived keys.
 
@@ -53,14 +534,48 @@ def put(secret, orig_key, derived_keys, stemmed_keys, username):
     :param derived_keys: split key words
     :param stemmed_keys: stemmed key words
     :param username: user name
+    :param content_keys: words and stems of the secret content to index for search, None to leave it out of the
+    content index
     """
-    obj = Secret()
-    record = obj.serialize(uuid.uuid4(), orig_key, secret, derived_keys, stemmed_keys, username, datetime.utcnow())
-    with open(_store, "a") as f:
-        f.write("\n%s" % record)
+    obj = _secret(secret, orig_key, derived_keys, stemmed_keys, username, content_keys)
+    _append(_shard(username)[0], [obj])
     return obj.sid
 
 
+def put_many(items, content_keys=None):
+    """
+    Put a batch of secrets in store with a single write per shard.
+
+    :param items: iterable of tuples containing the arguments of put: secret, original key, derived keys, stemmed keys
+    and user name
+    :param content_keys: list of the content keys of every secret (see put), in input order
+    :return: a list of the secrets' IDs, in input order
+    """
+    entries = []
+    by_shard = {}
+    items = list(items)
+    content_keys = content_keys or [None] * len(items)
+    for (secret, orig_key, derived_keys, stemmed_keys, username), keys in zip(items, content_keys):
+        obj = _secret(secret, orig_key, derived_keys, stemmed_keys, username, keys)
+        entries.append(obj)
+        by_shard.setdefault(_shard(username)[0], []).append(obj)
+    for store, shard_entries in by_shard.items():
+        _append(store, shard_entries)
+    return [obj.sid for obj in entries]
+
+
+def _secret(secret, orig_key, derived_keys, stemmed_keys, username, content_keys=None):
+    # the sidecars hold one tab separated entry per line
+    for field in [orig_key, username or ''] + list(derived_keys) + list(stemmed_keys) + list(content_keys or ()):
+        if _SEPARATORS.search(field):
+            raise ValueError("Keys and user names can't hold tabs or line breaks: %r" % field)
+    obj = Secret()
+    obj.sid, obj.key, obj.secret, obj.username = str(uuid.uuid4()), orig_key, secret, username or None
+    obj.derived_keys, obj.fuzzy_keys, obj.in_ts = list(derived_keys), list(stemmed_keys), datetime.utcnow()
+    obj.content_keys = content_keys
+    return obj
+
+
 def remove(secret_id, username):
     """
     Forget a secret.
@@ -68,100 +583,1051 @@ def remove(secret_id, username):
     :param secret_id: secret's ID
     :param username: user name
     """
-    row = [username, str(secret_id)]
-    with open(_store_del, "a") as f:
-        out = csv.writer(f)
-        out.writerow(row)
+    store, store_del = _shard(username)
+    _tombstone(store, store_del, secret_id, username)
+    _maybe_vacuum(store, store_del)
 
 
-def remove_all(username):
+def remove_many(secret_ids, username):
     """
-    Forget a secret.
+    Forget a batch of secrets, their tombstones are written in a single append.
 
+    :param secret_ids: secrets' IDs
     :param username: user name
     """
-    obj = Secret()
-    for record in _cursor():
-        obj = obj.deserialize(record)
-        if obj.username == username:
-            remove(obj.sid, username)
-
-
-def _cursor():
-    with open(_store, "r") as f:
-        for l in f:
-            record = []
-            match = re.search(_BEGIN_MARKER_RE, l.strip())
-            if match:
-                record.append(l)
-                record.append(f.readline().strip())  # username
-                record.append(f.readline().strip())  # ts
-                record.append(f.readline().strip())  # key
-                record.append(f.readline().strip())  # derived keys
-                for l in f:
-                    record.append(l.strip())
-                    if l.strip() == _END_MARKER:
-                        break
-            if record:
-                yield record
+    rows = [[username, str(secret_id)] for secret_id in secret_ids]
+    if not rows:
+        return
+    store, store_del = _shard(username)
+    _writer.submit("tombstones", store, store_del, rows)
+    _maybe_vacuum(store, store_del)
 
 
-def get(key, username):
+def remove_where(username, key=None, older_than=None):
     """
-    Get a collection of secrets associated with the key.
+    Forget the secrets of a user matching conditions, all of them if none is given. The store is walked once, without
+    reading secret bodies, and the tombstones are written in a single append.
 
     :param username: user name
-    :param key: the key
-    :return: a list of tuples containing the following: secret ID, key, secret, score
+    :param key: only forget the secrets kept under this original key
+    :param older_than: only forget the secrets kept before this datetime
+    :return: number of secrets forgotten
+    """
+    store, store_del = _shard(username)
+    deleted = _deleted(store_del, username)
+    secret_ids = [obj.sid for _offset, obj in _cursor(store, body=False)
+                  if obj.username == username and obj.sid not in deleted and (key is None or obj.key == key)
+                  and (older_than is None or obj.in_ts < older_than)]
+    remove_many(secret_ids, username)
+    return len(secret_ids)
+
+
+def remove_all(username):
+    """
+    Forget all the secrets of a user.
+
+    :param username: user name
+    """
+    remove_where(username)
+
+
+def iter_records():
+    """
+    Walk every secret still kept, of every user, for export.
+
+    :return: generator of dicts holding the sid, username, key, derived_keys, stemmed_keys, secret and in_ts of a secret
+    """
+    for store, store_del in _shards():
+        tombstones = set()
+        if _size(store_del):
+            with open(store_del, "r") as d:
+                tombstones.update(tuple(row) for row in csv.reader(d))
+        for _offset, obj in _cursor(store):
+            if (obj.username or '', obj.sid) not in tombstones:
+                yield {"sid": obj.sid, "username": obj.username, "key": obj.key, "derived_keys": obj.derived_keys,
+                       "stemmed_keys": obj.fuzzy_keys, "secret": obj.secret, "in_ts": obj.in_ts}
+
+
+def restore_many(records, content_keys=None):
+    """
+    Put a batch of exported secrets back in store, keeping their IDs and timestamps (see iter_records). Secrets
+    already in store, as told by its tag catalog, are skipped, so an interrupted import can be run again.
+
+    :param records: list of dicts as yielded by iter_records
+    :param content_keys: list of the content keys of every secret (see put), in input order
+    :return: number of secrets put
+    """
+    by_shard = {}
+    for record, keys in zip(records, content_keys or [None] * len(records)):
+        obj = _secret(record["secret"], record["key"], record["derived_keys"], record["stemmed_keys"],
+                      record["username"], keys)
+        obj.sid, obj.in_ts = str(record["sid"]), record["in_ts"]
+        by_shard.setdefault(_shard(record["username"]), []).append(obj)
+    put = 0
+    for (store, store_del), entries in by_shard.items():
+        catalog = _catalog(store, store_del)
+        new, seen = [], set()
+        with _index_lock:
+            for obj in entries:
+                if obj.sid not in seen and not catalog.has(obj.sid):
+                    seen.add(obj.sid)
+                    new.append(obj)
+        if new:
+            _append(store, new)
+            put += len(new)
+    return put
+
+
+def _tombstone(store, store_del, secret_id, username):
+    row = [username, str(secret_id)]
+    _writer.submit("tombstones", store, store_del, [row])
+
+
+def _write_tombstones(store_del, rows, sync):
+    with open(store_del, "a") as f:
+        out = csv.writer(f)
+        out.writerows(rows)
+        if sync:
+            _sync(f)
+
+
+def _cursor(store, start=0, body=True):
+    """
+    Walk a store file record by record.
+
+    :param store: store file path
+    :param start: byte offset to start walking from
+    :param body: whether secret bodies are needed, binary records skip them otherwise
+    :return: generator of tuples containing the byte offset of a record and its Secret
     """
-    secrets = []
-    _deleted = []
-    with open(_store_del, "r") as d:
+    if not os.path.exists(store):
+        return
+    with open(store, "rb") as f:
+        if _is_binary(f):
+            offset = max(start, len(_MAGIC))
+            f.seek(offset)
+            while True:
+                obj = Secret().unpack(f, body)
+                if obj is None:
+                    break
+                yield offset, obj
+                offset = f.tell()
+        else:
+            f.seek(start)
+            offset = start
+            for l in f:
+                if l.startswith(_BEGIN_BYTES):
+                    yield offset, Secret().deserialize(_read_record(f, l))
+                    offset = f.tell()
+                else:
+                    offset += len(l)
+
+
+def _is_binary(f):
+    f.seek(0)
+    return f.read(len(_MAGIC)) == _MAGIC
+
+
+def _read_record(f, first_line):
+    record = [first_line.decode("utf-8").strip()]
+    for l in f:
+        l = l.decode("utf-8").strip()
+        record.append(l)
+        if l == _END_MARKER:
+            break
+    return record
+
+
+def _read_at(f, offset, binary):
+    f.seek(offset)
+    if binary:
+        return Secret().unpack(f)
+    return Secret().deserialize(_read_record(f, f.readline()))
+
+
+def _deleted(store_del, username):
+    if not os.path.exists(store_del):
+        return _read_deleted(None, username)
+    with open(store_del, "r") as d:
+        return _read_deleted(d, username)
+
+
+def _read_deleted(d, username):
+    deleted = set()
+    rows = 0
+    if d is not None:
         for row in csv.reader(d):
             (_username, secret_id) = row
+            rows += 1
             if _username == username:
-                _deleted.append(secret_id)
-    obj = Secret()
-    for record in _cursor():
-        key_set = set()
-        obj = obj.deserialize(record)
-        if obj.sid not in _deleted:
-            if obj.username == username:
-                key_set.add(obj.key)
-                key_set = key_set.union(obj.derived_keys)
-                key_set = key_set.union(obj.fuzzy_keys)
-                if key.lower() in key_set:
-                    secrets.append(obj.summary())
+                deleted.add(secret_id)
+    metrics.inc("dude_tombstones_loaded_total", rows, store="file")
+    return deleted
+
+
+def get(key, username, match_all=True):
+    """
+    Get a collection of secrets associated with the key.
+    Candidate records are looked up in the index sidecar, only those are read from the store.
+
+    :param username: user name
+    :param key: the key, or a list of clauses of alternative keys (see src.stores.clauses)
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: a list of tuples containing the following: secret ID, key, secret, score
+    """
+    return list(iter_get(key, username, match_all))
+
+
+def iter_get(key, username, match_all=True):
+    """
+    Get the secrets associated with the key one at a time (see get), reading their records as they are asked for.
+
+    :param username: user name
+    :param key: the key, or a list of clauses of alternative keys (see src.stores.clauses)
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: generator of tuples containing the following: secret ID, key, secret, timestamp
+    """
+    store, store_del = _shard(username)
+    return _open_matches(store, store_del, _index, key, username, match_all)
+
 
-    return secrets
+def search(key, username, match_all=True):
+    """
+    Get the secrets whose content has the words, from the content index sidecar. Secrets kept without content keys
+    (see put) are not found.
 
+    :param key: the words, or a list of clauses of alternative words (see src.stores.clauses)
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: a list of tuples containing the following: secret ID, key, secret, timestamp
+    """
+    store, store_del = _shard(username)
+    return list(_open_matches(store, store_del, _content_index, key, username, match_all))
+
+
+def _match(index, key, username, match_all):
+    """
+    Look clauses up in an index.
+
+    :return: set of the byte offsets of the matching records
+    """
+    offsets = None
+    for clause in clauses(key):
+        matches = set()
+        for k in clause:
+            matches.update(index.get("%s\t%s" % (username or '', k)))
+        if offsets is None:
+            offsets = matches
+        elif match_all:
+            offsets &= matches
+        else:
+            offsets |= matches
+    return offsets
+
+
+def _open_matches(store, store_del, index, key, username, match_all):
+    """
+    Look clauses up in an index and open the store file and its tombstones under the store's lock, so that the
+    offsets found and the files read them from match even if the store is compacted before the records are read.
+
+    :param index: function getting the up to date index of the store file, _index or _content_index
+    :return: generator of the matching secrets, see _read_matches
+    """
+    with _lock(store):
+        offsets = _match(index(store), key, username, match_all)
+        if not offsets:
+            return iter(())
+        f = open(store, "rb")
+        d = open(store_del, "r") if os.path.exists(store_del) else None
+    return _read_matches(f, d, username, offsets)
+
+
+def _read_matches(f, d, username, offsets):
+    """
+    Read matching records, see _open_matches.
 
-def get_keys(username):
+    :param f: store file, opened in binary mode, closed once done
+    :param d: tombstone file, closed once done, None if there is none
+    :param offsets: byte offsets of the records
+    :return: generator of tuples containing the following: secret ID, key, secret, timestamp
+    """
+    scanned = matched = 0
+    try:
+        with f:
+            _deleted_ids = _read_deleted(d, username)
+            if d is not None:
+                d.close()
+            binary = _is_binary(f)
+            for offset in sorted(offsets):
+                obj = _read_at(f, offset, binary)
+                scanned += 1
+                if obj.sid not in _deleted_ids and obj.username == username:
+                    matched += 1
+                    yield obj.summary()
+    finally:
+        metrics.inc("dude_records_scanned_total", scanned, store="file")
+        metrics.inc("dude_records_matched_total", matched, store="file")
+
+
+def get_keys(username, after=None, limit=None):
     """
     Get a collection of keys (tags) that have a score of 1 - essentially keys input by end-user while storing secrets.
+    Keys come from the tag catalog, so this costs time proportional to the user's number of keys, not of secrets.
 
     :param username: user name
-    :return: a list of absolute keys
-    """
-    keys = []
-    with open(_store_del, "r") as d:
-        _deleted = set(d.read().split("\n"))
-    with open(_store, "r") as f:
-        for l in f:
-            match = re.search(_BEGIN_MARKER_RE, l.strip())
-            if match:
-                secret_id = match.groups()[0]
-                _username = f.readline().strip()
-                _ts = f.readline().strip()
-                if username != _username:
-                    continue
-                if secret_id not in _deleted:
-                    keys.append(f.readline().strip())
+    :param after: only return the keys sorting after this one, to get the next page
+    :param limit: maximum number of keys to return, all of them if None
+    :return: a sorted list of distinct absolute keys
+    """
+    store, store_del = _shard(username)
+    tags = _catalog(store, store_del).tags(username or '')
+    start = bisect.bisect_right(tags, after) if after is not None else 0
+    keys = tags[start:start + limit if limit is not None else None]
+    metrics.inc("dude_records_matched_total", len(keys), store="file")
     return keys
 
 
+def get_terms(username):
+    """
+    Get the keys of every secret of a user: original key, derived and stemmed keys.
+
+    :param username: user name
+    :return: generator of tuples containing secret ID and set of keys
+    """
+    store, store_del = _shard(username)
+    _deleted_ids = _deleted(store_del, username)
+    for _offset, obj in _cursor(store, body=False):
+        if obj.username == username and obj.sid not in _deleted_ids:
+            yield obj.sid, obj.words()
+
+
+def version(username):
+    """
+    Get a token of the state of a user's secrets, which changes whenever they may have: every write appends to their
+    shard's store file or tombstone log, and compaction replaces them. It costs two stat calls.
+
+    :param username: user name
+    :return: hashable token
+    """
+    return tuple(_file_version(path) for path in _shard(username))
+
+
+def _file_version(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size
+
+
 def _vacuum():
-    pass
+    """
+    Compact every shard of the store, see _vacuum_shard.
+
+    :return: number of records dropped
+    """
+    return sum(_vacuum_shard(store, store_del) for store, store_del in _shards())
+
+
+def _vacuum_shard(store, store_del, force=False):
+    """
+    Compact a store file: rewrite it in the binary record format without forgotten secrets, rebuild its index and
+    truncate its tombstone log. Writers wait for the store's lock meanwhile, the compacted files are swapped in by
+    rename so readers holding the old files open are unaffected.
+
+    :param store: store file path
+    :param store_del: tombstone file path
+    :param force: whether to rewrite the store even if nothing was forgotten
+    :return: number of records dropped
+    """
+    with _lock(store):
+        return _compact(store, store_del, force)
+
+
+def _compact(store, store_del, force):
+    tombstones = set()
+    if _size(store_del):
+        with open(store_del, "r") as d:
+            for row in csv.reader(d):
+                tombstones.add(tuple(row))
+    if not tombstones and not force:
+        return 0
+
+    idx_path = _index_path(store)
+    suffix = ".%d.tmp" % os.getpid()
+    dropped = 0
+    moved = {}  # old offset -> new offset of every record kept
+    catalog_path = _catalog_path(store)
+    catalog = _Catalog(None)
+    with open(store + suffix, "wb") as out, open(idx_path + suffix, "w") as ix, open(catalog_path + suffix, "w") as tx:
+        out.write(_MAGIC)
+        offset = len(_MAGIC)
+        for old_offset, obj in _cursor(store):
+            tombstone = (obj.username or '', obj.sid)
+            if tombstone in tombstones:
+                dropped += 1
+                continue
+            chunk = obj.pack()
+            ix.write("".join(_postings(offset, obj)))
+            tx.write(_tag(obj))
+            catalog.add(obj.sid, obj.username or '', obj.key)
+            out.write(chunk)
+            moved[old_offset] = offset
+            offset += len(chunk)
+        ix.write("#%d\n" % offset)
+        tx.write("#%d\n" % offset)
+    open(store_del + suffix, "w").close()
+    content_path = _content_index_path(store)
+    if os.path.exists(content_path):
+        _remap_content_index(content_path, content_path + suffix, moved, offset)
+
+    os.replace(store + suffix, store)
+    os.replace(idx_path + suffix, idx_path)
+    if os.path.exists(content_path):
+        os.replace(content_path + suffix, content_path)
+        _indexes.pop(content_path, None)
+    os.replace(catalog_path + suffix, catalog_path)
+    os.replace(store_del + suffix, store_del)
+    _drop_snapshot(store)
+    if _catalog_snapshot_every > 0:
+        catalog.inode, catalog.pos, catalog.watermark = os.stat(catalog_path).st_ino, _size(catalog_path), offset
+        _write_catalog_snapshot(store, catalog)
+    _indexes.pop(idx_path, None)
+    _catalogs.pop(catalog_path, None)
+    return dropped
+
+
+def _remap_content_index(path, out_path, moved, store_size):
+    """
+    Rewrite a content index sidecar for a compacted store, see _compact.
+
+    :param path: content index sidecar path
+    :param out_path: path of the rewritten sidecar
+    :param moved: dict of the old byte offset of every record kept to its new one
+    :param store_size: size of the compacted store file
+    """
+    index = _Index(None)
+    _load_postings(index, path)
+    with open(out_path, "w") as cx:
+        for word, offsets in index.postings.items():
+            cx.write("".join("%d\t%s\n" % (moved[offset], word) for offset in offsets if offset in moved))
+        cx.write("#%d\n" % store_size)
+
+
+def _convert():
+    """
+    Convert the store files still holding text records to the binary record format.
+
+    :return: number of files converted
+    """
+    converted = 0
+    for store, store_del in _shards():
+        with open(store, "rb") as f:
+            if _is_binary(f) or not _size(store):
+                continue
+        _vacuum_shard(store, store_del, force=True)
+        converted += 1
+    return converted
+
+
+def _maybe_vacuum(store, store_del):
+    if _vacuum_ratio <= 0:
+        return
+    with _index_lock:
+        index = _index(store)
+        records, tombstones = index.records, _count_tombstones(index, store_del)
+    if records and tombstones / records >= _vacuum_ratio:
+        _vacuum_shard(store, store_del)
+
+
+def _count_tombstones(index, store_del):
+    """
+    Count the tombstones of a store file, reading only those written since the last count. Compaction truncates the
+    tombstone log along with rewriting the index, whose count starts over.
+
+    :param index: the up to date _Index of the store file
+    :param store_del: tombstone file path
+    :return: number of tombstones
+    """
+    size = _size(store_del)
+    if size < index.del_pos:  # truncated by a compaction the index sidecar was read before
+        index.tombstones = index.del_pos = 0
+    if size > index.del_pos:
+        with open(store_del, "rb") as d:
+            d.seek(index.del_pos)
+            data = d.read(size - index.del_pos)
+        end = data.rfind(b"\n") + 1
+        index.tombstones += data.count(b"\n", 0, end)
+        index.del_pos += end
+    return index.tombstones
+
+
+def _index_path(store):
+    return store + ".idx"
+
+
+def _content_index_path(store):
+    return store + ".cidx"
+
+
+def _catalog_path(store):
+    return store + ".tags"
+
+
+def _catalog_snapshot_path(store):
+    return store + ".mtag"
+
+
+def _snapshot_path(store):
+    return store + ".midx"
+
+
+def _append(store, entries):
+    """
+    Append serialized records to a store file and their postings to its index sidecar, through the group commit writer.
+
+    :param store: store file path
+    :param entries: list of Secrets
+    """
+    _writer.submit("records", store, store, entries)
+
+
+def _commit(kind, store, path, payloads):
+    """
+    Write queued appends to a file, holding the store's lock.
+
+    :param kind: "records" or "tombstones"
+    :param store: store file path
+    :param path: path of the file appended to
+    :param payloads: list of queued payloads, see _Writer.submit
+    """
+    write = _write_records if kind == "records" else _write_tombstones
+    with _lock(store):
+        if _durability == "record":
+            for payload in payloads:
+                for item in payload:
+                    write(path, [item], True)
+        else:
+            write(path, [item for payload in payloads for item in payload], _durability == "batched")
+
+
+def _write_records(store, entries, sync):
+    idx_path = _index_path(store)
+    if _read_watermark(idx_path) != _size(store):
+        _index(store)  # sidecar lags behind the store, bring it up to date before extending it
+    catalog_watermark = _read_watermark(_catalog_path(store))
+    if catalog_watermark != _size(store):
+        _write_catalog(store, catalog_watermark)  # same for the tag catalog
+    postings = []
+    content_postings = []
+    tags = []
+    chunks = []
+    with open(store, "a+b") as f:
+        offset = f.seek(0, os.SEEK_END)
+        binary = offset == 0 or _is_binary(f)
+        if offset == 0:
+            chunks.append(_MAGIC)
+            offset = len(_MAGIC)
+        for obj in entries:
+            if binary:
+                chunk = obj.pack()
+                record_offset = offset
+            else:
+                chunk = ("\n%s" % obj.text()).encode("utf-8")
+                record_offset = offset + 1
+            postings.extend(_postings(record_offset, obj))
+            tags.append(_tag(obj))
+            if obj.content_keys is not None:
+                content_postings.extend(_postings(record_offset, obj, obj.content_keys))
+            chunks.append(chunk)
+            offset += len(chunk)
+        f.write(b"".join(chunks))
+        if sync:
+            _sync(f)
+    postings.append("#%d\n" % offset)
+    with open(idx_path, "a") as ix:
+        ix.write("".join(postings))
+    tags.append("#%d\n" % offset)
+    with open(_catalog_path(store), "a") as tx:
+        tx.write("".join(tags))
+    if content_postings:
+        content_postings.append("#%d\n" % offset)
+        with open(_content_index_path(store), "a") as cx:
+            cx.write("".join(content_postings))
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _lock(store):
+    """
+    Get the lock guarding writes to a store file, its tombstones and its index.
+
+    :param store: store file path
+    :return: the _FileLock
+    """
+    path = store + ".lock"
+    with _index_lock:
+        lock = _file_locks.get(path)
+        if lock is None:
+            lock = _file_locks[path] = _FileLock(path)
+        return lock
+
+
+def _postings(offset, obj, words=None):
+    username = obj.username or ''
+    return ["%d\t%s\t%s\n" % (offset, username, word) for word in (obj.words() if words is None else words)]
+
+
+def _tag(obj):
+    return "%s\t%s\t%s\n" % (obj.sid, obj.username or '', obj.key)
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _read_watermark(idx_path):
+    """
+    Read the last watermark of the index sidecar without loading it.
+
+    :param idx_path: index sidecar path
+    :return: number of store bytes covered by the sidecar, None if the sidecar is missing or unreadable
+    """
+    try:
+        with open(idx_path, "rb") as ix:
+            size = ix.seek(0, os.SEEK_END)
+            ix.seek(max(0, size - 64))
+            tail = ix.read()
+    except OSError:
+        return None
+    if size == 0:
+        return 0
+    last = tail[tail.rfind(b"\n", 0, -1) + 1:-1]
+    if tail.endswith(b"\n") and last.startswith(b"#"):
+        return int(last[1:])
+    return None
+
+
+def _index(store):
+    """
+    Get the up to date in-memory index of a store file.
+    New sidecar entries are read incrementally; records appended to the store without being indexed are indexed, and
+    the sidecar is rebuilt from the store if it is missing or does not match it.
+
+    :param store: store file path
+    :return: the _Index
+    """
+    with _index_lock:
+        return _refresh_index(store)
+
+
+def _refresh_index(store):
+    idx_path = _index_path(store)
+    try:
+        inode = os.stat(idx_path).st_ino
+    except OSError:
+        return _reindex(store)
+    index = _indexes.get(idx_path)
+    snapshot_inode = _inode(_snapshot_path(store)) if _snapshot_every > 0 else None
+    if (index is None or index.inode != inode or _size(idx_path) < index.pos
+            or index.snapshot_inode != snapshot_inode):
+        index = _indexes[idx_path] = _Index(inode, _open_snapshot(store, inode))
+        index.snapshot_inode = snapshot_inode
+    _load_postings(index, idx_path)
+    store_size = _size(store)
+    if index.watermark > store_size:
+        return _reindex(store)
+    if _snapshot_every > 0 and index.records - (index.snapshot.records if index.snapshot else 0) >= _snapshot_every:
+        with _lock(store):
+            if _inode(_snapshot_path(store)) == snapshot_inode:  # not rewritten by another process meanwhile
+                _write_snapshot(store, index)
+        return _refresh_index(store)
+    if index.watermark < store_size:
+        with _lock(store):
+            _load_postings(index, idx_path)
+            store_size = _size(store)
+            lines = []
+            for offset, obj in _cursor(store, index.watermark, body=False):
+                if offset >= store_size:
+                    break
+                lines.extend(_postings(offset, obj))
+            if lines:
+                lines.append("#%d\n" % store_size)
+                with open(idx_path, "a") as ix:
+                    ix.write("".join(lines))
+            _load_postings(index, idx_path)
+    return index
+
+
+def _inode(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+
+def _open_snapshot(store, idx_inode):
+    """
+    Map the index snapshot of a store file, if it has one matching its index sidecar.
+
+    :param store: store file path
+    :param idx_inode: inode of the index sidecar
+    :return: the _Snapshot, None if there is none, or it is stale or unreadable
+    """
+    if _snapshot_every <= 0:
+        return None
+    try:
+        snapshot = _Snapshot(_snapshot_path(store))
+    except (OSError, ValueError, struct.error):
+        return None
+    if (snapshot.idx_inode != idx_inode or snapshot.idx_pos > _size(_index_path(store))
+            or snapshot.watermark > _size(store)):
+        return None
+    return snapshot
+
+
+def _write_snapshot(store, index):
+    """
+    Write the postings of an index to the index snapshot of a store file, swapped in by rename so that processes
+    still mapping the previous one are unaffected. Must be called holding the store's lock.
+
+    :param store: store file path
+    :param index: the up to date _Index
+    """
+    words = {}
+    if index.snapshot is not None:
+        for word, offsets in index.snapshot.items():
+            words[word.encode("utf-8")] = offsets
+    for word, offsets in index.postings.items():
+        words.setdefault(word.encode("utf-8"), []).extend(offsets)
+    entries, blob, postings = [], [], array.array("Q")
+    words_offset = _SNAPSHOT_HEADER.size + len(words) * _SNAPSHOT_ENTRY.size
+    postings_offset = words_offset + sum(len(word) for word in words)
+    for word in sorted(words):
+        entries.append(_SNAPSHOT_ENTRY.pack(words_offset, len(word), postings_offset + 8 * len(postings),
+                                            len(words[word])))
+        words_offset += len(word)
+        blob.append(word)
+        postings.extend(words[word])
+    path = _snapshot_path(store)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, index.inode, index.pos, index.watermark, index.records,
+                                      len(words)))
+        f.write(b"".join(entries))
+        f.write(b"".join(blob))
+        f.write(postings.tobytes())
+    os.replace(tmp_path, path)
+
+
+def _drop_snapshot(store):
+    try:
+        os.remove(_snapshot_path(store))
+    except OSError:
+        pass
+
+
+def _content_index(store):
+    """
+    Get the up to date in-memory content index of a store file. Unlike the key index, it is never caught up from the
+    store: content keys are only known when secrets are kept (see put), or to reindex_content.
+
+    :param store: store file path
+    :return: the _Index, empty if the store has no content index
+    """
+    path = _content_index_path(store)
+    with _index_lock:
+        try:
+            inode = os.stat(path).st_ino
+        except OSError:
+            return _Index(None)
+        index = _indexes.get(path)
+        if index is None or index.inode != inode or _size(path) < index.pos:
+            index = _indexes[path] = _Index(inode)
+        _load_postings(index, path)
+        return index
+
+
+def _catalog(store, store_del):
+    """
+    Get the up to date tag catalog of a store file.
+    New sidecar entries and tombstones are read incrementally; records appended to the store without being cataloged
+    are cataloged, and the sidecar is rebuilt from the store if it is missing or does not match it.
+
+    :param store: store file path
+    :param store_del: tombstone file path
+    :return: the _Catalog
+    """
+    with _index_lock:
+        return _refresh_catalog(store, store_del)
+
+
+def _refresh_catalog(store, store_del):
+    path = _catalog_path(store)
+    if not os.path.exists(path):
+        with _lock(store):
+            _write_catalog(store, _read_watermark(path))
+    inode = os.stat(path).st_ino
+    catalog = _catalogs.get(path)
+    snapshot_inode = _inode(_catalog_snapshot_path(store)) if _catalog_snapshot_every > 0 else None
+    if (catalog is None or catalog.inode != inode or _size(path) < catalog.pos
+            or _size(store_del) < catalog.del_pos or catalog.snapshot_inode != snapshot_inode):
+        catalog = _catalogs[path] = _Catalog(inode, _open_catalog_snapshot(store, store_del, inode))
+        catalog.snapshot_inode = snapshot_inode
+    # tombstones are read before the sidecar: every secret they forget is then already in it
+    tombstones = _read_tombstones(catalog, store_del)
+    _load_catalog(catalog, path)
+    if catalog.watermark != _size(store):
+        with _lock(store):
+            _write_catalog(store, _read_watermark(path))
+        if _catalogs.get(path) is not catalog:  # rewritten
+            return _refresh_catalog(store, store_del)
+        _load_catalog(catalog, path)
+    for username, secret_id in tombstones:
+        catalog.discard(secret_id, username)
+    if _catalog_snapshot_every > 0 and catalog.changes >= _catalog_snapshot_every:
+        with _lock(store):
+            if _inode(_catalog_snapshot_path(store)) == snapshot_inode:  # not rewritten by another process meanwhile
+                _write_catalog_snapshot(store, catalog)
+        return _refresh_catalog(store, store_del)
+    return catalog
+
+
+def _open_catalog_snapshot(store, store_del, inode):
+    """
+    Map the snapshot of the tag catalog of a store file, if it has one matching its sidecar.
+
+    :param store: store file path
+    :param store_del: tombstone file path
+    :param inode: inode of the tag catalog sidecar
+    :return: the _CatalogSnapshot, None if there is none, or it is stale or unreadable
+    """
+    if _catalog_snapshot_every <= 0:
+        return None
+    try:
+        snapshot = _CatalogSnapshot(_catalog_snapshot_path(store))
+    except (OSError, ValueError, struct.error):
+        return None
+    if (snapshot.tags_inode != inode or snapshot.tags_pos > _size(_catalog_path(store))
+            or snapshot.watermark > _size(store) or snapshot.del_pos > _size(store_del)):
+        return None
+    return snapshot
+
+
+def _write_catalog_snapshot(store, catalog):
+    """
+    Write a tag catalog to the snapshot of a store file's catalog, swapped in by rename so that processes still mapping
+    the previous one are unaffected. Must be called holding the store's lock.
+
+    :param store: store file path
+    :param catalog: the up to date _Catalog
+    """
+    numbers, tags, secrets = {}, [], []
+    for secret_id, username, key in catalog.items():
+        number = numbers.get((username, key))
+        if number is None:
+            number = numbers[username, key] = len(tags)
+            tags.append([username, key, 0])
+        tags[number][2] += 1
+        secrets.append((secret_id.encode("utf-8"), number))
+    secrets.sort()
+    blob = "".join("%s\t%s\t%d\n" % (username, key, count) for username, key, count in tags).encode("utf-8")
+    sid_offset = _CATALOG_HEADER.size + len(blob) + len(secrets) * _CATALOG_ENTRY.size
+    entries = []
+    for sid, number in secrets:
+        entries.append(_CATALOG_ENTRY.pack(sid_offset, len(sid), number))
+        sid_offset += len(sid)
+    path = _catalog_snapshot_path(store)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(_CATALOG_HEADER.pack(_CATALOG_MAGIC, catalog.inode, catalog.pos, catalog.watermark, catalog.del_pos,
+                                     len(blob), len(secrets)))
+        f.write(blob)
+        f.write(b"".join(entries))
+        f.write(b"".join(sid for sid, _number in secrets))
+    os.replace(tmp_path, path)
+
+
+def _write_catalog(store, watermark):
+    """
+    Catalog the records of a store file its tag catalog sidecar does not cover yet, or rewrite the sidecar if it does
+    not match the store. Must be called holding the store's lock.
+
+    :param store: store file path
+    :param watermark: number of store bytes covered by the sidecar, None to rewrite it
+    """
+    path = _catalog_path(store)
+    store_size = _size(store)
+    rewrite = watermark is None or watermark > store_size
+    if not rewrite and watermark == store_size:
+        return
+    lines = []
+    for offset, obj in _cursor(store, 0 if rewrite else watermark, body=False):
+        if offset >= store_size:
+            break
+        lines.append(_tag(obj))
+    lines.append("#%d\n" % store_size)
+    if rewrite:
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as tx:
+            tx.write("".join(lines))
+        os.replace(tmp_path, path)
+        _catalogs.pop(path, None)
+    else:
+        with open(path, "a") as tx:
+            tx.write("".join(lines))
+
+
+def _load_catalog(catalog, path):
+    with open(path, "rb") as tx:
+        tx.seek(catalog.pos)
+        data = tx.read()
+    # entries are only consumed along with the watermark written after them, which a concurrent append may not have
+    # reached yet
+    position = consumed = 0
+    pending = []
+    for line in data[:data.rfind(b"\n")].split(b"\n") if b"\n" in data else ():
+        position += len(line) + 1
+        if line.startswith(b"#"):
+            watermark = int(line[1:])
+            # entries ahead of a watermark already covered were written twice by racing writers
+            if watermark > catalog.watermark:
+                for secret_id, username, key in pending:
+                    catalog.add(secret_id, username, key)
+                catalog.watermark = watermark
+            pending = []
+            consumed = position
+        else:
+            pending.append(line.decode("utf-8").split("\t", 2))
+    catalog.pos += consumed
+
+
+def _read_tombstones(catalog, store_del):
+    if _size(store_del) <= catalog.del_pos:
+        return []
+    with open(store_del, "rb") as d:
+        d.seek(catalog.del_pos)
+        data = d.read()
+    end = data.rfind(b"\n") + 1
+    catalog.del_pos += end
+    return [row for row in csv.reader(data[:end].decode("utf-8").split("\n")[:-1]) if len(row) == 2]
+
+
+def reindex_content(tokenize):
+    """
+    Rebuild the content index sidecars of every shard from the secrets' content.
+
+    :param tokenize: function taking a secret's content and returning its content keys
+    :return: number of secrets indexed
+    """
+    indexed = 0
+    for store, _store_del in _shards():
+        path = _content_index_path(store)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with _lock(store):
+            store_size = _size(store)
+            with open(tmp_path, "w") as cx:
+                for offset, obj in _cursor(store):
+                    if offset >= store_size:
+                        break
+                    cx.write("".join(_postings(offset, obj, tokenize(obj.secret))))
+                    indexed += 1
+                cx.write("#%d\n" % store_size)
+            os.replace(tmp_path, path)
+            _indexes.pop(path, None)
+    return indexed
+
+
+def _load_postings(index, idx_path):
+    with open(idx_path, "rb") as ix:
+        ix.seek(index.pos)
+        data = ix.read()
+    end = data.rfind(b"\n") + 1
+    index.pos += end
+    pending = []
+    # lines end with "\n" only, keys may hold other characters str.splitlines() would break them on
+    for line in data[:end].decode("utf-8").split("\n")[:-1]:
+        if line.startswith("#"):
+            watermark = int(line[1:])
+            # postings ahead of a watermark already covered were written twice by racing writers
+            if watermark > index.watermark:
+                for offset, word in pending:
+                    index.postings.setdefault(word, []).append(offset)
+                index.records += len({offset for offset, _word in pending})
+                index.watermark = watermark
+            pending = []
+        else:
+            offset, word = line.split("\t", 1)
+            pending.append((int(offset), word))
+
+
+def _reindex(store):
+    """
+    Rebuild the index sidecar of a store file from the store.
+
+    :param store: store file path
+    :return: the rebuilt _Index
+    """
+    with _index_lock:
+        return _rebuild_index(store)
+
+
+def _rebuild_index(store):
+    idx_path = _index_path(store)
+    tmp_path = "%s.%d.tmp" % (idx_path, os.getpid())
+    with _lock(store):
+        store_size = _size(store)
+        with open(tmp_path, "w") as ix:
+            for offset, obj in _cursor(store, body=False):
+                if offset >= store_size:
+                    break
+                ix.write("".join(_postings(offset, obj)))
+            ix.write("#%d\n" % store_size)
+        os.replace(tmp_path, idx_path)
+        _drop_snapshot(store)
+        _indexes.pop(idx_path, None)
+        return _index(store)
+
+
+def _shard_store(source, source_del, batch_size=1000):
+    """
+    Copy the live secrets of a single file store into the sharded store, streaming them in batches.
+
+    :param source: single store file path
+    :param source_del: single store tombstone file path
+    :param batch_size: number of secrets buffered before they are written to their shards
+    :return: number of secrets copied
+    """
+    tombstones = set()
+    if os.path.exists(source_del):
+        with open(source_del, "r") as d:
+            tombstones = set(tuple(row) for row in csv.reader(d))
+    os.makedirs(_store, exist_ok=True)
+    copied, pending, by_shard = 0, 0, {}
+    for _offset, obj in _cursor(source):
+        if (obj.username or '', obj.sid) in tombstones:
+            continue
+        by_shard.setdefault(_shard(obj.username)[0], []).append(obj)
+        pending += 1
+        if pending == batch_size:
+            copied += _flush_shards(by_shard)
+            pending = 0
+    return copied + _flush_shards(by_shard)
+
+
+def _flush_shards(by_shard):
+    copied = 0
+    for store, entries in by_shard.items():
+        _append(store, entries)
+        copied += len(entries)
+    by_shard.clear()
+    return copied
 
 
 class TestFilestore:
@@ -226,3 +1692,44 @@ class TestFilestore:
         put(secret, key, key.split(), key.split(), TestFilestore.username)
         keys = get_keys(TestFilestore.username)
         assert key in keys
+
+    def test_put_many(self):
+        key = "batch"
+        ids = put_many([(secret, key, [key, ], [key, ], TestFilestore.username) for secret in ("one", "two")])
+        result = get(key, TestFilestore.username)
+        assert [r[0] for r in result] == ids and [r[2] for r in result] == ["one", "two"]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m src.stores.file", description="File store maintenance")
+    parser.add_argument('command', choices=["reindex", "reindex-content", "vacuum", "shard", "convert"],
+                        help="reindex: rebuild the index and tag catalog sidecars from the store, "
+                             "reindex-content: rebuild the content index sidecars from the secrets' content, "
+                             "vacuum: drop forgotten secrets from the store, "
+                             "shard: copy a single file store into the sharded layout, "
+                             "convert: rewrite text records in the binary record format")
+    args = parser.parse_args()
+
+    if args.command == "reindex":
+        for store, store_del in _shards():
+            _reindex(store)
+            print("Index rebuilt: %s" % _index_path(store))
+            with _lock(store):
+                _write_catalog(store, None)
+            print("Tag catalog rebuilt: %s" % _catalog_path(store))
+    elif args.command == "reindex-content":
+        from src import da
+
+        print("Indexed the content of %d secrets" % reindex_content(da.tokenize))
+    elif args.command == "vacuum":
+        print("Dropped %d forgotten secrets from %s" % (_vacuum(), _store))
+    elif args.command == "shard":
+        _layout, _store = "sharded", _sharded_store
+        if _shards():
+            parser.exit(1, "%s already holds shards\n" % _store)
+        copied = _shard_store(_single_store, _single_store + ".deleted")
+        print("Copied %d secrets from %s to %s" % (copied, _single_store, _store))
+    elif args.command == "convert":
+        print("Converted %d store files" % _convert())
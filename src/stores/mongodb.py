@@ -2,15 +2,53 @@ import os
 from datetime import datetime
 
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import BulkWriteError
+
+from src import metrics
+from src.stores import clauses
 
 _ns = os.environ.get('DUDE_NAMESPACE', 'default')
-_client = MongoClient(os.environ.get('DUDE_MDB_URI', "mongodb://localhost:27017/"))
-_db = _client[os.environ.get('DUDE_MDB_NAME', "dude") + "_" + _ns]
-_collection = _db[os.environ.get('DUDE_MDB_COLLECTION', "secrets")]
+_collection = None  # connected on first use, see _secrets
+
+
+def _secrets():
+    """
+    Get the secrets collection, connecting to MongoDB and ensuring its indexes on first use.
+
+    :return: the collection
+    """
+    global _collection
+    if _collection is None:
+        client = MongoClient(os.environ.get('DUDE_MDB_URI', "mongodb://localhost:27017/"))
+        db = client[os.environ.get('DUDE_MDB_NAME', "dude") + "_" + _ns]
+        _collection = db[os.environ.get('DUDE_MDB_COLLECTION', "secrets")]
+        _ensure_indexes(_collection)
+    return _collection
+
+
+def _ensure_indexes(collection):
+    # all_keys serves get, key serves get_keys, content_terms serves search
+    collection.create_index([("username", ASCENDING), ("all_keys", ASCENDING)])
+    collection.create_index([("username", ASCENDING), ("key", ASCENDING)])
+    collection.create_index([("username", ASCENDING), ("content_terms", ASCENDING)], sparse=True)
+
+
+def _record(secret, orig_key, derived_keys, stemmed_keys, username, insert_ts, content_keys=None):
+    record = {"in_ts": insert_ts, "derived_keys": derived_keys, "stemmed_keys": stemmed_keys,
+              "all_keys": _all_keys(orig_key, derived_keys, stemmed_keys)}
+    if content_keys is not None:
+        record["content_terms"] = sorted(content_keys)
+    filter = {"username": username, "key": orig_key, "secret": secret}
+    record.update(filter)
+    return record
 
 
-def put(secret, orig_key, derived_keys, stemmed_keys, username):
+def _all_keys(orig_key, derived_keys, stemmed_keys):
+    return sorted({orig_key}.union(derived_keys, stemmed_keys))
+
+
+def put(secret, orig_key, derived_keys, stemmed_keys, username, content_keys=None):
     """
     Put a secret in store along with its key and derived keys.
 
@@ -19,45 +57,234 @@ def put(secret, orig_key, derived_keys, stemmed_keys, username):
     :param derived_keys: split key words
     :param stemmed_keys: stemmed key words
     :param username: user name
+    :param content_keys: words and stems of the secret content to index for search, None to leave it unsearchable
+    """
+    record = _record(secret, orig_key, derived_keys, stemmed_keys, username, datetime.utcnow(), content_keys)
+    db_response = _secrets().insert_one(record)
+    return str(db_response.inserted_id)
+
+
+def put_many(items, content_keys=None):
+    """
+    Put a batch of secrets in store with a single insert.
+
+    :param items: iterable of tuples containing the arguments of put: secret, original key, derived keys, stemmed keys
+    and user name
+    :param content_keys: list of the content keys of every secret (see put), in input order
+    :return: a list of the secrets' IDs, in input order
     """
     insert_ts = datetime.utcnow()
-    record = {"in_ts": insert_ts, "derived_keys": derived_keys, "stemmed_keys": stemmed_keys}
-    filter = {"username": username, "key": orig_key, "secret": secret}
-    record.update(filter)
-    # db_response = _collection.replace_one(filter, record, upsert=True)
-    db_response = _collection.insert(record)
-    return str(db_response)
+    items = list(items)
+    records = [_record(secret, orig_key, derived_keys, stemmed_keys, username, insert_ts, keys)
+               for (secret, orig_key, derived_keys, stemmed_keys, username), keys
+               in zip(items, content_keys or [None] * len(items))]
+    if not records:
+        return []
+    db_response = _secrets().insert_many(records)
+    return [str(_id) for _id in db_response.inserted_ids]
+
+
+def get(key, username, match_all=True):
+    """
+    Get a collection of secrets associated with the key, with a single query on the (username, all_keys) index.
 
+    :param key: the key, or a list of clauses of alternative keys (see src.stores.clauses)
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: a list of tuples containing the following: secret ID, key, secret, timestamp
+    """
+    return list(iter_get(key, username, match_all))
+
+
+def iter_get(key, username, match_all=True, batch_size=100):
+    """
+    Get the secrets associated with the key one at a time (see get), fetched from MongoDB in batches.
+
+    :param key: the key, or a list of clauses of alternative keys (see src.stores.clauses)
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :param batch_size: number of documents fetched per round trip
+    :return: generator of tuples containing the following: secret ID, key, secret, timestamp
+    """
+    return _find(_condition("all_keys", key, username, match_all), batch_size)
+
+
+def search(key, username, match_all=True):
+    """
+    Get the secrets whose content has the words, with a query on the (username, content_terms) index. Secrets kept
+    without content keys (see put) are not found.
+
+    :param key: the words, or a list of clauses of alternative words (see src.stores.clauses)
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: a list of tuples containing the following: secret ID, key, secret, timestamp
+    """
+    return list(_find(_condition("content_terms", key, username, match_all)))
+
+
+def _condition(field, key, username, match_all):
+    condns = [{field: {"$in": sorted(clause)}} for clause in clauses(key)]
+    if match_all:
+        return {"$and": condns, "username": username}
+    return {field: {"$in": sorted(set().union(*clauses(key)))}, "username": username}
+
+
+def _find(condn, batch_size=100):
+    matched = 0
+    try:
+        for record in _secrets().find(condn, {"secret": 1, "key": 1, "in_ts": 1, "_id": 1}).batch_size(batch_size):
+            matched += 1
+            yield str(record['_id']), record['key'], record['secret'], record['in_ts']
+    finally:
+        metrics.inc("dude_records_matched_total", matched, store="mongodb")
 
-def get(key, username):
-    condn = {"$or": [{"key": key},
-                     {"derived_keys": {"$elemMatch": {"$eq": key}}},
-                     {"stemmed_keys": {"$elemMatch": {"$eq": key}}},
-                     ],
-             "username": username
-             }
-    record_set = []
-    for record in _collection.find(condn, {"secret": 1, "key": 1, "in_ts": 1, "_id": 1}):
-        record_set.append((str(record['_id']), record['key'], record['secret'], record['in_ts']))
-    return record_set
 
+def get_keys(username, after=None, limit=None):
+    """
+    Get a collection of keys (tags) that have a score of 1 - essentially keys input by end-user while storing secrets.
+    Distinct keys are read off the (username, key) index rather than from every secret of the user.
 
-def get_keys(username):
+    :param username: user name
+    :param after: only return the keys sorting after this one, to get the next page
+    :param limit: maximum number of keys to return, all of them if None
+    :return: a sorted list of distinct absolute keys
+    """
     condn = {"username": username}
-    record_set = set()
-    for record in _collection.find(condn, {"key": 1, "_id": 1}):
-        record_set.add(record['key'])
-    return list(record_set)
+    if after is not None:
+        condn["key"] = {"$gt": after}
+    keys = sorted(_secrets().distinct("key", condn))[:limit]
+    metrics.inc("dude_records_matched_total", len(keys), store="mongodb")
+    return keys
+
+
+def get_terms(username):
+    """
+    Get the keys of every secret of a user: original key, derived and stemmed keys.
+
+    :param username: user name
+    :return: generator of tuples containing secret ID and set of keys
+    """
+    projection = {"all_keys": 1, "key": 1, "derived_keys": 1, "stemmed_keys": 1, "_id": 1}
+    for record in _secrets().find({"username": username}, projection):
+        if 'all_keys' not in record:  # stored before all_keys existed, see migrate
+            record['all_keys'] = _all_keys(record['key'], record.get('derived_keys', []),
+                                           record.get('stemmed_keys', []))
+        yield str(record['_id']), set(record['all_keys'])
+
+
+def version(username):
+    """
+    Get a token of the state of a user's secrets. MongoDB can't tell when a user's documents last changed without a
+    query as costly as the ones cached.
+
+    :param username: user name
+    :return: None
+    """
+    return None
+
+
+def iter_records(batch_size=1000):
+    """
+    Walk every secret, of every user, for export.
+
+    :param batch_size: number of documents fetched per round trip
+    :return: generator of dicts holding the sid, username, key, derived_keys, stemmed_keys, secret and in_ts of a secret
+    """
+    projection = {"username": 1, "key": 1, "derived_keys": 1, "stemmed_keys": 1, "secret": 1, "in_ts": 1}
+    for record in _secrets().find({}, projection).batch_size(batch_size):
+        yield {"sid": str(record['_id']), "username": record['username'], "key": record['key'],
+               "derived_keys": record.get('derived_keys', []), "stemmed_keys": record.get('stemmed_keys', []),
+               "secret": record['secret'], "in_ts": record['in_ts']}
+
+
+def restore_many(records, content_keys=None):
+    """
+    Put a batch of exported secrets back in store with a single insert, keeping their IDs and timestamps (see
+    iter_records). Secrets already in store are skipped, so an interrupted import can be run again.
+
+    :param records: list of dicts as yielded by iter_records
+    :param content_keys: list of the content keys of every secret (see put), in input order
+    :return: number of secrets put
+    """
+    documents = []
+    for record, keys in zip(records, content_keys or [None] * len(records)):
+        document = _record(record['secret'], record['key'], record['derived_keys'], record['stemmed_keys'],
+                           record['username'], record['in_ts'], keys)
+        document['_id'] = _object_id(record['sid'])
+        documents.append(document)
+    if not documents:
+        return 0
+    try:
+        return len(_secrets().insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):  # other than duplicate keys
+            raise
+        return e.details['nInserted']
+
+
+def _object_id(secret_id):
+    # secrets imported from other stores keep their IDs, which aren't necessarily ObjectIds
+    return ObjectId(secret_id) if ObjectId.is_valid(secret_id) else secret_id
 
 
 def remove(secret_id, username):
-    condn = {"_id": ObjectId(secret_id), "username": username}
-    return _collection.remove(condn)
+    condn = {"_id": _object_id(secret_id), "username": username}
+    _secrets().delete_one(condn)
 
 
-def remove_all(username):
+def remove_many(secret_ids, username):
+    condn = {"_id": {"$in": [_object_id(secret_id) for secret_id in secret_ids]}, "username": username}
+    _secrets().delete_many(condn)
+
+
+def remove_where(username, key=None, older_than=None):
+    """
+    Forget the secrets of a user matching conditions, all of them if none is given, in a single delete_many.
+
+    :param username: user name
+    :param key: only forget the secrets kept under this original key
+    :param older_than: only forget the secrets kept before this datetime
+    :return: number of secrets forgotten
+    """
     condn = {"username": username}
-    return _collection.remove(condn)
+    if key is not None:
+        condn["key"] = key
+    if older_than is not None:
+        condn["in_ts"] = {"$lt": older_than}
+    return _secrets().delete_many(condn).deleted_count
+
+
+def remove_all(username):
+    remove_where(username)
+
+
+def reindex_content(tokenize):
+    """
+    Set the content_terms field of every secret from its content.
+
+    :param tokenize: function taking a secret's content and returning its content keys
+    :return: number of secrets indexed
+    """
+    collection = _secrets()
+    indexed = 0
+    for record in collection.find({}, {"secret": 1}):
+        collection.update_one({"_id": record['_id']}, {"$set": {"content_terms": sorted(tokenize(record['secret']))}})
+        indexed += 1
+    return indexed
+
+
+def migrate():
+    """
+    Backfill the all_keys field of secrets stored before it existed. The indexes are ensured on connection.
+
+    :return: number of documents updated
+    """
+    collection = _secrets()
+    updated = 0
+    for record in collection.find({"all_keys": {"$exists": False}}, {"key": 1, "derived_keys": 1, "stemmed_keys": 1}):
+        all_keys = _all_keys(record['key'], record.get('derived_keys', []), record.get('stemmed_keys', []))
+        updated += collection.update_one({"_id": record['_id']}, {"$set": {"all_keys": all_keys}}).modified_count
+    return updated
 
 
 class TestMongodb:
@@ -122,3 +349,26 @@ class TestMongodb:
         put(secret, key, key.split(), key.split(), TestMongodb.username)
         keys = get_keys(TestMongodb.username)
         assert key in keys
+
+    def test_put_many(self):
+        key = "batch"
+        ids = put_many([(secret, key, [key, ], [key, ], TestMongodb.username) for secret in ("one", "two")])
+        result = get(key, TestMongodb.username)
+        assert [r[0] for r in result] == ids and [r[2] for r in result] == ["one", "two"]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m src.stores.mongodb", description="MongoDB store maintenance")
+    parser.add_argument('command', choices=["migrate", "reindex-content"],
+                        help="migrate: create indexes and backfill the all_keys field of existing secrets, "
+                             "reindex-content: index the content of every secret for search")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        print("Migrated %d secrets" % migrate())
+    elif args.command == "reindex-content":
+        from src import da
+
+        print("Indexed the content of %d secrets" % reindex_content(da.tokenize))
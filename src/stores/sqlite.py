@@ -0,0 +1,431 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+from src import metrics
+from src.stores import clauses
+
+_ns = os.environ.get('DUDE_NAMESPACE', 'default')
+_db = os.environ.get('DUDE_SQLITE_DB', 'dude.sqlite') + "_" + _ns
+# one connection per thread, sqlite3 connections can't be shared between threads
+_local = threading.local()
+# secret IDs per statement of a bulk delete, below SQLite's limit of bound parameters
+_BATCH = 500
+# PRAGMA user_version of databases whose content rows have the rowid of their secret
+_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS secrets (
+    sid TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    key TEXT NOT NULL,
+    derived_keys TEXT NOT NULL,
+    stemmed_keys TEXT NOT NULL,
+    secret TEXT NOT NULL,
+    in_ts TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS secrets_username_key ON secrets (username, key);
+-- every key a secret is found by: original key, derived and stemmed keys
+CREATE TABLE IF NOT EXISTS secret_keys (
+    sid TEXT NOT NULL REFERENCES secrets (sid) ON DELETE CASCADE,
+    username TEXT NOT NULL,
+    key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS secret_keys_username_key ON secret_keys (username, key);
+CREATE INDEX IF NOT EXISTS secret_keys_sid ON secret_keys (sid);
+-- distinct original keys of every user with the number of secrets kept under them, maintained by the triggers below
+CREATE TABLE IF NOT EXISTS tags (
+    username TEXT NOT NULL,
+    key TEXT NOT NULL,
+    secrets INTEGER NOT NULL,
+    PRIMARY KEY (username, key)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS tags_insert AFTER INSERT ON secrets BEGIN
+    INSERT INTO tags VALUES (new.username, new.key, 1)
+        ON CONFLICT (username, key) DO UPDATE SET secrets = secrets + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS tags_delete AFTER DELETE ON secrets BEGIN
+    UPDATE tags SET secrets = secrets - 1 WHERE username = old.username AND key = old.key;
+    DELETE FROM tags WHERE username = old.username AND key = old.key AND secrets <= 0;
+END;
+-- number of secrets of every user kept or forgotten so far, see version
+CREATE TABLE IF NOT EXISTS versions (
+    username TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS versions_insert AFTER INSERT ON secrets BEGIN
+    INSERT INTO versions VALUES (new.username, 1) ON CONFLICT (username) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS versions_delete AFTER DELETE ON secrets BEGIN
+    INSERT INTO versions VALUES (old.username, 1) ON CONFLICT (username) DO UPDATE SET version = version + 1;
+END;
+-- content keys are derived by da, only whitespace separates them; rows have the rowid of their secret, which
+-- full-text tables can look up, unlike their other columns
+CREATE VIRTUAL TABLE IF NOT EXISTS secret_content USING fts5(
+    terms, sid UNINDEXED, username UNINDEXED, tokenize = "unicode61 tokenchars '.-_'"
+);
+"""
+
+
+def _connection():
+    """
+    Get this thread's connection to the database, opening it and creating the schema on first use.
+
+    :return: the sqlite3 connection
+    """
+    connection = getattr(_local, "connection", None)
+    if connection is None or _local.path != _db:
+        connection = sqlite3.connect(_db, timeout=30)
+        connection.execute("PRAGMA journal_mode = WAL")  # readers don't wait for writers
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.executescript(_SCHEMA)
+        with connection:
+            # databases created before the tags table existed
+            empty = "SELECT NOT EXISTS (SELECT 1 FROM tags) AND EXISTS (SELECT 1 FROM secrets)"
+            if connection.execute(empty).fetchone()[0]:
+                connection.execute("INSERT INTO tags SELECT username, key, COUNT(*) FROM secrets "
+                                   "GROUP BY username, key")
+        if connection.execute("PRAGMA user_version").fetchone()[0] < _VERSION:
+            with connection:
+                # databases whose content rows were numbered on their own
+                rows = connection.execute("SELECT s.rowid, c.terms, c.sid, c.username FROM secret_content c "
+                                          "JOIN secrets s ON s.sid = c.sid").fetchall()
+                connection.execute("DELETE FROM secret_content")
+                connection.executemany("INSERT INTO secret_content (rowid, terms, sid, username) VALUES (?, ?, ?, ?)",
+                                       rows)
+                connection.execute("PRAGMA user_version = %d" % _VERSION)
+        _local.connection, _local.path = connection, _db
+    return connection
+
+
+def _row(secret, orig_key, derived_keys, stemmed_keys, username, secret_id=None, insert_ts=None):
+    return (secret_id or str(uuid.uuid4()), username or '', orig_key, json.dumps(list(derived_keys)),
+            json.dumps(list(stemmed_keys)), secret, (insert_ts or datetime.utcnow()).isoformat())
+
+
+def _insert(connection, rows, content_keys, ignore=False):
+    """
+    Insert secrets along with their keys and content keys, in the caller's transaction.
+
+    :return: number of secrets inserted
+    """
+    inserted = 0
+    verb = "INSERT OR IGNORE" if ignore else "INSERT"
+    for row, keys in zip(rows, content_keys or [None] * len(rows)):
+        cursor = connection.execute(verb + " INTO secrets VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+        if not cursor.rowcount:
+            continue  # already there
+        inserted += 1
+        sid, username, orig_key = row[:3]
+        all_keys = {orig_key}.union(json.loads(row[3]), json.loads(row[4]))
+        connection.executemany("INSERT INTO secret_keys VALUES (?, ?, ?)", [(sid, username, k) for k in all_keys])
+        if keys is not None:
+            connection.execute("INSERT INTO secret_content (rowid, terms, sid, username) VALUES (?, ?, ?, ?)",
+                               (cursor.lastrowid, " ".join(sorted(keys)), sid, username))
+    return inserted
+
+
+def put(secret, orig_key, derived_keys, stemmed_keys, username, content_keys=None):
+    """
+    Put a secret in store along with its key and derived keys.
+
+    :param secret: secret content
+    :param orig_key: original key
+    :param derived_keys: split key words
+    :param stemmed_keys: stemmed key words
+    :param username: user name
+    :param content_keys: words and stems of the secret content to index for search, None to leave it unsearchable
+    """
+    row = _row(secret, orig_key, derived_keys, stemmed_keys, username)
+    connection = _connection()
+    with connection:
+        _insert(connection, [row], [content_keys])
+    return row[0]
+
+
+def put_many(items, content_keys=None):
+    """
+    Put a batch of secrets in store in a single transaction.
+
+    :param items: iterable of tuples containing the arguments of put: secret, original key, derived keys, stemmed keys
+    and user name
+    :param content_keys: list of the content keys of every secret (see put), in input order
+    :return: a list of the secrets' IDs, in input order
+    """
+    rows = [_row(*item) for item in items]
+    connection = _connection()
+    with connection:
+        _insert(connection, rows, content_keys)
+    return [row[0] for row in rows]
+
+
+def get(key, username, match_all=True):
+    """
+    Get a collection of secrets associated with the key, looked up on the (username, key) index of secret_keys.
+
+    :param key: the key, or a list of clauses of alternative keys (see src.stores.clauses)
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: a list of tuples containing the following: secret ID, key, secret, timestamp
+    """
+    return list(iter_get(key, username, match_all))
+
+
+def iter_get(key, username, match_all=True):
+    """
+    Get the secrets associated with the key one at a time (see get), as the query steps through them.
+
+    :param key: the key, or a list of clauses of alternative keys (see src.stores.clauses)
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: generator of tuples containing the following: secret ID, key, secret, timestamp
+    """
+    key_clauses = clauses(key)
+    if not key_clauses:
+        return iter(())
+    if not match_all:
+        key_clauses = [set().union(*key_clauses)]
+    subquery = "sid IN (SELECT sid FROM secret_keys WHERE username = ? AND key IN (%s))"
+    conditions, params = [], [username or '']
+    for clause in key_clauses:
+        conditions.append(subquery % ", ".join("?" * len(clause)))
+        params.extend([username or ''] + sorted(clause))
+    joint = " AND " if match_all else " OR "
+    return _find("SELECT sid, key, secret, in_ts FROM secrets WHERE username = ? AND (%s) ORDER BY rowid"
+                 % joint.join(conditions), params)
+
+
+def search(key, username, match_all=True):
+    """
+    Get the secrets whose content has the words, through the secret_content full-text index. Secrets kept without
+    content keys (see put) are not found.
+
+    :param key: the words, or a list of clauses of alternative words (see src.stores.clauses)
+    :param username: user name
+    :param match_all: whether secrets must satisfy all the clauses, or any of them
+    :return: a list of tuples containing the following: secret ID, key, secret, timestamp
+    """
+    key_clauses = clauses(key)
+    if not key_clauses:
+        return []
+    expression = (" AND " if match_all else " OR ").join(
+        "(%s)" % " OR ".join('"%s"' % k.replace('"', '""') for k in sorted(clause)) for clause in key_clauses)
+    return list(_find("SELECT s.sid, s.key, s.secret, s.in_ts FROM secret_content c "
+                      "JOIN secrets s ON s.rowid = c.rowid "
+                      "WHERE secret_content MATCH ? AND c.username = ? ORDER BY s.rowid",
+                      [expression, username or '']))
+
+
+def _find(query, params):
+    matched = 0
+    try:
+        for sid, key, secret, in_ts in _connection().execute(query, params):
+            matched += 1
+            yield sid, key, secret, datetime.fromisoformat(in_ts)
+    finally:
+        metrics.inc("dude_records_matched_total", matched, store="sqlite")
+
+
+def get_keys(username, after=None, limit=None):
+    """
+    Get a collection of keys (tags) that have a score of 1 - essentially keys input by end-user while storing secrets.
+    Keys come from the tags table, so this costs time proportional to the user's number of keys, not of secrets.
+
+    :param username: user name
+    :param after: only return the keys sorting after this one, to get the next page
+    :param limit: maximum number of keys to return, all of them if None
+    :return: a sorted list of distinct absolute keys
+    """
+    query = "SELECT key FROM tags WHERE username = ? AND (? IS NULL OR key > ?) ORDER BY key LIMIT ?"
+    params = (username or '', after, after, limit if limit is not None else -1)
+    return [key for key, in _connection().execute(query, params)]
+
+
+def get_terms(username):
+    """
+    Get the keys of every secret of a user: original key, derived and stemmed keys.
+
+    :param username: user name
+    :return: generator of tuples containing secret ID and set of keys
+    """
+    terms = {}
+    for sid, key in _connection().execute("SELECT sid, key FROM secret_keys WHERE username = ?", (username or '',)):
+        terms.setdefault(sid, set()).add(key)
+    return iter(terms.items())
+
+
+def version(username):
+    """
+    Get a token of the state of a user's secrets, which changes whenever they may have: the versions table counts the
+    writes to every user's secrets.
+
+    :param username: user name
+    :return: hashable token
+    """
+    row = _connection().execute("SELECT version FROM versions WHERE username = ?", (username or '',)).fetchone()
+    return row[0] if row else 0
+
+
+def remove(secret_id, username):
+    """
+    Forget a secret.
+
+    :param secret_id: secret's ID
+    :param username: user name
+    """
+    connection = _connection()
+    with connection:
+        _delete(connection, "username = ? AND sid = ?", [username or '', str(secret_id)])
+
+
+def remove_many(secret_ids, username):
+    """
+    Forget a batch of secrets in a single transaction.
+
+    :param secret_ids: secrets' IDs
+    :param username: user name
+    """
+    secret_ids = [str(secret_id) for secret_id in secret_ids]
+    connection = _connection()
+    with connection:
+        for i in range(0, len(secret_ids), _BATCH):
+            batch = secret_ids[i:i + _BATCH]
+            _delete(connection, "username = ? AND sid IN (%s)" % ", ".join("?" * len(batch)), [username or ''] + batch)
+
+
+def remove_where(username, key=None, older_than=None):
+    """
+    Forget the secrets of a user matching conditions, all of them if none is given, in a single transaction.
+
+    :param username: user name
+    :param key: only forget the secrets kept under this original key
+    :param older_than: only forget the secrets kept before this datetime
+    :return: number of secrets forgotten
+    """
+    condition, params = "username = ?", [username or '']
+    if key is not None:
+        condition += " AND key = ?"
+        params.append(key)
+    if older_than is not None:
+        condition += " AND in_ts < ?"
+        params.append(older_than.isoformat())
+    connection = _connection()
+    with connection:
+        return _delete(connection, condition, params)
+
+
+def _delete(connection, condition, params):
+    # keys go along through ON DELETE CASCADE, the full-text index has no foreign keys
+    connection.execute("DELETE FROM secret_content WHERE rowid IN (SELECT rowid FROM secrets WHERE %s)" % condition,
+                       params)
+    return connection.execute("DELETE FROM secrets WHERE %s" % condition, params).rowcount
+
+
+def remove_all(username):
+    """
+    Forget all the secrets of a user.
+
+    :param username: user name
+    """
+    remove_where(username)
+
+
+def iter_records():
+    """
+    Walk every secret, of every user, for export.
+
+    :return: generator of dicts holding the sid, username, key, derived_keys, stemmed_keys, secret and in_ts of a secret
+    """
+    query = "SELECT sid, username, key, derived_keys, stemmed_keys, secret, in_ts FROM secrets ORDER BY rowid"
+    for sid, username, key, derived_keys, stemmed_keys, secret, in_ts in _connection().execute(query):
+        yield {"sid": sid, "username": username or None, "key": key, "derived_keys": json.loads(derived_keys),
+               "stemmed_keys": json.loads(stemmed_keys), "secret": secret, "in_ts": datetime.fromisoformat(in_ts)}
+
+
+def restore_many(records, content_keys=None):
+    """
+    Put a batch of exported secrets back in store in a single transaction, keeping their IDs and timestamps (see
+    iter_records). Secrets already in store are skipped, so an interrupted import can be run again.
+
+    :param records: list of dicts as yielded by iter_records
+    :param content_keys: list of the content keys of every secret (see put), in input order
+    :return: number of secrets put
+    """
+    rows = [_row(r["secret"], r["key"], r["derived_keys"], r["stemmed_keys"], r["username"], str(r["sid"]), r["in_ts"])
+            for r in records]
+    connection = _connection()
+    with connection:
+        return _insert(connection, rows, content_keys, ignore=True)
+
+
+def reindex_content(tokenize):
+    """
+    Rebuild the full-text index of the content of every secret.
+
+    :param tokenize: function taking a secret's content and returning its content keys
+    :return: number of secrets indexed
+    """
+    connection = _connection()
+    indexed = 0
+    with connection:
+        connection.execute("DELETE FROM secret_content")
+        rows = connection.execute("SELECT rowid, sid, username, secret FROM secrets").fetchall()
+        for rowid, sid, username, secret in rows:
+            connection.execute("INSERT INTO secret_content (rowid, terms, sid, username) VALUES (?, ?, ?, ?)",
+                               (rowid, " ".join(sorted(tokenize(secret))), sid, username))
+            indexed += 1
+    return indexed
+
+
+class TestSqlite:
+    @classmethod
+    def setup_class(cls):
+        global _db
+        cls.db = _db
+        _db = "_testsqlite.db"
+        cls.username = "__tE5tE7__"
+
+    @classmethod
+    def teardown_class(cls):
+        global _db
+        _local.connection.close()
+        _local.connection = None
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(_db + suffix):
+                os.remove(_db + suffix)
+        _db = cls.db
+
+    def test_put_get(self):
+        key, secret = "sqlite", "embedded db"
+        put(secret, key, [key, ], [key, ], TestSqlite.username)
+        record = get(key, TestSqlite.username)[0]
+        assert record[2] == secret
+
+    def test_remove(self):
+        key, secret = "perishable", "earth"
+        _id = put(secret, key, [key, ], [key, ], TestSqlite.username)
+        put(secret, key, [key, ], [key, ], TestSqlite.username + "_1")
+        remove(_id, TestSqlite.username)
+        assert len(get(key, TestSqlite.username)) == 0 and len(get(key, TestSqlite.username + "_1")) == 1
+
+    def test_get_by_partial_key(self):
+        key, secret = "foo bar", "horse ranch"
+        put(secret, key, key.split(), key.split(), TestSqlite.username)
+        record = get(key.split()[1], TestSqlite.username)[0]
+        assert record[2] == secret
+
+    def test_get_by_stemmed_key(self):
+        key, secret = "running fox", "sleeping rabbit"
+        stemmed_keys = ["run", "fox"]
+        put(secret, key, key.split(), stemmed_keys, TestSqlite.username)
+        record = get(stemmed_keys[0], TestSqlite.username)[0]
+        assert record[2] == secret
+
+    def test_get_keys(self):
+        key, secret = "multi-word key", "ignored secret"
+        put(secret, key, key.split(), key.split(), TestSqlite.username)
+        assert key in get_keys(TestSqlite.username)
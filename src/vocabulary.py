@@ -0,0 +1,211 @@
+import bisect
+import threading
+import time
+
+
+def trigrams(word):
+    """
+    Character trigrams of a word, padded so that its first and last characters weigh as much as the others.
+
+    :param word: the word
+    :return: set of trigrams
+    """
+    padded = "  %s " % word
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def distance(a, b, bound):
+    """
+    Levenshtein distance between two words, given up on as soon as it exceeds a bound.
+
+    :param a: a word
+    :param b: another word
+    :param bound: largest distance of interest
+    :return: the distance, or bound + 1 if it is larger than bound
+    """
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > bound:
+            return bound + 1
+        previous = current
+    return previous[-1] if previous[-1] <= bound else bound + 1
+
+
+class _UserVocabulary:
+    __slots__ = ("words", "counts", "terms", "grams", "lengths", "expiry")
+
+    def __init__(self, expiry):
+        self.words = []  # sorted distinct keys
+        self.counts = {}  # key -> number of secrets having it
+        self.terms = {}  # secret ID -> keys
+        self.grams = None  # trigram -> keys having it, built on first typo-tolerant lookup
+        self.lengths = None  # length -> keys that long, along with grams
+        self.expiry = expiry
+
+    def similar(self, word, bound):
+        """
+        Keys within an edit distance of a word. Candidates share enough trigrams with the word to possibly be within
+        the distance (every edit changes at most 3 of them), only those are compared to it. Words too short for that
+        to rule any key out are compared to all the keys of a close enough length.
+
+        :param word: the word
+        :param bound: largest edit distance
+        :return: list of tuples containing the distance and the key, closest first
+        """
+        if self.grams is None:
+            self.grams, self.lengths = {}, {}
+            for key in self.counts:
+                self._index(key)
+        grams = trigrams(word)
+        threshold = len(grams) - 3 * bound
+        if threshold > 0:
+            shared = {}
+            for gram in grams:
+                for key in self.grams.get(gram, ()):
+                    shared[key] = shared.get(key, 0) + 1
+            candidates = [key for key, count in shared.items() if count >= threshold]
+        else:
+            candidates = [key for length in range(max(len(word) - bound, 0), len(word) + bound + 1)
+                          for key in self.lengths.get(length, ())]
+        matches = []
+        for key in candidates:
+            d = distance(word, key, bound)
+            if d <= bound:
+                matches.append((d, key))
+        return sorted(matches)
+
+    def _index(self, key):
+        for gram in trigrams(key):
+            self.grams.setdefault(gram, set()).add(key)
+        self.lengths.setdefault(len(key), set()).add(key)
+
+    def _unindex(self, key):
+        for gram in trigrams(key):
+            keys = self.grams.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.grams[gram]
+        self.lengths[len(key)].discard(key)
+
+    def add(self, secret_id, terms):
+        terms = frozenset(terms)
+        self.discard(secret_id)
+        self.terms[secret_id] = terms
+        for word in terms:
+            count = self.counts.get(word, 0)
+            if not count:
+                bisect.insort(self.words, word)
+                if self.grams is not None:
+                    self._index(word)
+            self.counts[word] = count + 1
+
+    def load(self, items):
+        # sorted once, rather than inserting every key in place
+        for secret_id, terms in items:
+            terms = self.terms[secret_id] = frozenset(terms)
+            for word in terms:
+                self.counts[word] = self.counts.get(word, 0) + 1
+        self.words = sorted(self.counts)
+
+    def discard(self, secret_id):
+        for word in self.terms.pop(secret_id, ()):
+            count = self.counts[word] - 1
+            if count:
+                self.counts[word] = count
+            else:
+                del self.counts[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+                if self.grams is not None:
+                    self._unindex(word)
+
+
+class Vocabulary:
+    """
+    Per-user sorted index of the keys of stored secrets (tags, derived words and stems), answering prefix lookups with
+    a binary search. A user's vocabulary is loaded from the store on first lookup, kept up to date by this process's
+    writes and reloaded once it expires, to pick up writes from other processes.
+    """
+
+    def __init__(self, loader, ttl):
+        """
+        :param loader: function taking a user name and returning an iterable of tuples containing a secret ID and its
+        keys
+        :param ttl: seconds a loaded vocabulary stays valid for
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self._users = {}  # username -> _UserVocabulary
+        self._lock = threading.Lock()
+
+    def complete(self, username, prefix, limit=None):
+        """
+        :param username: user name
+        :param prefix: beginning of the keys to look for
+        :param limit: maximum number of keys to return, all of them if None
+        :return: sorted list of the user's keys starting with prefix
+        """
+        vocabulary = self._vocabulary(username)
+        with self._lock:
+            words = vocabulary.words
+            matches = []
+            for i in range(bisect.bisect_left(words, prefix), len(words)):
+                if not words[i].startswith(prefix) or (limit is not None and len(matches) >= limit):
+                    break
+                matches.append(words[i])
+            return matches
+
+    def similar(self, username, word, bound, limit=None):
+        """
+        :param username: user name
+        :param word: a possibly misspelled key
+        :param bound: largest edit distance
+        :param limit: maximum number of keys to return, all of them if None
+        :return: list of the user's keys within the edit distance of word, closest first
+        """
+        vocabulary = self._vocabulary(username)
+        with self._lock:
+            return [key for _d, key in vocabulary.similar(word, bound)[:limit]]
+
+    def __contains__(self, user_word):
+        username, word = user_word
+        vocabulary = self._vocabulary(username)
+        with self._lock:
+            return word in vocabulary.counts
+
+    def add(self, username, secret_id, terms):
+        with self._lock:
+            vocabulary = self._users.get(username)
+            if vocabulary is not None:
+                vocabulary.add(secret_id, terms)
+
+    def remove(self, username, secret_id):
+        with self._lock:
+            vocabulary = self._users.get(username)
+            if vocabulary is not None:
+                vocabulary.discard(secret_id)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._users.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+    def _vocabulary(self, username):
+        with self._lock:
+            vocabulary = self._users.get(username)
+            if vocabulary is not None and vocabulary.expiry > time.monotonic():
+                return vocabulary
+        # loaded outside the lock, a concurrent load of the same user just wins or loses the race
+        vocabulary = _UserVocabulary(time.monotonic() + self.ttl)
+        vocabulary.load(self.loader(username))
+        with self._lock:
+            self._users[username] = vocabulary
+        return vocabulary
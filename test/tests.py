@@ -1,11 +1,50 @@
+import getpass
+import glob
+import io
+import json
+import multiprocessing
 import os
-from datetime import datetime
+import queue
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
-from src import da
+import pytest
+
+from src import da, daemon, metrics, migrate, stores, vocabulary
+from src.cache import QueryCache, WriteMarks
 from src.stores import file as filestore
+from src.stores import mongodb as mongostore
+from src.stores import sqlite as sqlitestore
 from src.stores.file import Secret
 
 
+def _index_scans(plan):
+    """
+    :param plan: query plan, as returned by explain
+    :return: set of the names of the indexes the plan scans
+    """
+    if isinstance(plan, list):
+        return set().union(*(_index_scans(p) for p in plan))
+    if not isinstance(plan, dict):
+        return set()
+    names = {plan["indexName"]} if plan.get("stage") in ("IXSCAN", "DISTINCT_SCAN") else set()
+    return names.union(*(_index_scans(value) for value in plan.values()))
+
+
+def _put_secrets(key, secret, count):
+    for i in range(count):
+        filestore.put("%s %d" % (secret, i), key, [key], [key], TestDA.username)
+
+
 class TestDA:
     @classmethod
     def setup_class(cls):
@@ -13,13 +52,15 @@ class TestDA:
         cls.username = '__tE5tE7__'
         open(cls.test_db, "w")
         open(cls.test_db + ".deleted", "w")
+        cls.stores = filestore._store, filestore._store_del
         filestore._store = cls.test_db
         filestore._store_del = cls.test_db + ".deleted"
 
     @classmethod
     def teardown_class(cls):
-        os.remove(cls.test_db)
-        os.remove(cls.test_db + ".deleted")
+        filestore._store, filestore._store_del = cls.stores
+        for path in glob.glob(cls.test_db + "*"):
+            os.remove(path)
 
     def test_secret_serialize(self):
         secret = Secret()
@@ -66,6 +107,67 @@ class TestDA:
         keys = da.list_absolute_keys(TestDA.username)
         assert k.lower() in keys
 
+    def test_tag_catalog(self):
+        username = TestDA.username + "_cataloger"
+        (_, first), (_, second), _ = da.put_many([("shared", "one", username), ("shared", "two", username),
+                                                  ("single", "three", username)])
+        assert da.list_absolute_keys(username) == ["shared", "single"]
+        assert da.list_absolute_keys(username, limit=1) == ["shared"]
+        assert da.list_absolute_keys(username, after="shared") == ["single"]
+        da.remove(first, username)
+        da.remove(second, TestDA.username)  # not theirs, kept
+        assert da.list_absolute_keys(username) == ["shared", "single"]
+        # forgotten by another process: only the tombstone log tells
+        with open(filestore._store_del, "a") as f:
+            f.write("%s,%s\n" % (username, second))
+        assert da.list_absolute_keys(username) == ["single"]
+        assert filestore._vacuum() >= 2
+        assert da.list_absolute_keys(username) == ["single"]
+        os.remove(filestore._catalog_path(filestore._store))  # e.g. a store kept before the catalog existed
+        filestore._catalogs.clear()
+        da.put("Late", "four", username)
+        assert da.list_absolute_keys(username) == ["late", "single"]
+
+    def test_tag_catalog_snapshot(self):
+        username = TestDA.username + "_snapshotted"
+        every, filestore._catalog_snapshot_every = filestore._catalog_snapshot_every, 3
+        try:
+            secrets = da.put_many([("tag %d" % i, "secret %d" % i, username) for i in range(4)])
+            assert da.list_absolute_keys(username) == ["tag %d" % i for i in range(4)]
+            assert os.path.exists(filestore._catalog_snapshot_path(filestore._store))
+            da.remove(secrets[0][1], username)  # resolved from the snapshot
+            da.put("tag 4", "secret 4", username)
+            filestore._catalogs.clear()
+            assert da.list_absolute_keys(username) == ["tag %d" % i for i in range(1, 5)]
+            catalog = filestore._catalog(filestore._store, filestore._store_del)
+            assert catalog.snapshot is not None and catalog.changes == 2 and len(catalog.keys) == 1
+            assert catalog.has(secrets[1][1]) and not catalog.has(secrets[0][1])
+            filestore._vacuum_shard(filestore._store, filestore._store_del)
+            filestore._catalogs.clear()
+            catalog = filestore._catalog(filestore._store, filestore._store_del)
+            assert catalog.changes == 0 and catalog.tags(username) == ["tag %d" % i for i in range(1, 5)]
+        finally:
+            filestore._catalog_snapshot_every = every
+
+    def test_key_line_separators(self):
+        # characters str.splitlines() breaks lines on, sidecar entries only end with "\n"
+        username = TestDA.username + "_separators"
+        every, filestore._catalog_snapshot_every = filestore._catalog_snapshot_every, 1
+        try:
+            da.put("a\x85b", "nel", username)
+            da.put("c\u2028d", "line separator", username)
+            da.put("plain", "plain", username)
+            filestore._indexes.clear()
+            filestore._catalogs.clear()
+            assert da.get("plain", username)[0][2] == "plain"
+            assert da.get("a\x85b", username)[0][2] == "nel"
+            assert da.list_absolute_keys(username) == ["a\x85b", "c\u2028d", "plain"]
+        finally:
+            filestore._catalog_snapshot_every = every
+        for key in ("a\tb", "a\nb", "a\rb"):
+            with pytest.raises(ValueError):
+                da.put(key, "split", username)
+
     def test_key_with_dash(self):
         keys, secret_id = da.put("mid-day", "newspaper?", TestDA.username)
         assert len(keys) == 3
@@ -81,3 +183,865 @@ class TestDA:
         da.put("bank", "money", username="hardworker")
         secret = da.get("bank", username="hacker")
         assert secret == []
+
+    def test_index_rebuild(self):
+        da.put("sidecar", "rebuilt", TestDA.username)
+        os.remove(filestore._index_path(filestore._store))
+        secrets = da.get("sidecar", TestDA.username)
+        assert secrets[0][2] == "rebuilt" and os.path.exists(filestore._index_path(filestore._store))
+
+    def test_index_catch_up(self):
+        secret = Secret()
+        secret.serialize("42", "unindexed", "appended", ["unindexed"], ["unindex"], TestDA.username, datetime.utcnow())
+        with open(filestore._store, "ab") as f:
+            f.write(secret.pack())
+        secrets = da.get("unindex", TestDA.username)
+        assert secrets[0][0] == "42"
+
+    def test_vacuum(self):
+        da.put("compact", "kept", TestDA.username)
+        _, secret_id = da.put("compact", "dropped", TestDA.username)
+        da.remove(secret_id, TestDA.username)
+        assert filestore._vacuum() >= 1
+        with open(filestore._store, "rb") as f:
+            assert b"dropped" not in f.read()
+        assert os.path.getsize(filestore._store_del) == 0
+        assert [s[2] for s in da.get("compact", TestDA.username)] == ["kept"]
+
+    def test_auto_vacuum(self):
+        _, secret_id = da.put("threshold", "dead", TestDA.username)
+        filestore._vacuum_ratio = 0.0001
+        try:
+            da.remove(secret_id, TestDA.username)
+        finally:
+            filestore._vacuum_ratio = 0
+        assert os.path.getsize(filestore._store_del) == 0
+        assert da.get("threshold", TestDA.username) == []
+
+    def test_tombstone_count(self):
+        (_, first), (_, second) = da.put_many([("counted", "one", TestDA.username),
+                                               ("counted", "two", TestDA.username)])
+        filestore._vacuum_ratio = 1000  # counted, never reached
+        try:
+            da.remove(first, TestDA.username)
+            index = filestore._index(filestore._store)
+            tombstones = index.tombstones
+            assert index.del_pos == os.path.getsize(filestore._store_del)
+            with open(filestore._store_del, "a") as f:  # written by another process
+                f.write("%s,%s\n" % (TestDA.username, second))
+            da.remove("unknown", TestDA.username)
+            assert index.tombstones == tombstones + 2 and index.del_pos == os.path.getsize(filestore._store_del)
+            filestore._vacuum()
+            da.remove("unknown", TestDA.username)
+            assert filestore._index(filestore._store).tombstones == 1
+        finally:
+            filestore._vacuum_ratio = 0
+
+    def test_remove_many(self):
+        username = TestDA.username + "_leaver"
+        sids = [sid for _keys, sid in da.put_many([("offboard", "secret %d" % i, username) for i in range(3)])]
+        da.put("offboard", "other user", TestDA.username)
+        da.remove_many(sids[:2], username)
+        assert [s[2] for s in da.get("offboard", username)] == ["secret 2"]
+        with open(filestore._store_del) as f:
+            assert f.read().count(username) == 2
+        assert da.complete("offbo", username) == ["offboard"]
+        da.remove_many(sids[2:], username)
+        assert da.complete("offbo", username) == [] and len(da.get("offboard", TestDA.username)) == 1
+
+    def test_remove_where(self):
+        username = TestDA.username + "_retention"
+        filestore.put_many([("old", "retained", ["retained"], ["retain"], username),
+                            ("other", "kept", ["kept"], ["kept"], username)])
+        da.put("Retained", "new", username)
+        assert da.remove_where(username, key="retained", older_than=timedelta(seconds=-1)) == 2
+        assert da.remove_where(username, key="retained") == 0
+        filestore.put("newer", "retained", ["retained"], ["retain"], username)
+        assert da.remove_where(username, older_than=datetime.utcnow() - timedelta(days=1)) == 0
+        assert [s[2] for s in da.get("retain", username)] == ["newer"]
+        assert da.remove_where(username) == 2
+        assert da.list_absolute_keys(username) == []
+
+    def test_explode_many(self):
+        keys = ["running fox", "Mid-Day", "a"]
+        assert [sorted(k) for k in da.explode_many(keys)] == [sorted(da._explode(k)) for k in keys]
+
+    def test_stem_cache(self):
+        da._explode("cacheable words")
+        hits = da.stem_cache_info().hits
+        da._explode("cacheable words")
+        assert da.stem_cache_info().hits >= hits + 2
+
+    def test_lazy_backend(self):
+        assert da._backend() is filestore
+        with pytest.raises(ValueError):
+            stores.load("floppy")
+
+    def test_put_many(self):
+        kept = da.put_many([("bulk import", "first", TestDA.username), ("bulk", "second", TestDA.username),
+                            ("bulk", "other", "someone")])
+        assert len(kept) == 3 and "import" in kept[0][0]
+        secrets = da.get("bulk", TestDA.username)
+        assert [s[0] for s in secrets] == [kept[0][1], kept[1][1]]
+        assert da.put_many([]) == []
+
+    def test_multi_tag_query(self):
+        da.put("prod db password", "hunter2", TestDA.username)
+        da.put("staging db password", "hunter3", TestDA.username)
+        da.put("prod vpn", "openvpn", TestDA.username)
+        assert [s[2] for s in da.get("prod db passwords", TestDA.username)] == ["hunter2"]
+        assert [s[2] for s in da.get(["prod", "password"], TestDA.username)] == ["hunter2"]
+        secrets = da.get(["staging", "vpn"], TestDA.username, match_all=False)
+        assert sorted(s[2] for s in secrets) == ["hunter3", "openvpn"]
+
+    def test_rank(self):
+        da.put("gateway", "exact", TestDA.username)
+        da.put("gateway address", "derived", TestDA.username)
+        da.put("gateways list", "stemmed", TestDA.username)
+        ranked = da.rank("gateway", TestDA.username)
+        assert [s[3] for s in ranked] == ["exact", "derived", "stemmed"]
+        assert 0 < ranked[-1][0] < ranked[0][0] <= 1
+        assert [s[3] for s in da.rank("gateway", TestDA.username, limit=1)] == ["exact"]
+
+    def test_query_cache(self):
+        da.put("cached", "first", TestDA.username)
+        da.get("cached", TestDA.username)
+        hits = da.cache_stats()["hits"]
+        assert [s[2] for s in da.get("cached", TestDA.username)] == ["first"]
+        assert da.cache_stats()["hits"] == hits + 1
+        da.put("cached", "second", TestDA.username)
+        assert [s[2] for s in da.get("cached", TestDA.username)] == ["first", "second"]
+
+    def test_query_cache_bounds(self):
+        cache = QueryCache(2, ttl=60)
+        for key in ("a", "b", "c"):
+            cache.put(key, "user", key.upper())
+        assert cache.get("a") is None and cache.get("c") == "C"
+        cache.invalidate("user")
+        assert cache.get("c") is None
+        cache = QueryCache(2, ttl=0)
+        cache.put("a", "user", "A")
+        assert cache.get("a") is None
+        cache = QueryCache(2, ttl=60)
+        generation = cache.generation("user")
+        cache.invalidate("user")  # while "a" was read
+        cache.put("a", "user", "A", generation)
+        assert cache.get("a") is None
+        cache.put("a", "user", "A", cache.generation("user"))
+        assert cache.get("a") == "A"
+
+    def test_query_cache_race(self, monkeypatch):
+        username = TestDA.username + "_racer"
+        da.put("raced", "first", username)
+        backend = da._backend()
+
+        class Racing:
+            # a secret is kept while the lookup reads the store
+            def __getattr__(self, name):
+                return getattr(backend, name)
+
+            def get(self, clauses, username, match_all=True):
+                secrets = list(backend.get(clauses, username, match_all))
+                monkeypatch.setattr(da, "_store", backend)
+                da.put("raced", "second", username)
+                return secrets
+
+        monkeypatch.setattr(da, "_store", Racing())
+        assert [s[2] for s in da.get("raced", username)] == ["first"]
+        assert [s[2] for s in da.get("raced", username)] == ["first", "second"]
+
+    def test_write_marks(self):
+        path = TestDA.test_db + ".marks"
+        mine, theirs = WriteMarks(path), WriteMarks(path)
+        assert not theirs.changed("alice")
+        mine.mark("alice")
+        assert theirs.changed("alice") and not theirs.changed("alice")
+        assert not mine.changed("alice") and not theirs.changed("bob")
+        mine.mark_all()
+        assert theirs.changed("bob") and not theirs.changed("bob")
+        marks, da._marks = da._marks, WriteMarks(path)
+        try:
+            da.put("marked", "first", TestDA.username)
+            assert [s[2] for s in da.get("marked", TestDA.username)] == ["first"]
+            assert da.complete("marke", TestDA.username) == ["marked"]
+            filestore.put("second", "marked again", ["marked", "again"], ["mark", "again"], TestDA.username)
+            mine.mark(TestDA.username)  # as another process keeping it would
+            assert [s[2] for s in da.get("marked", TestDA.username)] == ["first", "second"]
+            assert da.complete("marke", TestDA.username) == ["marked", "marked again"]
+        finally:
+            da._marks = marks
+
+    def test_store_versions(self):
+        username = TestDA.username + "_versioned"
+        checks, da._check_versions = da._check_versions, True
+        try:
+            da.put("versioned", "first", username)
+            assert [s[2] for s in da.get("versioned", username)] == ["first"]
+            assert da.complete("versioned", username) == ["versioned"]
+            version, hits = filestore.version(username), da._cache.stats()["hits"]
+            assert [s[2] for s in da.get("versioned", username)] == ["first"]
+            assert filestore.version(username) == version and da._cache.stats()["hits"] == hits + 1
+            # kept by another process, which doesn't mark its writes
+            filestore.put("second", "versioned again", ["versioned", "again"], ["version", "again"], username)
+            assert [s[2] for s in da.get("versioned", username)] == ["first", "second"]
+            assert da.complete("versioned", username) == ["versioned", "versioned again"]
+        finally:
+            da._check_versions = checks
+
+    def test_index_snapshot(self):
+        username = TestDA.username + "_snapshot"
+        filestore._snapshot_every = 2
+        try:
+            for i in range(5):
+                filestore.put("mapped %d" % i, "mapped", ["mapped"], ["map"], username)
+            assert len(filestore.get("map", username)) == 5  # written as the index is caught up
+            assert os.path.exists(filestore._snapshot_path(filestore._store))
+            filestore._indexes.clear()
+            index = filestore._index(filestore._store)
+            assert index.snapshot is not None and index.snapshot.records >= 4
+            assert [s[2] for s in filestore.get("map", username)] == ["mapped %d" % i for i in range(5)]
+            filestore.remove(filestore.get("mapped", username)[0][0], username)
+            filestore._compact(filestore._store, filestore._store_del, True)
+            assert not os.path.exists(filestore._snapshot_path(filestore._store))
+            assert [s[2] for s in filestore.get("map", username)] == ["mapped %d" % i for i in range(1, 5)]
+        finally:
+            filestore._snapshot_every = 0
+
+    def test_complete(self):
+        da.put("kubernetes cluster", "k8s", TestDA.username)
+        _keys, sid = da.put("kube config", "~/.kube", TestDA.username)
+        da.put("kubernetes", "other", "someone")
+        assert da.complete("Kub", TestDA.username) == ["kube", "kube config", "kubernet", "kubernetes",
+                                                       "kubernetes cluster"]
+        assert da.complete("kube", TestDA.username, limit=2) == ["kube", "kube config"]
+        da.remove(sid, TestDA.username)
+        assert da.complete("kube", TestDA.username, limit=2) == ["kubernet", "kubernetes"]
+        da._vocabulary.clear()
+        assert da.complete("kubernetes ", TestDA.username) == ["kubernetes", "kubernetes cluster"]
+        assert da.complete("zzz", TestDA.username) == []
+
+    def test_typos(self):
+        username = TestDA.username + "_typist"
+        da.put("kubernetes cluster", "k8s", username)
+        da.put("db password", "hunter2", username)
+        assert da.get("pasword", username) == []
+        da._typo_distance = 2
+        try:
+            assert [s[2] for s in da.get("pasword", username)] == ["hunter2"]
+            assert [s[3] for s in da.rank("kuberentes clustr", username)] == ["k8s"]
+            assert da.get("zzzzzzz", username) == []
+        finally:
+            da._typo_distance = 0
+
+    def test_trigram_candidates(self):
+        words = ["password", "passwords", "passport", "kubernetes", "kube", "api", "apis", "mobile"]
+        vocab = vocabulary.Vocabulary(lambda username: [(str(i), {w}) for i, w in enumerate(words)], ttl=60)
+        for typo in ("pasword", "passwrd", "kuberntes", "mobil", "apis", "xyz"):
+            brute = sorted((vocabulary.distance(typo, w, 2), w) for w in words)
+            assert vocab.similar("user", typo, 2) == [w for d, w in brute if d <= 2]
+        assert vocabulary.distance("kitten", "sitting", 3) == 3
+        assert vocabulary.distance("kitten", "sitting", 2) == 3
+
+    def test_page(self):
+        for i in range(5):
+            da.put("paged %d" % i if i % 2 else "paged", "secret %d" % i, TestDA.username)
+        assert sorted(s[2] for s in da.iter_get("paged", TestDA.username)) == ["secret %d" % i for i in range(5)]
+        pages, token = [], None
+        while True:
+            secrets, token = da.page("paged", TestDA.username, 2, token)
+            pages.append(secrets)
+            if token is None:
+                break
+        assert [len(secrets) for secrets in pages] == [2, 2, 1]
+        assert [s[3] for secrets in pages for s in secrets] == [s[3] for s in da.rank("paged", TestDA.username)]
+        with pytest.raises(ValueError):
+            da.page("paged", TestDA.username, 2, "garbage")
+        with pytest.raises(ValueError):
+            da.page("paged", TestDA.username, 0)
+
+    def test_page_cache(self):
+        da.put("hot", "first", TestDA.username)
+        assert [s[3] for s in da.page("hot", TestDA.username, 1)[0]] == ["first"]
+        hits = da.cache_stats()["hits"]
+        assert [s[3] for s in da.page("hot", TestDA.username, 1)[0]] == ["first"]
+        assert [s[2] for s in da.get("hot", TestDA.username)] == ["first"]
+        assert da.cache_stats()["hits"] == hits + 2
+        da.put("hot", "second", TestDA.username)
+        assert sorted(s[3] for s in da.page("hot", TestDA.username, 2)[0]) == ["first", "second"]
+        max_results, da._cache_max_results = da._cache_max_results, 1
+        try:
+            da.page("hot", TestDA.username, 1, match_all=False)
+            hits = da.cache_stats()["hits"]
+            da.page("hot", TestDA.username, 1, match_all=False)
+            assert da.cache_stats()["hits"] == hits  # too many matches to be cached
+        finally:
+            da._cache_max_results = max_results
+
+    def test_page_cache_race(self, monkeypatch):
+        username = TestDA.username + "_pager"
+        da.put("streamed", "first", username)
+        backend = da._backend()
+
+        class Racing:
+            # a secret is kept while the lookup streams from the store
+            def __getattr__(self, name):
+                return getattr(backend, name)
+
+            def iter_get(self, clauses, username, match_all=True):
+                yield from backend.iter_get(clauses, username, match_all)
+                monkeypatch.setattr(da, "_store", backend)
+                da.put("streamed", "second", username)
+
+        monkeypatch.setattr(da, "_store", Racing())
+        assert [s[3] for s in da.page("streamed", username, 5)[0]] == ["first"]
+        assert sorted(s[3] for s in da.page("streamed", username, 5)[0]) == ["first", "second"]
+
+    def test_search(self):
+        username = TestDA.username + "_searcher"
+        da.put("legacy box", "root@10.0.3.16, unindexed", username)
+        da._content_index = True
+        try:
+            da.put("jump host", "ssh root@10.0.3.17 -p 2222", username)
+            _, sid = da.put("status", "the servers are down", username)
+            da.put_many([("db", "postgres on 10.0.3.18", username)])
+        finally:
+            da._content_index = False
+        assert [s[1] for s in da.search("10.0.3.17", username)] == ["jump host"]
+        assert [s[1] for s in da.search("Server", username)] == ["status"]
+        assert sorted(s[1] for s in da.search("10.0.3.17 10.0.3.18", username, match_all=False)) == ["db", "jump host"]
+        assert da.search("root@10.0.3.16", username) == [] and da.search("the", username) == []
+        da.remove(sid, username)
+        assert da.search("servers", username) == []
+        filestore._vacuum()
+        assert [s[1] for s in da.search("2222", username)] == ["jump host"]
+        assert [s[1] for s in da.search("postgres", username)] == ["db"]
+        assert da.reindex_content() >= 3
+        assert [s[1] for s in da.search("unindexed", username)] == ["legacy box"]
+
+    def test_metrics(self):
+        metrics.reset()
+        da.put("metered", "value", TestDA.username)
+        assert metrics.render() == ""
+        metrics.enable()
+        try:
+            da._cache.clear()
+            da.get("metered", TestDA.username)
+            da.get("metered", TestDA.username)
+        finally:
+            metrics.enable(False)
+        text = metrics.render()
+        assert "dude_cache_hits_total 1\n" in text and "dude_cache_misses_total 1\n" in text
+        assert 'dude_records_matched_total{store="file"} 1\n' in text
+        assert 'dude_da_seconds_count{op="get"} 2\n' in text
+        assert 'dude_store_seconds_bucket{op="get",store="file",le="+Inf"} 1\n' in text
+        metrics.reset()
+
+    def test_sharded_layout(self):
+        single, single_del = filestore._store, filestore._store_del
+        da.put("sharding", "before", TestDA.username)
+        filestore._layout, filestore._store = "sharded", TestDA.test_db + "_shards"
+        try:
+            assert filestore._shard_store(single, single_del) > 0
+            da.put("sharding", "mine", "alice")
+            da.put("sharding", "theirs", "bob")
+            stores = [store for store, _store_del in filestore._shards()]
+            assert filestore._shard("alice")[0] in stores and filestore._shard("bob")[0] in stores
+            assert filestore._shard("alice") != filestore._shard("bob")
+            assert [s[2] for s in da.get("sharding", "alice")] == ["mine"]
+            assert [s[2] for s in da.get("sharding", TestDA.username)] == ["before"]
+        finally:
+            shutil.rmtree(filestore._store)
+            filestore._layout, filestore._store = "single", single
+
+    def test_read_during_vacuum(self):
+        username = TestDA.username + "_vacuumed"
+        ids = [filestore.put("moved %d" % i, "moved", ["moved"], ["move"], username) for i in range(3)]
+        filestore.remove(ids[0], username)
+        secrets = filestore.iter_get("move", username)
+        filestore._vacuum_shard(filestore._store, filestore._store_del, force=True)
+        assert [s[2] for s in secrets] == ["moved 1", "moved 2"]
+        assert [s[2] for s in filestore.iter_get("move", username)] == ["moved 1", "moved 2"]
+
+    def test_concurrent_writers(self):
+        ctx = multiprocessing.get_context("fork")
+        writers = [ctx.Process(target=_put_secrets, args=("stress", "writer %d" % i, 50)) for i in range(6)]
+        for writer in writers:
+            writer.start()
+        for _ in range(20):
+            da.put("stress", "parent", TestDA.username)
+        for writer in writers:
+            writer.join()
+            assert writer.exitcode == 0
+        for _offset, secret in filestore._cursor(filestore._store):
+            assert secret.secret
+        secrets = filestore.get("stress", TestDA.username)
+        assert len(secrets) == 6 * 50 + 20 and len({s[0] for s in secrets}) == len(secrets)
+
+    def test_binary_record(self):
+        secret = Secret()
+        secret.serialize("21", "foo bar", "lorem ipsum " * 100, ["foo", "bar"], ["foo", "bar"], "atif-user",
+                         datetime(2017, 6, 27, 19, 35, 44, 239))
+        record = secret.pack()
+        assert len(record) < len("lorem ipsum " * 100)
+        unpacked = Secret().unpack(io.BytesIO(record))
+        assert unpacked.summary() == secret.summary() and unpacked.username == "atif-user"
+        assert unpacked.derived_keys == ["foo", "bar"] and unpacked.fuzzy_keys == ["foo", "bar"]
+        skipped = io.BytesIO(record + record)
+        assert Secret().unpack(skipped, body=False).key == "foo bar" and Secret().unpack(skipped).sid == "21"
+
+    def test_convert_text_store(self):
+        store, store_del = filestore._store, filestore._store_del
+        filestore._store, filestore._store_del = TestDA.test_db + "_text", TestDA.test_db + "_text.deleted"
+        try:
+            with open(filestore._store, "w") as f:
+                f.write("\n====<BR 7>====\n%s\n2017-06-27 19:35:44.000239\nlegacy\nlegacy legaci\nold\n====<ER>===="
+                        % TestDA.username)
+            filestore.put("new", "legacy", ["legacy"], ["legaci"], TestDA.username)
+            assert [s[2] for s in filestore.get("legaci", TestDA.username)] == ["old", "new"]
+            assert filestore._convert() == 1
+            with open(filestore._store, "rb") as f:
+                assert f.read(len(filestore._MAGIC)) == filestore._MAGIC
+            assert [s[2] for s in filestore.get("legaci", TestDA.username)] == ["old", "new"]
+        finally:
+            filestore._store, filestore._store_del = store, store_del
+
+
+class TestMongoStore:
+    @classmethod
+    def setup_class(cls):
+        mongomock = pytest.importorskip("mongomock")
+        cls.username = '__tE5tE7__'
+        cls.collection = mongomock.MongoClient().db.secrets
+        mongostore._collection = cls.collection
+        mongostore._ensure_indexes(cls.collection)
+
+    @classmethod
+    def teardown_class(cls):
+        mongostore._collection = None
+
+    def test_indexes(self):
+        indexes = [info['key'] for info in TestMongoStore.collection.index_information().values()]
+        assert [("username", 1), ("all_keys", 1)] in indexes and [("username", 1), ("key", 1)] in indexes
+
+    def test_indexes_used(self):
+        pymongo = pytest.importorskip("pymongo")
+        client = pymongo.MongoClient(os.environ.get("DUDE_MDB_URI", "mongodb://localhost:27017/"),
+                                     serverSelectionTimeoutMS=500)
+        try:
+            client.admin.command("ping")
+        except pymongo.errors.PyMongoError:
+            pytest.skip("no MongoDB server to explain queries with")
+        collection = client["dude_test_explain"]["secrets"]
+        try:
+            collection.drop()
+            mongostore._ensure_indexes(collection)
+            username = TestMongoStore.username
+            collection.insert_many([mongostore._record("secret %d" % i, "tag %d" % i, ["tag"], ["tag"], username,
+                                                       datetime.utcnow(), {"word%d" % i}) for i in range(50)])
+            queries = [("all_keys", [["tag"], ["tag 7"]], True, "username_1_all_keys_1"),
+                       ("all_keys", "tag 7", False, "username_1_all_keys_1"),
+                       ("content_terms", "word7", True, "username_1_content_terms_1")]
+            for field, key, match_all, index in queries:
+                condn = mongostore._condition(field, key, username, match_all)
+                assert index in _index_scans(collection.find(condn).explain()["queryPlanner"]["winningPlan"])
+            explained = collection.database.command("explain", {"distinct": collection.name, "key": "key",
+                                                                "query": {"username": username}})
+            assert "username_1_key_1" in _index_scans(explained["queryPlanner"]["winningPlan"])
+        finally:
+            client.drop_database("dude_test_explain")
+
+    def test_all_keys(self):
+        mongostore.put("sleeping rabbit", "running fox", ["running", "fox"], ["run", "fox"], TestMongoStore.username)
+        record = TestMongoStore.collection.find_one({"key": "running fox"})
+        assert record['all_keys'] == ["fox", "run", "running", "running fox"]
+        assert mongostore.get([["run"], ["fox"]], TestMongoStore.username)[0][2] == "sleeping rabbit"
+        assert mongostore.get([["run"], ["hare"]], TestMongoStore.username, match_all=False)[0][2] == "sleeping rabbit"
+
+    def test_get_terms(self):
+        sid = mongostore.put("tea", "green tea", ["green", "tea"], ["green", "tea"], TestMongoStore.username + "_terms")
+        assert list(mongostore.get_terms(TestMongoStore.username + "_terms")) == [(sid, {"green", "tea", "green tea"})]
+
+    def test_search(self):
+        username = TestMongoStore.username + "_search"
+        mongostore.put("ssh root@10.0.3.17", "jump", ["jump"], ["jump"], username,
+                       content_keys={"ssh", "root@10.0.3.17"})
+        mongostore.put("nothing to see", "other", ["other"], ["other"], username)
+        assert [s[1] for s in mongostore.search([["root@10.0.3.17"]], username)] == ["jump"]
+        assert mongostore.reindex_content(lambda text: set(text.split())) >= 2
+        assert [s[1] for s in mongostore.search([["see"]], username)] == ["other"]
+
+    def test_remove(self):
+        username = TestMongoStore.username + "_remove"
+        sids = mongostore.put_many([("secret %d" % i, "tag %d" % (i % 2), ["tag"], ["tag"], username)
+                                    for i in range(5)])
+        mongostore.remove(sids[0], username)
+        mongostore.remove_many(sids[1:3], username)
+        assert [s[0] for s in mongostore.get("tag", username)] == sids[3:]
+        assert mongostore.remove_where(username, key="tag 0", older_than=datetime.utcnow() + timedelta(seconds=1)) == 1
+        mongostore.remove_all(username)
+        assert mongostore.get("tag", username) == []
+
+    def test_get_keys(self):
+        username = TestMongoStore.username + "_keys"
+        mongostore.put_many([(str(i), "tag %d" % (i % 3), ["tag"], ["tag"], username) for i in range(6)])
+        assert mongostore.get_keys(username) == ["tag 0", "tag 1", "tag 2"]
+        assert mongostore.get_keys(username, after="tag 0", limit=1) == ["tag 1"]
+
+    def test_migrate(self):
+        TestMongoStore.collection.insert_one({"username": TestMongoStore.username, "key": "legacy", "secret": "old",
+                                              "derived_keys": ["legacy"], "stemmed_keys": ["legaci"],
+                                              "in_ts": datetime.utcnow()})
+        assert mongostore.get("legaci", TestMongoStore.username) == []
+        assert mongostore.migrate() >= 1
+        assert mongostore.get("legaci", TestMongoStore.username)[0][2] == "old"
+
+
+class TestSqliteStore:
+    @classmethod
+    def setup_class(cls):
+        cls.username = '__tE5tE7__'
+        cls.test_db = '_testsqlite.db'
+        cls.db, cls.store, cls.storage = sqlitestore._db, da._store, da._storage
+        sqlitestore._db = cls.test_db
+        da._store, da._storage = sqlitestore, "sqlite"
+
+    @classmethod
+    def teardown_class(cls):
+        sqlitestore._local.connection.close()
+        sqlitestore._local.connection = None
+        sqlitestore._db = cls.db
+        da._store, da._storage = cls.store, cls.storage
+        for path in glob.glob(cls.test_db + "*"):
+            os.remove(path)
+
+    def test_registered(self):
+        assert stores.load("sqlite") is sqlitestore
+
+    def test_put_get_remove(self):
+        username = TestSqliteStore.username
+        da.put("running fox", "sleeping rabbit", username)
+        secrets = da.get("runs", username)
+        assert [s[2] for s in secrets] == ["sleeping rabbit"]
+        assert "running fox" in da.list_absolute_keys(username)
+        da.remove(secrets[0][0], username)
+        assert da.get("fox", username) == []
+        assert sqlitestore._connection().execute("SELECT COUNT(*) FROM secret_keys WHERE sid = ?",
+                                                 (secrets[0][0],)).fetchone()[0] == 0
+
+    def test_version(self):
+        username = TestSqliteStore.username + "_versioned"
+        version = sqlitestore.version(username)
+        secret_id = sqlitestore.put("one", "versioned", ["versioned"], ["version"], username)
+        assert sqlitestore.version(username) != version
+        version = sqlitestore.version(username)
+        sqlitestore.get([["versioned"]], username)
+        assert sqlitestore.version(username) == version
+        sqlitestore.remove(secret_id, username)
+        assert sqlitestore.version(username) != version
+
+    def test_match_any(self):
+        username = TestSqliteStore.username + "_any"
+        sqlitestore.put_many([("one", "green tea", ["green", "tea"], ["green", "tea"], username),
+                              ("two", "black coffee", ["black", "coffee"], ["black", "coffee"], username)])
+        assert [s[2] for s in sqlitestore.get([["green"], ["coffee"]], username)] == []
+        assert [s[2] for s in sqlitestore.get([["green"], ["coffee"]], username, match_all=False)] == ["one", "two"]
+        assert dict(sqlitestore.get_terms(username)).popitem()[1] <= {"green", "tea", "green tea",
+                                                                      "black", "coffee", "black coffee"}
+
+    def test_search(self):
+        username = TestSqliteStore.username + "_search"
+        sqlitestore.put("ssh root@10.0.3.17", "jump", ["jump"], ["jump"], username,
+                        content_keys={"ssh", "root", "10.0.3.17"})
+        sqlitestore.put("nothing to see", "other", ["other"], ["other"], username)
+        assert [s[1] for s in sqlitestore.search([["10.0.3.17"]], username)] == ["jump"]
+        assert sqlitestore.search([["10.0.3"]], username) == []
+        assert sqlitestore.reindex_content(lambda text: set(text.split())) >= 2
+        assert [s[1] for s in sqlitestore.search([["see"]], username)] == ["other"]
+
+    def test_content_rowids(self):
+        username = TestSqliteStore.username + "_content"
+        secret_ids = sqlitestore.put_many([("%d" % i, "tag %d" % i, ["tag"], ["tag"], username) for i in range(3)],
+                                          [{"word%d" % i} for i in range(3)])
+        connection = sqlitestore._connection()
+        aligned = ("SELECT COUNT(*) FROM secret_content c JOIN secrets s ON s.rowid = c.rowid AND s.sid = c.sid "
+                   "WHERE c.username = ?")
+        assert connection.execute(aligned, (username,)).fetchone()[0] == 3
+        with connection:
+            # as numbered before content rows had the rowid of their secret
+            connection.execute("UPDATE secret_content SET rowid = rowid + 1000 WHERE sid = ?", (secret_ids[0],))
+            connection.execute("PRAGMA user_version = 0")
+        sqlitestore._local.connection.close()
+        sqlitestore._local.connection = None
+        connection = sqlitestore._connection()
+        assert connection.execute(aligned, (username,)).fetchone()[0] == 3
+        sqlitestore.remove_many(secret_ids[:2], username)
+        assert connection.execute("SELECT sid FROM secret_content WHERE username = ?", (username,)).fetchall() == \
+            [(secret_ids[2],)]
+
+    def test_remove_where(self):
+        username = TestSqliteStore.username + "_remove"
+        sids = sqlitestore.put_many([("secret %d" % i, "tag %d" % (i % 2), ["tag"], ["tag"], username)
+                                     for i in range(5)], content_keys=[{"secret"}] * 5)
+        sqlitestore.remove_many(sids[:2], username)
+        assert [s[0] for s in sqlitestore.search([["secret"]], username)] == sids[2:]
+        assert sqlitestore.remove_where(username, key="tag 0", older_than=datetime.utcnow() - timedelta(days=1)) == 0
+        assert sqlitestore.remove_where(username, key="tag 0") == 2
+        assert [s[0] for s in sqlitestore.get("tag", username)] == [sids[3]]
+        sqlitestore.remove_all(username)
+        assert sqlitestore.search([["secret"]], username) == [] and list(sqlitestore.get_terms(username)) == []
+
+    def test_tags(self):
+        username = TestSqliteStore.username + "_tags"
+        sids = sqlitestore.put_many([(str(i), "tag %d" % (i % 3), ["tag"], ["tag"], username) for i in range(6)])
+        assert sqlitestore.get_keys(username, after="tag 0", limit=1) == ["tag 1"]
+        sqlitestore.remove_many(sids[:4], username)
+        assert sqlitestore.get_keys(username) == ["tag 1", "tag 2"]
+        connection = sqlitestore._connection()
+        connection.execute("DELETE FROM tags")  # as in a database created before the tags table existed
+        connection.commit()
+        connection.close()
+        sqlitestore._local.connection = None
+        assert sqlitestore.get_keys(username) == ["tag 1", "tag 2"]
+        assert sqlitestore._connection().execute("SELECT secrets FROM tags WHERE username = ? AND key = ?",
+                                                 (username, "tag 1")).fetchone()[0] == 1
+
+    def test_restore(self):
+        username = TestSqliteStore.username + "_restore"
+        sid = sqlitestore.put("old", "legacy", ["legacy"], ["legaci"], username)
+        records = [r for r in sqlitestore.iter_records() if r["username"] == username]
+        assert sqlitestore.restore_many(records) == 0  # already there
+        sqlitestore.remove_all(username)
+        assert sqlitestore.restore_many(records) == 1
+        assert sqlitestore.get("legaci", username)[0][:3] == (sid, "legacy", "old")
+
+
+class TestMigrate:
+    @classmethod
+    def setup_class(cls):
+        mongomock = pytest.importorskip("mongomock")
+        cls.username = '__tE5tE7__'
+        cls.test_db = '_testmigrate.db'
+        cls.stores = filestore._store, filestore._store_del
+        filestore._store, filestore._store_del = cls.test_db, cls.test_db + ".deleted"
+        mongostore._collection = mongomock.MongoClient().migrate.secrets
+        mongostore._ensure_indexes(mongostore._collection)
+
+    @classmethod
+    def teardown_class(cls):
+        filestore._store, filestore._store_del = cls.stores
+        mongostore._collection = None
+        for path in glob.glob(cls.test_db + "*"):
+            os.remove(path)
+
+    def test_file_to_mongodb_and_back(self):
+        username = TestMigrate.username
+        sids = filestore.put_many([("secret %d" % i, "tag %d" % i, ["tag", str(i)], ["tag", str(i)], username)
+                                   for i in range(5)])
+        filestore.remove(sids[1], username)
+        exported = io.StringIO()
+        assert migrate.export_records(filestore, exported) == 4
+        lines = exported.getvalue().splitlines()
+        assert json.loads(lines[0])["sid"] == sids[0]
+
+        assert migrate.import_records(mongostore, lines, batch_size=3) == 4
+        assert migrate.import_records(mongostore, lines, batch_size=3) == 0  # already there
+        secrets = mongostore.get("tag", username)
+        assert [s[0] for s in secrets] == [sids[0]] + sids[2:]
+        originals = {s[0]: s for s in filestore.get("tag", username)}
+        assert all(abs((s[3] - originals[s[0]][3]).total_seconds()) < 0.001 for s in secrets)
+        assert mongostore._secrets().delete_one({"_id": mongostore._object_id(sids[0])}).deleted_count == 1
+
+        filestore._store, filestore._store_del = TestMigrate.test_db + "_copy", TestMigrate.test_db + "_copy.deleted"
+        try:
+            assert migrate.restore(filestore, mongostore.iter_records(), batch_size=2) == 3
+            assert migrate.restore(filestore, mongostore.iter_records(), batch_size=2) == 0  # already there
+            assert [s[2] for s in filestore.get("tag", username)] == ["secret 2", "secret 3", "secret 4"]
+        finally:
+            filestore._store, filestore._store_del = TestMigrate.test_db, TestMigrate.test_db + ".deleted"
+
+
+class TestDaemon:
+    @classmethod
+    def setup_class(cls):
+        cls.username = '__tE5tE7__'
+        cls.test_db = '_testdaemon.db'
+        cls.tmp = tempfile.mkdtemp(prefix="dude-test-")
+        cls.stores = filestore._store, filestore._store_del
+        filestore._store, filestore._store_del = cls.test_db, cls.test_db + ".deleted"
+
+    @classmethod
+    def teardown_class(cls):
+        filestore._store, filestore._store_del = cls.stores
+        shutil.rmtree(cls.tmp)
+        for path in glob.glob(cls.test_db + "*"):
+            os.remove(path)
+
+    def test_serve(self):
+        path = os.path.join(TestDaemon.tmp, "dude.sock")
+        with pytest.raises(daemon.Unavailable):
+            daemon.request("tell", "ssh", TestDaemon.username, path=path)
+        idle, daemon._idle = daemon._idle, 0
+        server = threading.Thread(target=daemon.serve, args=(path,))
+        server.start()
+        try:
+            while not os.path.exists(path):
+                server.join(0.01)
+            keys, secret_id = daemon.request("keep", "ssh root@10.0.3.17", "ssh jump", TestDaemon.username, path=path)
+            assert keys == ["jump", "ssh", "ssh jump"]
+            secrets = daemon.request("tell", "jump", TestDaemon.username, path=path)
+            assert [s[1] for s in secrets] == [secret_id] and isinstance(secrets[0][4], datetime)
+            # kept by another process, which has no write marks to tell the daemon
+            filestore.put("ssh admin@10.0.3.18", "jump", ["jump"], ["jump"], TestDaemon.username)
+            secrets = daemon.request("tell", "jump", TestDaemon.username, path=path)
+            assert sorted(s[3] for s in secrets) == ["ssh admin@10.0.3.18", "ssh root@10.0.3.17"]
+            assert daemon.request("complete", "ju", TestDaemon.username, path=path) == ["jump"]
+            assert daemon.request("list_absolute_keys", TestDaemon.username, path=path) == ["jump", "ssh jump"]
+            with pytest.raises(RuntimeError):
+                daemon.request("remove_all", TestDaemon.username, path=path)
+            assert not daemon.serve(path)  # already served
+        finally:
+            daemon._idle = idle
+            daemon.request("shutdown", path=path)
+            server.join(5)
+        assert not server.is_alive() and not os.path.exists(path)
+
+    def test_socket_directory(self, monkeypatch):
+        runtime = os.path.join(TestDaemon.tmp, "runtime")
+        directory = os.path.join(runtime, "dude-%s" % getpass.getuser())
+        monkeypatch.setenv("XDG_RUNTIME_DIR", runtime)
+        monkeypatch.delenv("DUDE_DAEMON_SOCKET", raising=False)
+        os.makedirs(directory, mode=0o755)
+        os.chmod(directory, 0o755)  # readable by all, as if created by someone else
+        with pytest.raises(daemon.Unavailable):
+            daemon.socket_path()
+        os.rmdir(directory)
+        os.symlink(TestDaemon.tmp, directory)
+        with pytest.raises(daemon.Unavailable):
+            daemon.socket_path()
+        os.remove(directory)
+        assert os.path.dirname(daemon.socket_path()) == directory
+        assert stat.S_IMODE(os.lstat(directory).st_mode) == 0o700
+
+
+class TestSlack:
+    @classmethod
+    def setup_class(cls):
+        pytest.importorskip("bottle")
+        from src.clients import slack_dude
+        cls.slack = slack_dude
+        cls.test_db = '_testslack.db'
+        cls.stores = filestore._store, filestore._store_del
+        filestore._store = cls.test_db
+        filestore._store_del = cls.test_db + ".deleted"
+        cls.replies = queue.Queue()
+
+        class _FakeSlack(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                cls.replies.put(json.loads(body.decode("utf-8")))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        cls.fake_slack = HTTPServer(("localhost", 0), _FakeSlack)
+        cls.response_url = "http://localhost:%d/response" % cls.fake_slack.server_port
+        threading.Thread(target=cls.fake_slack.serve_forever, daemon=True).start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.fake_slack.shutdown()
+        filestore._store, filestore._store_del = cls.stores
+        for path in glob.glob(cls.test_db + "*"):
+            os.remove(path)
+
+    def _command(self, command, text):
+        return TestSlack.slack._handle("C1", "general", "U1", "slacker", command, text, TestSlack.response_url)
+
+    def test_deferred_reply(self):
+        assert self._command("/keep", "oncall alice") == "\n".join(["Kept! To recall just holla..",
+                                                                    "Hint: /tell oncall"])
+        assert self._command("/tell", "oncall") == "On it.."
+        assert TestSlack.replies.get(timeout=5) == {"text": "alice"}
+
+    def test_complete(self):
+        self._command("/keep", "oncall-backup bob")
+        assert self._command("/tell", "oncal*") == "On it.."
+        assert TestSlack.replies.get(timeout=5) == {"text": "\n".join(["Try one of these..", "oncal", "oncall",
+                                                                        "oncall-backup"])}
+
+    def test_pages(self):
+        self._command("/keep", "pager first")
+        self._command("/keep", "pager second")
+        assert self._command("/tell", "pager -n 1") == "On it.."
+        first = TestSlack.replies.get(timeout=5)["text"].split("\n")
+        assert first[-1].startswith("More: /tell pager -n 1 -p ")
+        assert self._command("/tell", first[-1][len("More: /tell "):]) == "On it.."
+        second = TestSlack.replies.get(timeout=5)["text"].split("\n")
+        assert sorted([first[1][6:], second[1][6:]]) == ["first", "second"] and len(second) == 2
+        assert self._command("/tell", "pager -n 0") == "On it.."
+        assert TestSlack.replies.get(timeout=5)["text"].split("\n")[-1].startswith("More: /tell pager -n 1 -p ")
+
+    def test_list_pages(self):
+        self._command("/keep", "catalog a")
+        self._command("/keep", "catalog b")
+        self._command("/keep", "catalog b")
+        assert self._command("/list", "-n 1") == "On it.."
+        first = TestSlack.replies.get(timeout=5)["text"].split("\n")
+        assert len(first) == 3 and first[-1] == "More: /list -n 1 -p %s" % first[1]
+        keys = da.list_absolute_keys("slacker")
+        assert keys == sorted(set(keys)) and keys[0] == first[1]
+        assert self._command("/list", "-n 1 -p %s" % keys[-1]) == "On it.."
+        assert TestSlack.replies.get(timeout=5)["text"] == "no more tags after %s" % keys[-1]
+        assert self._command("/list", "-n 0") == "On it.."
+        assert TestSlack.replies.get(timeout=5)["text"] == "\n".join(first)
+
+    def test_metrics_route(self):
+        metrics.reset()
+        metrics.enable()
+        try:
+            self._command("/keep", "metered secret")
+        finally:
+            metrics.enable(False)
+        assert 'dude_slack_commands_total{command="/keep"} 1' in TestSlack.slack.metrics_text()
+        metrics.reset()
+
+    def test_prefork(self):
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            port = sock.getsockname()[1]
+        env = dict(os.environ, DUDE_STORE="file", DUDE_FILE_DB=TestSlack.test_db + "_prefork",
+                   DUDE_SLACK_PORT=str(port), DUDE_SLACK_SERVER="prefork", DUDE_SLACK_PROCESSES="2",
+                   DUDE_SLACK_DEFER="", PYTHONPATH=os.getcwd())
+        server = subprocess.Popen([sys.executable, os.path.join("src", "clients", "slack_dude.py")], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    socket.create_connection(("localhost", port), timeout=1).close()
+                    break
+                except OSError:
+                    assert time.monotonic() < deadline
+                    time.sleep(0.1)
+            from bench.load import _command
+            # completed by both workers, whichever keeps the secret
+            with ThreadPoolExecutor(4) as pool:
+                assert set(pool.map(lambda _i: _command(port, "/tell", "forked*", "slacker"), range(4))) == \
+                    {"no tags starting with forked"}
+                _command(port, "/keep", "forked secret", "slacker")
+                assert set(pool.map(lambda _i: _command(port, "/tell", "forked*", "slacker"), range(4))) == \
+                    {"Try one of these..\nforked"}
+        finally:
+            server.terminate()
+            assert server.wait(30) == 0
+
+    def test_queue_depth(self):
+        slack = TestSlack.slack
+        slots, slack._queue_slots = slack._queue_slots, threading.BoundedSemaphore(1)
+        try:
+            slack._queue_slots.acquire()
+            assert self._command("/tell", "oncall").startswith("Too many secrets")
+        finally:
+            slack._queue_slots = slots